@@ -0,0 +1,163 @@
+from typing import Iterable, Iterator
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import groupby
+import re
+
+# Distinct stemmed forms kept; Zipfian text repeats a small set of words, so nearly every lookup is a hit.
+STEM_CACHE_SIZE = 1 << 16
+
+# Close to the Unicode word boundaries of Elasticsearch's standard tokenizer: "don't", "u.s.a" and "3.14" stay
+# one token, hyphens and other punctuation separate tokens.
+_TOKEN_PATTERN = re.compile(r"\w+(?:[.'’]\w+)*")
+_POSSESSIVE_SUFFIXES = ("'s", "’s")
+# Footnote markers like "[12]" in text copied from Wikipedia.
+WIKIPEDIA_SYMBOLS = (re.compile(r"\[\d+\]"), " ")
+
+# Lucene's English stop words (_english_).
+ENGLISH_STOP_WORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in", "into", "is", "it", "no", "not", "of",
+    "on", "or", "such", "that", "the", "their", "then", "there", "these", "they", "this", "to", "was", "will", "with",
+))
+
+
+@dataclass(frozen=True)
+class Analyzer:
+    # Stages in Elasticsearch's order: char filters on the raw text, the tokenizer, then the token filters
+    # lowercase, possessive stemmer, stop words and stemmer.
+    char_filters: tuple[tuple[re.Pattern, str], ...] = ()
+    possessive: bool = False
+    stop_words: frozenset[str] = frozenset()
+    stem: bool = False
+
+    def analyze(self, text: str) -> list[str]:
+        for pattern, replacement in self.char_filters:
+            text = pattern.sub(replacement, text)
+        tokens = _TOKEN_PATTERN.findall(text.lower())
+        if self.possessive:
+            tokens = [token[:-2] if token.endswith(_POSSESSIVE_SUFFIXES) else token for token in tokens]
+        if self.stop_words:
+            tokens = [token for token in tokens if token not in self.stop_words]
+        if self.stem:
+            tokens = [stem(token) for token in tokens]
+        return tokens
+
+    def analyze_many(self, texts: Iterable[str]) -> list[list[str]]:
+        return [self.analyze(text) for text in texts]
+
+    def iter_terms(self, texts: Iterable[str]) -> Iterator[str]:
+        for text in texts:
+            yield from self.analyze(text)
+
+
+STANDARD_ANALYZER = Analyzer()
+ENGLISH_ANALYZER = Analyzer(possessive=True, stop_words=ENGLISH_STOP_WORDS, stem=True)
+# custom_wikipedia_analyzer of the lab2 mapping.
+WIKIPEDIA_ANALYZER = Analyzer(char_filters=(WIKIPEDIA_SYMBOLS,), possessive=True, stop_words=ENGLISH_STOP_WORDS,
+                              stem=True)
+
+ANALYZERS = {
+    "standard": STANDARD_ANALYZER,
+    "english": ENGLISH_ANALYZER,
+    "custom_wikipedia_analyzer": WIKIPEDIA_ANALYZER,
+}
+
+
+# Porter's algorithm as in Lucene's PorterStemFilter (the "english" stemmer of Elasticsearch), including the
+# bli -> ble and logi -> log departures of Porter's reference implementation.
+
+_STEP2 = (("ational", "ate"), ("tional", "tion"), ("enci", "ence"), ("anci", "ance"), ("izer", "ize"),
+          ("bli", "ble"), ("alli", "al"), ("entli", "ent"), ("eli", "e"), ("ousli", "ous"), ("ization", "ize"),
+          ("ation", "ate"), ("ator", "ate"), ("alism", "al"), ("iveness", "ive"), ("fulness", "ful"),
+          ("ousness", "ous"), ("aliti", "al"), ("iviti", "ive"), ("biliti", "ble"), ("logi", "log"))
+_STEP3 = (("icate", "ic"), ("ative", ""), ("alize", "al"), ("iciti", "ic"), ("ical", "ic"), ("ful", ""),
+          ("ness", ""))
+_STEP4 = ("al", "ance", "ence", "er", "ic", "able", "ible", "ant", "ement", "ment", "ent", "ion", "ou", "ism",
+          "ate", "iti", "ous", "ive", "ize")
+
+
+def _is_consonant(word: str, i: int) -> bool:
+    if word[i] in "aeiou":
+        return False
+    if word[i] == "y":
+        return i == 0 or not _is_consonant(word, i - 1)
+    return True
+
+
+def _measure(stem: str) -> int:
+    # m in [C](VC){m}[V]
+    form = "".join(kind for kind, _ in groupby("c" if _is_consonant(stem, i) else "v" for i in range(len(stem))))
+    return form.count("vc")
+
+
+def _has_vowel(stem: str) -> bool:
+    return any(not _is_consonant(stem, i) for i in range(len(stem)))
+
+
+def _ends_double_consonant(word: str) -> bool:
+    return len(word) >= 2 and word[-1] == word[-2] and _is_consonant(word, len(word) - 1)
+
+
+def _ends_cvc(word: str) -> bool:
+    return (len(word) >= 3 and _is_consonant(word, len(word) - 3) and not _is_consonant(word, len(word) - 2)
+            and _is_consonant(word, len(word) - 1) and word[-1] not in "wxy")
+
+
+def _replace_suffix(word: str, rules: tuple[tuple[str, str], ...], min_measure: int) -> str:
+    # Only the first matching suffix is tried, as in the reference implementation.
+    for suffix, replacement in rules:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            return stem + replacement if _measure(stem) > min_measure else word
+    return word
+
+
+def _step1(word: str) -> str:
+    if word.endswith("sses") or word.endswith("ies"):
+        word = word[:-2]
+    elif word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    if word.endswith("eed"):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    elif (word.endswith("ed") and _has_vowel(word[:-2])) or (word.endswith("ing") and _has_vowel(word[:-3])):
+        word = word[:-2] if word.endswith("ed") else word[:-3]
+        if word.endswith(("at", "bl", "iz")):
+            word += "e"
+        elif _ends_double_consonant(word) and word[-1] not in "lsz":
+            word = word[:-1]
+        elif _measure(word) == 1 and _ends_cvc(word):
+            word += "e"
+    if word.endswith("y") and _has_vowel(word[:-1]):
+        word = word[:-1] + "i"
+    return word
+
+
+def _step4(word: str) -> str:
+    for suffix in _STEP4:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if suffix == "ion" and not stem.endswith(("s", "t")):
+                continue
+            return stem if _measure(stem) > 1 else word
+    return word
+
+
+def _step5(word: str) -> str:
+    if word.endswith("e"):
+        measure = _measure(word[:-1])
+        if measure > 1 or (measure == 1 and not _ends_cvc(word[:-1])):
+            word = word[:-1]
+    if word.endswith("ll") and _measure(word) > 1:
+        word = word[:-1]
+    return word
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word: str) -> str:
+    if len(word) <= 2:
+        return word
+    word = _step1(word)
+    word = _replace_suffix(word, _STEP2, 0)
+    word = _replace_suffix(word, _STEP3, 0)
+    return _step5(_step4(word))
@@ -0,0 +1,142 @@
+from typing import Callable, Optional, TextIO, TypeVar
+from dataclasses import dataclass
+from functools import wraps
+from pathlib import Path
+import cProfile
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# Instrumentation is off unless enable() is called, e.g. by the global --profile option. While it is off phase()
+# returns a shared no-op context manager and count() returns after one flag check, so the hooks can stay in hot
+# paths; they are still placed per file, chunk or query rather than per token.
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_profiler: Optional[cProfile.Profile] = None
+_profile_output: Optional[Path] = None
+_started = 0.0
+
+F = TypeVar("F", bound=Callable)
+
+
+@dataclass
+class PhaseStats:
+    calls: int = 0
+    seconds: float = 0
+    # Largest amount of memory traced while the phase ran, nested phases included.
+    peak_memory_bytes: int = 0
+
+
+_phases: dict[str, PhaseStats] = {}
+_counters: dict[str, int] = {}
+
+
+class _NullPhase:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        return None
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.peak = 0
+
+    def __enter__(self) -> None:
+        stack = _phase_stack()
+        if stack:
+            # reset_peak() below would lose the peak reached so far by the enclosing phase.
+            stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        stack.append(self)
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        seconds = time.perf_counter() - self._start
+        stack = _phase_stack()
+        stack.pop()
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        with _lock:
+            stats = _phases.setdefault(self.name, PhaseStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.peak_memory_bytes = max(stats.peak_memory_bytes, self.peak)
+
+
+def _phase_stack() -> list[_Phase]:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(profile_output: Optional[Path] = None) -> None:
+    global _enabled, _profiler, _profile_output, _started
+    _enabled = True
+    _started = time.perf_counter()
+    tracemalloc.start()
+    if profile_output is not None:
+        _profile_output = profile_output
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def phase(name: str):
+    return _Phase(name) if _enabled else _NULL_PHASE
+
+
+def timed(name: str) -> Callable[[F], F]:
+    def decorator(function: F) -> F:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: int = 1) -> None:
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def report(out: TextIO = sys.stderr) -> None:
+    # Phases nest, so their times do not add up to the total. Timings include the cost of memory tracing.
+    if not _enabled:
+        return
+    total = time.perf_counter() - _started
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_output)
+    _, peak = tracemalloc.get_traced_memory()
+    print(f"\nProfile: {total:.3f}s total, peak traced memory {peak / 2 ** 20:.1f} MiB", file=out)
+    if _phases:
+        print(f"{'phase':<32}{'calls':>10}{'seconds':>12}{'share':>8}{'peak MiB':>10}", file=out)
+        for name, stats in sorted(_phases.items(), key=lambda item: item[1].seconds, reverse=True):
+            share = stats.seconds / total * 100 if total else 0
+            print(f"{name:<32}{stats.calls:>10}{stats.seconds:>12.4f}{share:>7.1f}%"
+                  f"{stats.peak_memory_bytes / 2 ** 20:>10.1f}", file=out)
+    if _counters:
+        print(f"{'counter':<32}{'value':>10}", file=out)
+        for name, value in sorted(_counters.items()):
+            print(f"{name:<32}{value:>10}", file=out)
+    if _profiler is not None:
+        print(f"cProfile stats written to {_profile_output}, top functions by cumulative time:", file=out)
+        pstats.Stats(str(_profile_output), stream=out).sort_stats("cumulative").print_stats(15)
@@ -0,0 +1,205 @@
+from typing import Any, Callable, Iterator, Optional
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from inverted_index import InvertedIndex
+from lsh import LSHParameters
+from postings import difference, intersect_many, union_many
+from segment import SegmentReader, write_segment
+from sparse_tfidf import sparse_backend_available
+from spimi import DEFAULT_MEMORY_BUDGET
+from synthetic_corpus import CorpusParameters, document_frequency_estimate, generate_corpus, vocabulary
+from vector import VectorBackend, VectorIndex
+
+RESULTS_FORMAT_VERSION = 1
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    seconds: float
+    # Peak of memory allocated by Python during the phase, None when memory tracing was off.
+    peak_memory_bytes: Optional[int] = None
+    details: dict[str, Any] = field(default_factory=dict)
+
+
+class _Recorder:
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.results: list[BenchmarkResult] = []
+
+    @contextmanager
+    def measure(self, name: str, **details) -> Iterator[dict[str, Any]]:
+        # Timings taken with memory tracing on include its overhead; compare runs made with the same setting.
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield details
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.results.append(BenchmarkResult(name, seconds, peak, details))
+            print(f"{name}: {seconds:.3f}s" + (f", peak {peak / 2 ** 20:.1f} MiB" if peak is not None else ""))
+
+    def repeat(self, name: str, run: Callable[[], Any], repeat: int, **details) -> None:
+        # Mean time of repeated queries; the result size of the last run is kept as the selectivity.
+        with self.measure(name, repeat=repeat, **details) as measured:
+            for _ in range(repeat):
+                result = run()
+            measured["matches"] = len(result)
+        self.results[-1].seconds /= repeat
+
+
+def _boolean_queries(parameters: CorpusParameters) -> dict[str, str]:
+    words = vocabulary(parameters.vocabulary_size)
+    frequent, common, rare = words[0], words[1], words[-1]
+    middle = words[len(words) // 100]
+    return {
+        "frequent_term": f'"{frequent}"',
+        "rare_term": f'"{rare}"',
+        "frequent_and_frequent": f'"{frequent}" & "{common}"',
+        "frequent_and_rare": f'"{frequent}" & "{rare}"',
+        "medium_or_medium": f'"{middle}" | "{words[len(words) // 100 + 1]}"',
+        "frequent_and_not_medium": f'"{frequent}" & !"{middle}"',
+        "three_way_and": f'"{frequent}" & "{common}" & "{middle}"',
+    }
+
+
+def _vector_queries(parameters: CorpusParameters) -> dict[str, str]:
+    words = vocabulary(parameters.vocabulary_size)
+    return {
+        "short_frequent": f'"{words[0]}" "{words[1]}"',
+        "short_rare": f'"{words[-1]}" "{words[-2]}"',
+        "long_mixed": " ".join(f'"{word}"' for word in words[::max(1, len(words) // 10)]),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def _working_directory(path: Path) -> Iterator[None]:
+    # Indexes are stored next to the current directory, the benchmark must not touch the user's ones.
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _benchmark_inverted_index(recorder: _Recorder, corpus: Path, index_terms: Path, parameters: CorpusParameters,
+                              workers: int, memory_budget: int, repeat: int) -> None:
+    index = InvertedIndex()
+    index.replace_index_terms(index_terms, positional=False)
+    with recorder.measure("inverted.index_text_corpus", workers=workers):
+        index.index_text_corpus(corpus, workers, memory_budget)
+    with recorder.measure("inverted.save"):
+        index.save()
+    index.close()
+    with recorder.measure("inverted.load"):
+        index = InvertedIndex.open()
+    recorder.results[-1].details["bytes"] = sum(path.stat().st_size for path in Path(".").glob("index_terms*"))
+    for name, query in _boolean_queries(parameters).items():
+        recorder.repeat(f"inverted.search.{name}", lambda: index.search(query, use_cache=False), repeat,
+                        query=query)
+    index.close()
+
+
+def _benchmark_vector_index(recorder: _Recorder, corpus: Path, index_terms: Path, parameters: CorpusParameters,
+                            workers: int, memory_budget: int, repeat: int, top_k: int) -> None:
+    index = VectorIndex()
+    index.replace_index_terms(index_terms)
+    with recorder.measure("vector.index_text_corpus", workers=workers):
+        index.index_text_corpus(corpus, workers, memory_budget)
+    with recorder.measure("vector.save"):
+        index.save()
+    index.close()
+    with recorder.measure("vector.load"):
+        index = VectorIndex.open()
+    recorder.results[-1].details["bytes"] = sum(path.stat().st_size for path in Path(".").glob("vector_index*"))
+    backends = [VectorBackend.python, VectorBackend.lsh]
+    if sparse_backend_available():
+        backends.append(VectorBackend.sparse)
+    for backend in backends:
+        # The first query pays for building the backend's structures, it is reported on its own.
+        with recorder.measure(f"vector.{backend.value}.first_query"):
+            index.search('"term1"', backend, top_k, use_cache=False)
+        for name, query in _vector_queries(parameters).items():
+            recorder.repeat(f"vector.{backend.value}.search.{name}",
+                            lambda: index.search(query, backend, top_k, LSHParameters(), use_cache=False), repeat,
+                            query=query, top_k=top_k)
+    index.close()
+
+
+def _benchmark_postings_encodings(recorder: _Recorder, parameters: CorpusParameters, repeat: int) -> None:
+    # The dense terms of the corpus written once as bitmaps and once as delta varints; bitmaps are only worth
+    # storing while they decode and combine faster.
+    generator = random.Random(parameters.seed)
+    documents = [f"doc{number}" for number in range(parameters.documents)]
+    words = vocabulary(parameters.vocabulary_size)[:2]
+    postings = {word: sorted(generator.sample(range(parameters.documents), round(
+        parameters.documents * document_frequency_estimate(parameters, rank)))) for rank, word in enumerate(words, 1)}
+    for encoding, dense_bitmaps in (("bitmap", True), ("varint", False)):
+        path = Path(f"postings_{encoding}.bin")
+        write_segment(path, documents, postings, dense_bitmaps=dense_bitmaps)
+        reader = SegmentReader(path)
+        operations = {
+            "decode": lambda: list(reader.postings(words[0])),
+            "and": lambda: intersect_many([reader.postings(word) for word in words]),
+            "or": lambda: union_many([reader.postings(word) for word in words]),
+            "not": lambda: difference(reader.postings(words[0]), reader.postings(words[1])),
+        }
+        for name, run in operations.items():
+            recorder.repeat(f"postings.{encoding}.{name}", run, repeat, terms=words)
+        reader.close()
+
+
+def run_benchmark(parameters: CorpusParameters, output: Path, workers: int = 1,
+                  memory_budget: int = DEFAULT_MEMORY_BUDGET, repeat: int = 5, top_k: int = 10,
+                  trace_memory: bool = True) -> list[BenchmarkResult]:
+    recorder = _Recorder(trace_memory)
+    output = Path(output).resolve()
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as work_dir:
+        work_dir = Path(work_dir)
+        corpus = work_dir / "corpus"
+        with recorder.measure("corpus.generate", **asdict(parameters)):
+            index_terms = generate_corpus(corpus, parameters)
+        with _working_directory(work_dir):
+            _benchmark_inverted_index(recorder, corpus, index_terms, parameters, workers, memory_budget, repeat)
+            _benchmark_postings_encodings(recorder, parameters, repeat)
+            _benchmark_vector_index(recorder, corpus, index_terms, parameters, workers, memory_budget, repeat,
+                                    top_k)
+
+    data = {
+        "format_version": RESULTS_FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count(), "sparse_backend": sparse_backend_available()},
+        "parameters": {**asdict(parameters), "workers": workers, "memory_budget": memory_budget, "repeat": repeat,
+                       "top_k": top_k, "trace_memory": trace_memory,
+                       "frequent_term_document_share": document_frequency_estimate(parameters, 1)},
+        "results": [asdict(result) for result in recorder.results],
+    }
+    with open(output, "w") as f:
+        json.dump(data, f, indent=4)
+    return recorder.results
@@ -0,0 +1,332 @@
+from typing import Callable, Iterator, Mapping, Optional, Union
+from dataclasses import dataclass
+from bisect import bisect_left
+import logging
+import re
+
+from search_common.analysis import Analyzer
+
+from postings import Postings, difference, intersect_many, union_many
+from tokenizer import tokenize_text
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Term:
+    term: str
+
+
+@dataclass(frozen=True)
+class Prefix:
+    # "eag*": every term starting with the prefix.
+    prefix: str
+
+
+@dataclass(frozen=True)
+class Phrase:
+    terms: tuple[str, ...]
+    text: str
+
+
+@dataclass(frozen=True)
+class Near:
+    left: Union[Term, Phrase]
+    right: Union[Term, Phrase]
+    distance: int
+
+
+@dataclass(frozen=True)
+class And:
+    children: tuple['QueryNode', ...]
+
+
+@dataclass(frozen=True)
+class Or:
+    children: tuple['QueryNode', ...]
+
+
+@dataclass(frozen=True)
+class Not:
+    child: 'QueryNode'
+
+
+QueryNode = Union[Term, Prefix, Phrase, Near, And, Or, Not]
+TermPositions = Callable[[str], Optional[Mapping[int, list[int]]]]
+
+_TOKEN_PATTERN = re.compile(r'\s*(?:"([^"]*)"|(\()|(\))|(near/\d+|&&?|\|\|?|!|\w+)|(\S))', re.IGNORECASE)
+_AND = {"&", "&&", "and"}
+_OR = {"|", "||", "or"}
+_NOT = {"!", "not"}
+
+
+def _tokenize(query: str) -> Iterator[tuple[str, str]]:
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _TOKEN_PATTERN.match(query, position)
+        term, left, right, operator, unexpected = match.groups()
+        position = match.end()
+        if term is not None:
+            yield "term", term
+        elif left:
+            yield "(", left
+        elif right:
+            yield ")", right
+        elif operator is not None and operator.lower() in _AND:
+            yield "and", operator
+        elif operator is not None and operator.lower() in _OR:
+            yield "or", operator
+        elif operator is not None and operator.lower() in _NOT:
+            yield "not", operator
+        elif operator is not None and operator.lower().startswith("near/"):
+            yield "near", operator
+        elif '"' in (operator or unexpected or ""):
+            raise QuerySyntaxError(f"Unterminated quote at position {match.start()}")
+        else:
+            raise QuerySyntaxError(f"Unexpected {operator or unexpected!r} at position {match.start()}, "
+                                   f"terms must be quoted")
+
+
+class _Parser:
+    # Queries historically were conjunctions of disjunctions ('"a" | "b" & "c"' is (a OR b) AND c), so OR binds
+    # tighter than AND here. Adjacent terms without an operator are OR-ed, as the old parser did, but a NOT
+    # following a term without an operator excludes it from everything before: '"a" NOT "b"' is a AND NOT b.
+    def __init__(self, query: str, analyzer: Optional[Analyzer] = None):
+        self._tokens = list(_tokenize(query))
+        self._position = 0
+        self._analyzer = analyzer
+
+    def _peek(self) -> Optional[str]:
+        if self._position < len(self._tokens):
+            return self._tokens[self._position][0]
+        return None
+
+    def _next(self) -> tuple[str, str]:
+        token = self._tokens[self._position]
+        self._position += 1
+        return token
+
+    def parse(self) -> QueryNode:
+        if not self._tokens:
+            raise QuerySyntaxError("Empty query")
+        node = self._and()
+        if self._peek() is not None:
+            raise QuerySyntaxError(f"Unexpected {self._tokens[self._position][1]!r}")
+        return node
+
+    def _and(self) -> QueryNode:
+        children = [self._or()]
+        while self._peek() in ("and", "not"):
+            if self._peek() == "and":
+                self._next()
+            children.append(self._or())
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def _or(self) -> QueryNode:
+        children = [self._not()]
+        while self._peek() in ("or", "term", "("):
+            if self._peek() == "or":
+                self._next()
+            children.append(self._not())
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def _not(self) -> QueryNode:
+        if self._peek() == "not":
+            self._next()
+            return Not(self._not())
+        return self._near()
+
+    def _near(self) -> QueryNode:
+        node = self._primary()
+        while self._peek() == "near":
+            _, operator = self._next()
+            right = self._primary()
+            if not isinstance(node, (Term, Phrase)) or not isinstance(right, (Term, Phrase)):
+                raise QuerySyntaxError(f"{operator} only combines terms and phrases")
+            node = Near(node, right, int(operator.split("/")[1]))
+        return node
+
+    def _primary(self) -> QueryNode:
+        kind = self._peek()
+        if kind is None:
+            raise QuerySyntaxError("Unexpected end of query")
+        _, value = self._next()
+        if kind == "term":
+            if value.endswith("*") and len(value[:-1].split()) == 1:
+                # Prefixes are not stemmed, like Elasticsearch's prefix queries.
+                return Prefix(value[:-1].lower() if self._analyzer else value[:-1])
+            if value.strip() == "*":
+                raise QuerySyntaxError("A wildcard needs at least one character before the *")
+            if self._analyzer is None:
+                words = tuple(tokenize_text(value))
+                return Phrase(words, value) if len(words) > 1 else Term(value)
+            words = tuple(self._analyzer.analyze(value))
+            if len(words) > 1:
+                return Phrase(words, value)
+            # A stop word analyzes to nothing and, like a match query of stop words only, matches no document.
+            return Term(words[0] if words else value)
+        if kind == "(":
+            node = self._and()
+            if self._peek() != ")":
+                raise QuerySyntaxError("Missing closing parenthesis")
+            self._next()
+            return node
+        raise QuerySyntaxError(f"Unexpected {value!r}")
+
+
+def _canonical(node: QueryNode) -> QueryNode:
+    # Flattens nested operators of the same kind and sorts and deduplicates their operands, so equal
+    # sub-expressions compare equal and are evaluated once.
+    if isinstance(node, Not):
+        child = _canonical(node.child)
+        return child.child if isinstance(child, Not) else Not(child)
+    if isinstance(node, Near):
+        left, right = sorted((node.left, node.right), key=repr)
+        return Near(left, right, node.distance)
+    if isinstance(node, (And, Or)):
+        children = set()
+        for child in map(_canonical, node.children):
+            if type(child) is type(node):
+                children.update(child.children)
+            else:
+                children.add(child)
+        if len(children) == 1:
+            return children.pop()
+        return type(node)(tuple(sorted(children, key=repr)))
+    return node
+
+
+def parse_query(query: str, analyzer: Optional[Analyzer] = None) -> QueryNode:
+    return _canonical(_Parser(query, analyzer).parse())
+
+
+class QueryPlan:
+    def __init__(self, root: QueryNode, document_frequency: Callable[[str], int], documents_count: int,
+                 prefix_terms: Optional[Callable[[str], list[str]]] = None):
+        self.root = root
+        self._document_frequency = document_frequency
+        self._documents_count = documents_count
+        self._prefix_terms = prefix_terms
+        self._costs: dict[QueryNode, int] = {}
+        self._expansions: dict[str, list[str]] = {}
+
+    def expand(self, node: Prefix) -> list[str]:
+        if node.prefix not in self._expansions:
+            self._expansions[node.prefix] = self._prefix_terms(node.prefix) if self._prefix_terms else []
+        return self._expansions[node.prefix]
+
+    def cost(self, node: QueryNode) -> int:
+        # Estimated number of matching documents.
+        if node not in self._costs:
+            if isinstance(node, Term):
+                cost = self._document_frequency(node.term)
+            elif isinstance(node, Prefix):
+                cost = min(self._documents_count, sum(map(self._document_frequency, self.expand(node))))
+            elif isinstance(node, Phrase):
+                cost = min(self._document_frequency(term) for term in node.terms)
+            elif isinstance(node, Near):
+                cost = min(self.cost(node.left), self.cost(node.right))
+            elif isinstance(node, And):
+                cost = min(self.cost(child) for child in node.children)
+            elif isinstance(node, Or):
+                cost = min(self._documents_count, sum(self.cost(child) for child in node.children))
+            else:
+                cost = self._documents_count - self.cost(node.child)
+            self._costs[node] = cost
+        return self._costs[node]
+
+    def execute(self, postings: Callable[[str], Optional[Postings]], universe: Callable[[], list[int]],
+                positions: Optional[TermPositions] = None) -> list[int]:
+        results: dict[QueryNode, Postings] = {}
+        # Start positions of phrase matches per document, filled while evaluating phrases.
+        phrase_starts: dict[Phrase, dict[int, list[int]]] = {}
+
+        def starts(node: Union[Term, Phrase]) -> Mapping[int, list[int]]:
+            if isinstance(node, Term):
+                return positions(node.term) or {}
+            evaluate(node)
+            return phrase_starts[node]
+
+        def evaluate_phrase(node: Phrase) -> Postings:
+            if positions is None:
+                logging.warning("The index has no positions, %r is looked up as a single term", node.text)
+                return postings(node.text) or []
+            # Candidates must contain every term; then term i has to occur i positions after a phrase start.
+            candidates = intersect_many([postings(term) or [] for term in node.terms])
+            term_positions = [positions(term) or {} for term in node.terms]
+            matches = {}
+            for doc_id in candidates:
+                phrase_start = set(term_positions[0][doc_id])
+                for offset, other in enumerate(term_positions[1:], start=1):
+                    phrase_start.intersection_update(position - offset for position in other[doc_id])
+                    if not phrase_start:
+                        break
+                if phrase_start:
+                    matches[doc_id] = sorted(phrase_start)
+            phrase_starts[node] = matches
+            return list(matches)
+
+        def evaluate_near(node: Near) -> Postings:
+            if positions is None:
+                raise QuerySyntaxError("NEAR needs an index created with positions")
+            candidates = intersect_many([evaluate(node.left), evaluate(node.right)])
+            left_starts, right_starts = starts(node.left), starts(node.right)
+            left_length, right_length = _span_length(node.left), _span_length(node.right)
+            result = []
+            for doc_id in candidates:
+                right = right_starts[doc_id]
+                for start in left_starts[doc_id]:
+                    # First right span that does not end more than distance before this left span starts.
+                    index = bisect_left(right, start - node.distance - right_length + 1)
+                    if index < len(right) and right[index] <= start + left_length - 1 + node.distance:
+                        result.append(doc_id)
+                        break
+            return result
+
+        def evaluate(node: QueryNode) -> Postings:
+            if node in results:
+                return results[node]
+            if isinstance(node, Term):
+                result = postings(node.term) or []
+            elif isinstance(node, Prefix):
+                result = union_many([postings(term) or [] for term in self.expand(node)])
+            elif isinstance(node, Phrase):
+                result = evaluate_phrase(node)
+            elif isinstance(node, Near):
+                result = evaluate_near(node)
+            elif isinstance(node, Or):
+                result = union_many([evaluate(child) for child in node.children])
+            elif isinstance(node, Not):
+                result = difference(universe(), evaluate(node.child))
+            else:
+                result = evaluate_and(node)
+            logging.debug("%s matched %d documents", node, len(result))
+            results[node] = result
+            return result
+
+        def evaluate_and(node: And) -> Postings:
+            included = sorted((child for child in node.children if not isinstance(child, Not)), key=self.cost)
+            excluded = sorted((child.child for child in node.children if isinstance(child, Not)),
+                              key=self.cost, reverse=True)
+            result: Postings = universe() if not included else evaluate(included[0])
+            # Most selective operands first; once nothing is left the remaining operands are never evaluated.
+            for child in included[1:]:
+                if not result:
+                    return []
+                result = intersect_many([result, evaluate(child)])
+            for child in excluded:
+                if not result:
+                    return []
+                result = difference(result, evaluate(child))
+            return result
+
+        result = evaluate(self.root)
+        return result if isinstance(result, list) else list(result)
+
+
+def _span_length(node: Union[Term, Phrase]) -> int:
+    return len(node.terms) if isinstance(node, Phrase) else 1
+
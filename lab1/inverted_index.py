@@ -1,100 +1,430 @@
-from typing import Generator
-from dataclasses import dataclass, asdict, field
+from typing import Generator, Iterable, Iterator, Optional, Union
+from collections.abc import Container
+from dataclasses import dataclass, field
+from functools import partial
 import json
 from contextlib import contextmanager
+from itertools import repeat
 import os
 from pathlib import Path
-from collections import defaultdict
 import logging
-import re
+import sys
+import tempfile
 
+from search_common import profiling
+from search_common.analysis import WIKIPEDIA_ANALYZER, Analyzer
 
+from boolean_query import QueryNode, QueryPlan, parse_query
+from postings import add_doc_id
+from manifest import Manifest
+from result_cache import ResultCache
+from segment import (SegmentReader, SegmentWriter, FLAG_ANALYZED, FLAG_NEW_INDEX_TERMS_ALLOWED, FLAG_OPEN_VOCABULARY,
+                     FLAG_POSITIONAL)
+from segment_list import SegmentEntry, SegmentList, merge_start
+from spimi import DEFAULT_MEMORY_BUDGET, RunPostings, build_runs, merge_runs, read_run
+from tokenizer import tokenize_file
+
+
+INDEX_SEGMENTS_PATH = "index_segments.json"
+INDEX_SEGMENT_STEM = "index_terms"
+INDEX_MANIFEST_PATH = "index_manifest.json"
+INDEX_CACHE_PATH = "index_query_cache.json"
+# Indexes saved before segment lists have a single segment under this name; it is read as their only segment.
+INDEX_SEGMENT_PATH = "index_terms.seg"
+# Indexes saved before the segment format are still read once and converted on the next save.
 INDEX_TERMS_PATH = "index_terms.json"
 
 
+class MemorySegment:
+    # Documents indexed since the last save, behind the read interface of SegmentReader.
+    def __init__(self, terms: Optional[dict[str, list[int]]] = None):
+        self.postings_by_term: dict[str, list[int]] = terms if terms is not None else {}
+        # term -> doc ID -> positions of the term in the document, only kept for positional indexes
+        self.positions_by_term: dict[str, dict[int, list[int]]] = {}
+        self.documents: list[str] = []
+
+    @property
+    def documents_count(self) -> int:
+        return len(self.documents)
+
+    def document_name(self, doc_id: int) -> str:
+        return self.documents[doc_id]
+
+    def document_names(self) -> list[str]:
+        return list(self.documents)
+
+    def document_frequency(self, term: str) -> int:
+        return len(self.postings_by_term.get(term, ()))
+
+    def postings(self, term: str) -> Optional[list[int]]:
+        return self.postings_by_term.get(term)
+
+    def positions(self, term: str) -> Optional[list[list[int]]]:
+        postings = self.postings_by_term.get(term)
+        if postings is None:
+            return None
+        positions = self.positions_by_term.get(term, {})
+        return [positions[doc_id] for doc_id in postings]
+
+    def terms_with_prefix(self, prefix: str) -> list[str]:
+        # A linear scan, saved segments answer from their sorted dictionary.
+        return sorted(term for term in self.postings_by_term if term.startswith(prefix))
+
+    def terms(self) -> Iterator[str]:
+        return iter(sorted(self.postings_by_term))
+
+
+Segment = Union[SegmentReader, MemorySegment]
+
+
+def _term_positions(segment: Segment, term: str) -> Optional[dict[int, list[int]]]:
+    postings = segment.postings(term)
+    if postings is None:
+        return None
+    return dict(zip(postings, segment.positions(term)))
+
+
+def _run_postings(segment: Segment, deleted: Container[int], offset: int,
+                  positional: bool) -> Iterator[tuple[str, RunPostings]]:
+    # Postings of the live documents of a segment, renumbered from offset in doc ID order.
+    new_ids: list[Optional[int]] = []
+    next_id = offset
+    for doc_id in range(segment.documents_count):
+        new_ids.append(None if doc_id in deleted else next_id)
+        next_id += doc_id not in deleted
+    for term in segment.terms():
+        positions = segment.positions(term) if positional else repeat([])
+        yield term, [(new_ids[doc_id], len(doc_positions) or 1, doc_positions)
+                     for doc_id, doc_positions in zip(segment.postings(term), positions)
+                     if new_ids[doc_id] is not None]
+
+
+def _live_names(segment: Segment, deleted: Container[int]) -> list[str]:
+    return [name for doc_id, name in enumerate(segment.document_names()) if doc_id not in deleted]
+
+
 @dataclass()
 class InvertedIndex:
-    index_terms: defaultdict[str, dict[str, list[str]]] = field(default_factory=dict)
+    # Saved documents live in immutable segments. New documents are written as one more segment and removed ones
+    # are marked in the deletion set of their segment; segments are only rewritten when merge_start says so.
     new_index_terms_allowed: bool = True
+    positional: bool = False
+    # Index every term met while indexing, not only the ones of the index terms file.
+    open_vocabulary: bool = False
+    # Stem and drop stop words like the custom_wikipedia_analyzer of the Elasticsearch mapping, instead of only
+    # lowercasing.
+    analyzed: bool = False
+    _segments: SegmentList = field(default_factory=SegmentList, init=False, repr=False)
+    # Opened readers, in the order of _segments.segments.
+    _readers: list[SegmentReader] = field(default_factory=list, init=False, repr=False)
+    _pending: MemorySegment = field(default_factory=MemorySegment, init=False, repr=False)
+    _pending_ids: dict[str, int] = field(default_factory=dict, init=False, repr=False)
+    _pending_deleted: set[int] = field(default_factory=set, init=False, repr=False)
+    # name -> (position in _readers, doc ID) of the live saved documents, read on first use.
+    _locations: Optional[dict[str, tuple[int, int]]] = field(default=None, init=False, repr=False)
+    _vocabulary: Optional[frozenset[str]] = field(default=None, init=False, repr=False)
+    # Segment files merged away; they are unlinked once the segment list no longer names them.
+    _obsolete: list[str] = field(default_factory=list, init=False, repr=False)
+    _manifest: Optional[Manifest] = field(default=None, init=False, repr=False)
+    _dirty: bool = field(default=True, init=False, repr=False)
+    # Where the index files live; shards of a sharded index each have their own directory.
+    _directory: Path = field(default=Path("."), init=False, repr=False)
+
+    def _views(self) -> list[tuple[Segment, set[int]]]:
+        views = [(reader, entry.deleted) for reader, entry in zip(self._readers, self._segments.segments)]
+        # An index without segments keeps its vocabulary in the pending segment until the first save.
+        if self._pending.documents_count or not views:
+            views.append((self._pending, self._pending_deleted))
+        return views
+
+    def _document_locations(self) -> dict[str, tuple[int, int]]:
+        if self._locations is None:
+            self._locations = {}
+            for position, (reader, entry) in enumerate(zip(self._readers, self._segments.segments)):
+                for doc_id, name in enumerate(reader.document_names()):
+                    if doc_id not in entry.deleted:
+                        self._locations[name] = (position, doc_id)
+        return self._locations
+
+    def _closed_vocabulary(self) -> frozenset[str]:
+        # The oldest segment keeps every index term, with or without postings, through all merges.
+        if self._vocabulary is None:
+            terms = self._readers[0].terms() if self._readers else self._pending.postings_by_term
+            self._vocabulary = frozenset(terms)
+        return self._vocabulary
+
+    def _get_manifest(self) -> Manifest:
+        if self._manifest is None:
+            self._manifest = Manifest.read(self._directory / INDEX_MANIFEST_PATH)
+        return self._manifest
+
+    def has_document(self, name: str) -> bool:
+        return name in self._pending_ids or name in self._document_locations()
+
+    def remove_document(self, name: str) -> None:
+        if name in self._pending_ids:
+            self._pending_deleted.add(self._pending_ids.pop(name))
+        else:
+            position, doc_id = self._document_locations().pop(name)
+            self._segments.segments[position].deleted.add(doc_id)
+        self._get_manifest().forget(name)
+        self._dirty = True
 
-    def replace_index_terms(self, path: Path) -> None:
+    def _analyzer(self) -> Optional[Analyzer]:
+        return WIKIPEDIA_ANALYZER if self.analyzed else None
+
+    def replace_index_terms(self, path: Optional[Path], positional: bool = False,
+                            open_vocabulary: bool = False, analyzed: bool = False) -> None:
+        # Without a path the index starts with an empty vocabulary, which only makes sense with open_vocabulary.
         if not self.new_index_terms_allowed:
             logging.warning("Adding index terms after initialisation is not allowed.")
             return
-        with open(path, "r") as f:
-            index_terms = json.load(f)
-            self.index_terms["index_terms"] = {}
-            for key in index_terms["index_terms"].keys():
-                self.index_terms["index_terms"][key] = []
-            self.new_index_terms_allowed = False
-
-    def index_text_corpus(self, dir_path: Path):
-        pathlist = Path(dir_path).glob('*')
-        for path in pathlist:
+        self._pending = MemorySegment()
+        if path is not None:
             with open(path, "r") as f:
-                document = "".join(f.readlines())
-                self.index_document(path.name, document)
-
-    def index_document(self, name: str, document: str):
-        words = set(document.replace(",", "").replace(".", "").replace("\n", " ").lower().split(" "))
-        for word in words:
-            indexed_documents = self.index_terms["index_terms"].get(word, None)
-            if indexed_documents is not None and name not in indexed_documents:
-                indexed_documents.append(name)
-
-    def _construct_words(self, normal_conjunctive: str) -> list[set[str]]:
-        indexes = [m.start() for m in re.finditer('&', normal_conjunctive)]
-        indexes.append(len(normal_conjunctive) - 1)
-        last_index = -1
-        search_by_words: list[set] = []
-        for index in indexes:
-            disjunctive = normal_conjunctive[last_index + 1:index + 1].replace("&", "")
-            terms_between = [m.start() for m in re.finditer('\"', disjunctive)]
-            assert len(terms_between) % 2 == 0
-            words = set()
-            for position, index_start in enumerate(terms_between):
-                if position % 2 == 1:
+                index_terms = json.load(f)
+                keys = index_terms["index_terms"].keys()
+                # Analyzed indexes hold the analyzed forms, so "eagles" becomes "eagl" and stop words are dropped.
+                for key in WIKIPEDIA_ANALYZER.iter_terms(keys) if analyzed else keys:
+                    self._pending.postings_by_term[sys.intern(key)] = []
+        self._vocabulary = None
+        self.new_index_terms_allowed = False
+        self.positional = positional
+        self.open_vocabulary = open_vocabulary
+        self.analyzed = analyzed
+        self._dirty = True
+
+    def index_text_corpus(self, dir_path: Path, workers: int = 1, memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                          names: Optional[Container[str]] = None):
+        # names restricts the index to some of the corpus files, e.g. the ones of one shard.
+        manifest = self._get_manifest()
+        changes = manifest.scan(dir_path, names)
+        for name in changes.to_remove + [path.name for path in changes.added]:
+            if self.has_document(name):
+                self.remove_document(name)
+        if workers != 1 and changes.to_index:
+            self._index_text_corpus_parallel(changes.to_index, workers, memory_budget)
+        else:
+            for path in changes.to_index:
+                self.index_document(path.name, tokenize_file(path, analyzer=self._analyzer()))
+        manifest.update(dir_path, changes)
+
+    def _index_text_corpus_parallel(self, paths: list[Path], workers: int, memory_budget: int):
+        # Workers write sorted partial indexes (runs) for batches of files, then the runs and the pending
+        # documents are merged term by term straight into a new segment, so the postings never have to fit in
+        # memory. Saved segments are left as they are.
+        vocabulary = None if self.open_vocabulary else self._closed_vocabulary()
+        documents = _live_names(self._pending, self._pending_deleted)
+        sources = [_run_postings(self._pending, self._pending_deleted, 0, self.positional)]
+        with tempfile.TemporaryDirectory(dir=self._directory) as run_dir:
+            with profiling.phase("spimi.build_runs"):
+                runs = build_runs([(len(documents) + number, path) for number, path in enumerate(paths)],
+                                  Path(run_dir), vocabulary, workers, memory_budget, self.positional,
+                                  self._analyzer())
+            with profiling.phase("spimi.merge_runs"):
+                self._write_segment(documents + [path.name for path in paths],
+                                    merge_runs(sources + [read_run(run) for run in runs]))
+        self._clear_pending()
+
+    @profiling.timed("inverted.index_document")
+    def index_document(self, name: str, terms: Iterable[str]):
+        pending = self._pending
+        doc_id = self._pending_ids.get(name)
+        if doc_id is None:
+            doc_id = self._pending_ids[name] = pending.documents_count
+            pending.documents.append(name)
+        vocabulary = None if self.open_vocabulary else self._closed_vocabulary()
+        for position, word in enumerate(terms):
+            indexed_documents = pending.postings_by_term.get(word)
+            if indexed_documents is None:
+                if vocabulary is not None and word not in vocabulary:
                     continue
-                words.add(disjunctive[index_start + 1:terms_between[position + 1]])
-            last_index = index
-            search_by_words.append(words)
-        return search_by_words
-
-    def search(self, normal_conjunctive: str):
-        words_collection = self._construct_words(normal_conjunctive)
-        result: set | None = None
-        for words in words_collection:
-            disjunction = set()
-            for word in words:
-                indexed = self.index_terms["index_terms"].get(word, None)
-                if indexed is not None:
-                    disjunction.update(indexed)
-            print(disjunction)
-            if result is None:
-                result = disjunction
-            else:
-                result = result.intersection(disjunction)
+                # Interned, so the positions map and the tokens of later documents share the dictionary's string.
+                indexed_documents = pending.postings_by_term[sys.intern(word)] = []
+            add_doc_id(indexed_documents, doc_id)
+            if self.positional:
+                pending.positions_by_term.setdefault(word, {}).setdefault(doc_id, []).append(position)
+        self._dirty = True
+
+    def _search_segment(self, node: QueryNode, segment: Segment, deleted: set[int]) -> list[str]:
+        def live_doc_ids() -> list[int]:
+            return [doc_id for doc_id in range(segment.documents_count) if doc_id not in deleted]
+
+        plan = QueryPlan(node, segment.document_frequency, segment.documents_count - len(deleted),
+                         segment.terms_with_prefix)
+        doc_ids = plan.execute(segment.postings, live_doc_ids,
+                               partial(_term_positions, segment) if self.positional else None)
+        return [segment.document_name(doc_id) for doc_id in doc_ids if doc_id not in deleted]
+
+    def search(self, query: str, use_cache: bool = True) -> list[str]:
+        with profiling.phase("query.parse"):
+            node = parse_query(query, self._analyzer())
+        # Only saved indexes have an identity and a generation that identify their content.
+        cache = ResultCache.open(self._directory / INDEX_CACHE_PATH) if use_cache and not self._dirty else None
+        # The canonical form ignores whitespace, operand order and duplicate operands.
+        key = repr(node)
+        if cache is not None:
+            result = cache.get(key, self._segments.identity, self._segments.generation)
+            if result is not None:
+                return list(result)
+        # A document lives in one segment and every segment evaluates the whole query against its documents, so
+        # the concatenation in segment order is the result in doc ID order of one big segment.
+        result = []
+        with profiling.phase("query.execute"):
+            for segment, deleted in self._views():
+                result.extend(self._search_segment(node, segment, deleted))
+        if cache is not None:
+            cache.put(key, self._segments.identity, self._segments.generation, result)
         return result
 
+    def _write_segment(self, documents: list[str], postings: Iterable[tuple[str, RunPostings]]) -> None:
+        name = self._segments.new_name(INDEX_SEGMENT_STEM)
+        writer = SegmentWriter(self._directory / name, documents, self._flags(),
+                               generation=self._segments.generation + 1)
+        with writer:
+            for term, term_postings in postings:
+                writer.add(term, [posting[0] for posting in term_postings],
+                           [posting[2] for posting in term_postings] if self.positional else None)
+        self._readers.append(SegmentReader(self._directory / name))
+        self._segments.segments.append(SegmentEntry(name, len(documents)))
+        self._locations = None
+        self._dirty = True
+
+    def _clear_pending(self) -> None:
+        self._pending = MemorySegment()
+        self._pending_ids = {}
+        self._pending_deleted = set()
+
+    @profiling.timed("inverted.merge")
+    def _merge(self, start: int) -> None:
+        readers, entries = self._readers[start:], self._segments.segments[start:]
+        del self._readers[start:], self._segments.segments[start:]
+        documents: list[str] = []
+        sources = []
+        for reader, entry in zip(readers, entries):
+            sources.append(_run_postings(reader, entry.deleted, len(documents), self.positional))
+            documents.extend(_live_names(reader, entry.deleted))
+        # Newer segments without live documents are dropped, the oldest one is kept for its vocabulary.
+        if documents or not self._readers:
+            self._write_segment(documents, merge_runs(sources))
+        for reader, entry in zip(readers, entries):
+            reader.close()
+            self._obsolete.append(entry.name)
+
+    @profiling.timed("inverted.save")
     def save(self) -> None:
-        with open(INDEX_TERMS_PATH, "w") as f:
-            json.dump(asdict(self), f, default=str, indent=4)
+        if self._manifest is not None:
+            self._manifest.save(self._directory / INDEX_MANIFEST_PATH)
+        if not self._dirty:
+            return
+        # A new index is saved even without documents, its segment keeps the vocabulary and the options.
+        if self._pending.documents_count > len(self._pending_deleted) or not self._readers:
+            documents = _live_names(self._pending, self._pending_deleted)
+            self._write_segment(documents, _run_postings(self._pending, self._pending_deleted, 0, self.positional))
+            self._clear_pending()
+        start = merge_start(self._segments.segments)
+        if start < len(self._segments.segments):
+            self._merge(start)
+        self._segments.generation += 1
+        self._segments.save(self._directory / INDEX_SEGMENTS_PATH)
+        for name in self._obsolete:
+            os.unlink(self._directory / name)
+        self._obsolete = []
+        self._dirty = False
+
+    def _flags(self) -> int:
+        flags = FLAG_NEW_INDEX_TERMS_ALLOWED if self.new_index_terms_allowed else 0
+        if self.positional:
+            flags |= FLAG_POSITIONAL
+        if self.open_vocabulary:
+            flags |= FLAG_OPEN_VOCABULARY
+        if self.analyzed:
+            flags |= FLAG_ANALYZED
+        return flags
+
+    def close(self) -> None:
+        for reader in self._readers:
+            reader.close()
+        self._readers = []
+
+    def _attach_segments(self, segments: SegmentList, readers: list[SegmentReader]) -> None:
+        flags = readers[0].flags
+        self.new_index_terms_allowed = bool(flags & FLAG_NEW_INDEX_TERMS_ALLOWED)
+        self.positional = bool(flags & FLAG_POSITIONAL)
+        self.open_vocabulary = bool(flags & FLAG_OPEN_VOCABULARY)
+        self.analyzed = bool(flags & FLAG_ANALYZED)
+        self._segments = segments
+        self._readers = readers
+        self._dirty = False
 
     @classmethod
-    @contextmanager
-    def load(cls) -> Generator['InvertedIndex', None, None]:
+    def from_legacy_json(cls, data: dict) -> 'InvertedIndex':
+        index = cls(new_index_terms_allowed=data.get("new_index_terms_allowed", True))
+        terms = index._pending.postings_by_term
+        for term, names in data.get("index_terms", {}).get("index_terms", {}).items():
+            postings = terms[term] = []
+            for name in names:
+                if name not in index._pending_ids:
+                    index._pending_ids[name] = index._pending.documents_count
+                    index._pending.documents.append(name)
+                add_doc_id(postings, index._pending_ids[name])
+        return index
+
+    @classmethod
+    def _open_segments(cls, directory: Path) -> Optional[tuple[SegmentList, list[SegmentReader]]]:
+        segments = SegmentList.read(directory / INDEX_SEGMENTS_PATH)
+        if segments is None:
+            try:
+                reader = SegmentReader(directory / INDEX_SEGMENT_PATH)
+            except FileNotFoundError:
+                return None
+            entry = SegmentEntry(INDEX_SEGMENT_PATH, reader.documents_count)
+            return SegmentList(reader.generation, [entry], identity=""), [reader]
+        readers = []
         try:
-            with open(INDEX_TERMS_PATH, "r") as f:
-                index_terms = json.load(f)
-                query = cls(**index_terms)
-        except (FileNotFoundError, json.JSONDecodeError):
-            query = cls()
+            for entry in segments.segments:
+                readers.append(SegmentReader(directory / entry.name))
+        except FileNotFoundError:
+            # A merge unlinked the segment after this list was read; the new list names its replacement.
+            for reader in readers:
+                reader.close()
+            return cls._open_segments(directory)
+        return segments, readers
+
+    @classmethod
+    @profiling.timed("inverted.open")
+    def open(cls, directory: Path = Path(".")) -> 'InvertedIndex':
+        opened = cls._open_segments(directory)
+        if opened is not None:
+            index = cls()
+            index._attach_segments(*opened)
+        else:
+            try:
+                with open(directory / INDEX_TERMS_PATH, "r") as f, profiling.phase("json.load"):
+                    index = cls.from_legacy_json(json.load(f))
+            except (FileNotFoundError, json.JSONDecodeError):
+                index = cls()
+        index._directory = directory
+        return index
+
+    @classmethod
+    @contextmanager
+    def load(cls, read_only: bool = False, directory: Path = Path(".")) -> Generator['InvertedIndex', None, None]:
+        query = cls.open(directory)
         try:
             yield query
+            # Nothing is saved when the caller failed, a half applied change must not reach the segment list.
+            if not read_only:
+                query.save()
+            ResultCache.open(directory / INDEX_CACHE_PATH).save()
         finally:
-            query.save()
+            query.close()
 
     @classmethod
     def reset_index_terms(cls) -> None:
-        os.unlink(INDEX_TERMS_PATH)
-
+        segments = SegmentList.read(Path(INDEX_SEGMENTS_PATH))
+        names = [entry.name for entry in segments.segments] if segments is not None else []
+        for path in names + [INDEX_SEGMENTS_PATH, INDEX_SEGMENT_PATH, INDEX_TERMS_PATH, INDEX_MANIFEST_PATH]:
+            if os.path.exists(path):
+                os.unlink(path)
+        ResultCache.delete(Path(INDEX_CACHE_PATH))
@@ -0,0 +1,100 @@
+from typing import Any
+from dataclasses import dataclass
+import hashlib
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+# Sign bits of the projections stored with every document of a vector segment. Queries whose tables x bits fit in
+# them, with the seed they were computed with, read their buckets from the segment instead of hashing documents.
+SIGNATURE_BITS = 256
+# Terms projected at once; the projections of a chunk take terms x bits floats.
+PROJECTION_CHUNK_TERMS = 16384
+
+
+@dataclass(frozen=True)
+class LSHParameters:
+    # More tables and probes raise recall, more bits per table make buckets smaller and queries faster.
+    tables: int = 32
+    bits: int = 8
+    # Extra buckets looked up per table at query time, made by flipping the bits whose projections were closest
+    # to zero (multi-probe LSH).
+    probes: int = 4
+    seed: int = 0
+
+
+def lsh_available() -> bool:
+    return np is not None and sparse is not None
+
+
+def _term_hashes(terms: list[str], seed: int) -> "np.ndarray":
+    return np.fromiter((int.from_bytes(hashlib.blake2b(f"{seed}:{term}".encode("utf-8"), digest_size=8).digest(),
+                                       "little") for term in terms), dtype=np.uint64, count=len(terms))
+
+
+def projections(terms: list[str], seed: int, bits: int) -> "np.ndarray":
+    # terms x bits matrix of +1 / -1 hyperplane components. A component is a splitmix64 hash of the term and the
+    # column, so it does not depend on the rest of the vocabulary: documents and queries agree without a stored
+    # matrix, and the first bits of a longer signature are the bits of a shorter one.
+    with np.errstate(over="ignore"):
+        columns = np.arange(1, bits + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        values = _term_hashes(terms, seed)[:, None] + columns
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        values ^= values >> np.uint64(31)
+    return np.where(values >> np.uint64(63), 1.0, -1.0).astype(np.float32)
+
+
+def document_signatures(terms: list[str], term_offsets: list[int], doc_ids: Any, weights: Any, idf: list[float],
+                        documents_count: int, seed: int, bits: int) -> "np.ndarray":
+    # Sign bits of every document's projections, documents x bits. The term-major columns of a vector segment
+    # hold tf / norm; scaled by idf they are the unit tf-idf vectors the query is compared with. All documents are
+    # projected with one sparse product per chunk of terms.
+    by_term = sparse.csr_matrix((np.frombuffer(weights, dtype=np.float32).astype(np.float64) *
+                                 np.repeat(np.asarray(idf, dtype=np.float64), np.diff(np.asarray(term_offsets))),
+                                 np.frombuffer(doc_ids, dtype=np.uint32), np.asarray(term_offsets)),
+                                shape=(len(terms), documents_count))
+    projected = np.zeros((documents_count, bits))
+    for start in range(0, len(terms), PROJECTION_CHUNK_TERMS):
+        chunk = by_term[start:start + PROJECTION_CHUNK_TERMS]
+        projected += chunk.T @ projections(terms[start:start + PROJECTION_CHUNK_TERMS], seed, bits)
+    return projected >= 0
+
+
+def pack_signatures(signatures: "np.ndarray") -> bytes:
+    return np.packbits(signatures, axis=1, bitorder="little").tobytes()
+
+
+def unpack_signatures(packed: Any, documents_count: int, bits: int) -> "np.ndarray":
+    rows = np.frombuffer(packed, dtype=np.uint8).reshape(documents_count, bits // 8)
+    return np.unpackbits(rows, axis=1, bitorder="little").astype(bool)
+
+
+class RandomProjectionLSH:
+    # Signed random projections: a table hashes a vector to the signs of its projections on `bits` hyperplanes, so
+    # vectors with a small angle between them share a bucket with high probability. The bucket of every document
+    # in every table is kept as one documents x tables array, and a query's buckets are matched against it with
+    # vectorised comparisons.
+    def __init__(self, parameters: LSHParameters, signatures: "np.ndarray"):
+        self.parameters = parameters
+        self._shifts = np.arange(parameters.bits, dtype=np.uint64)
+        table_bits = signatures[:, :parameters.tables * parameters.bits].reshape(
+            len(signatures), parameters.tables, parameters.bits)
+        self._buckets = (table_bits.astype(np.uint64) << self._shifts).sum(axis=2, dtype=np.uint64)
+
+    def candidates(self, query: dict[str, float], probes: int = 0) -> "np.ndarray":
+        # Doc IDs sharing a bucket with the weighted query terms in any table.
+        bits = self.parameters.bits
+        weights = np.fromiter(query.values(), dtype=np.float64, count=len(query))
+        projection = weights @ projections(list(query), self.parameters.seed, self.parameters.tables * bits)
+        matches = np.zeros(len(self._buckets), dtype=bool)
+        for table in range(self.parameters.tables):
+            values = projection[table * bits:(table + 1) * bits]
+            bucket = int(((values >= 0).astype(np.uint64) << self._shifts).sum(dtype=np.uint64))
+            buckets = [bucket] + [bucket ^ (1 << int(bit)) for bit in np.argsort(np.abs(values))[:probes]]
+            matches |= np.isin(self._buckets[:, table], np.asarray(buckets, dtype=np.uint64))
+        return np.flatnonzero(matches)
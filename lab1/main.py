@@ -1,30 +1,81 @@
 import typer
+from boolean_query import QuerySyntaxError
 from inverted_index import InvertedIndex
-from vector import VectorIndex
+from benchmark import run_benchmark
+from lsh import LSHParameters
+from vector import VectorIndex, VectorBackend
+from server import run_server
+from sharding import ShardedInvertedIndex, ShardedVectorIndex, load_inverted_index, load_vector_index
 from pathlib import Path
+from search_common import profiling
+from typing import Optional
+from spimi import DEFAULT_MEMORY_BUDGET
+from synthetic_corpus import CorpusParameters, generate_corpus
 
 app = typer.Typer()
 
+WORKERS_HELP = "Indexing processes, 0 uses every core. Defaults to 1, or to every core for a sharded index."
+
+
+@app.callback()
+def main(
+        ctx: typer.Context,
+        profile: bool = typer.Option(False, help="Print a per-phase time, memory and counter breakdown."),
+        profile_output: Optional[Path] = typer.Option(None, help="Also run cProfile and write its stats here."),
+):
+    if profile or profile_output is not None:
+        profiling.enable(profile_output)
+        ctx.call_on_close(profiling.report)
+
+
+@app.command()
+def init_index_terms(
+        path: Optional[Path] = typer.Argument(None),
+        positional: bool = typer.Option(False, help="Store term positions."),
+        open_vocabulary: bool = typer.Option(False, help="Also index terms missing from PATH."),
+        analyzed: bool = typer.Option(False, help="Stem and drop stop words like custom_wikipedia_analyzer."),
+        shards: int = typer.Option(1, min=1, help="Partition the documents across this many shards."),
+):
+    if path is None and not open_vocabulary:
+        raise typer.BadParameter("PATH is required unless --open-vocabulary is set", param_hint="PATH")
+    if shards > 1:
+        ShardedInvertedIndex.create(shards)
+    with load_inverted_index() as inverted_index:
+        inverted_index: InvertedIndex
+        inverted_index.replace_index_terms(path, positional, open_vocabulary, analyzed)
+
 
 @app.command()
-def init_index_terms(path: Path):
-    with InvertedIndex.load() as inverted_index:
+def index_text_corpus(
+        corpus_path: Path = Path("text_corpus"),
+        workers: Optional[int] = typer.Option(None, min=0, help=WORKERS_HELP),
+        memory_budget_mb: int = typer.Option(DEFAULT_MEMORY_BUDGET // 2 ** 20, min=1),
+):
+    with load_inverted_index() as inverted_index:
         inverted_index: InvertedIndex
-        inverted_index.replace_index_terms(path)
+        if workers is None:
+            workers = 0 if isinstance(inverted_index, ShardedInvertedIndex) else 1
+        inverted_index.index_text_corpus(corpus_path, workers, memory_budget_mb * 2 ** 20)
 
 
 @app.command()
-def index_text_corpus(corpus_path: Path = Path("text_corpus")):
-    with InvertedIndex.load() as inverted_index:
+def remove_document(name: str):
+    with load_inverted_index() as inverted_index:
         inverted_index: InvertedIndex
-        inverted_index.index_text_corpus(corpus_path)
+        if not inverted_index.has_document(name):
+            raise typer.BadParameter(f"{name} is not indexed.", param_hint="NAME")
+        inverted_index.remove_document(name)
 
 
 @app.command()
-def search_boolean(normal_conjunctive: str):
-    with InvertedIndex.load() as inverted_index:
+def search_boolean(query: str, cache: bool = typer.Option(True, help="Use and fill the result cache.")):
+    with load_inverted_index(read_only=True) as inverted_index:
         inverted_index: InvertedIndex
-        result = inverted_index.search(normal_conjunctive)
+        try:
+            result = inverted_index.search(query, cache)
+        except QuerySyntaxError as e:
+            print(f"Invalid query: {e}")
+            raise typer.Exit(code=1)
         if len(result) == 0:
             print("Documents not found :(")
             return
@@ -33,25 +84,111 @@ def search_boolean(normal_conjunctive: str):
             print(item)
 
 @app.command()
-def replace_vector_index_terms(path: Path = "initial_index_terms.json"):
-    with VectorIndex.load() as vector_index:
+def replace_vector_index_terms(
+        path: Path = "initial_index_terms.json",
+        open_vocabulary: bool = typer.Option(False, help="Also index terms missing from PATH, which may not exist."),
+        analyzed: bool = typer.Option(False, help="Stem and drop stop words like custom_wikipedia_analyzer."),
+        shards: int = typer.Option(1, min=1, help="Partition the documents across this many shards."),
+):
+    if shards > 1:
+        ShardedVectorIndex.create(shards)
+    with load_vector_index() as vector_index:
+        vector_index: VectorIndex
+        vector_index.replace_index_terms(path if not open_vocabulary or path.exists() else None, open_vocabulary,
+                                         analyzed)
+
+@app.command()
+def index_text_corpus_vector(
+        corpus_path: Path = Path("text_corpus"),
+        workers: Optional[int] = typer.Option(None, min=0, help=WORKERS_HELP),
+        memory_budget_mb: int = typer.Option(DEFAULT_MEMORY_BUDGET // 2 ** 20, min=1),
+):
+    with load_vector_index() as vector_index:
         vector_index: VectorIndex
-        vector_index.replace_index_terms(path)
+        if workers is None:
+            workers = 0 if isinstance(vector_index, ShardedVectorIndex) else 1
+        vector_index.index_text_corpus(corpus_path, workers, memory_budget_mb * 2 ** 20)
 
 @app.command()
-def index_text_corpus_vector(corpus_path: Path = Path("text_corpus")):
-    with VectorIndex.load() as vector_index:
+def remove_document_vector(name: str):
+    with load_vector_index() as vector_index:
         vector_index: VectorIndex
-        vector_index.index_text_corpus(corpus_path)
+        if not vector_index.has_document(name):
+            raise typer.BadParameter(f"{name} is not indexed.", param_hint="NAME")
+        vector_index.remove_document(name)
 
 @app.command()
-def search_vector(query: str):
-    with VectorIndex.load() as vector_index:
+def search_vector(
+        query: str,
+        backend: VectorBackend = VectorBackend.auto,
+        top_k: Optional[int] = typer.Option(None, min=1, help="Only print the best K documents."),
+        lsh_tables: int = typer.Option(LSHParameters.tables, min=1, help="Hash tables of the lsh backend."),
+        lsh_bits: int = typer.Option(LSHParameters.bits, min=1, max=62, help="Hyperplanes per lsh table."),
+        lsh_probes: int = typer.Option(LSHParameters.probes, min=0, help="Extra buckets read per lsh table."),
+        cache: bool = typer.Option(True, help="Use and fill the result cache."),
+):
+    with load_vector_index(read_only=True) as vector_index:
         vector_index: VectorIndex
-        result = vector_index.search(query)
+        result = vector_index.search(query, backend, top_k, LSHParameters(lsh_tables, lsh_bits, lsh_probes), cache)
         print("Found documents:")
         for item, score in result:
             print(f"{item}; Score: {score}")
 
+@app.command()
+def search_vector_batch(
+        queries_path: Path,
+        backend: VectorBackend = VectorBackend.auto,
+        top_k: Optional[int] = typer.Option(None, min=1, help="Only print the best K documents per query."),
+        lsh_tables: int = typer.Option(LSHParameters.tables, min=1, help="Hash tables of the lsh backend."),
+        lsh_bits: int = typer.Option(LSHParameters.bits, min=1, max=62, help="Hyperplanes per lsh table."),
+        lsh_probes: int = typer.Option(LSHParameters.probes, min=0, help="Extra buckets read per lsh table."),
+        cache: bool = typer.Option(True, help="Use and fill the result cache."),
+):
+    with open(queries_path, "r") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    lsh = LSHParameters(lsh_tables, lsh_bits, lsh_probes)
+    with load_vector_index(read_only=True) as vector_index:
+        vector_index: VectorIndex
+        for query, result in zip(queries, vector_index.search_batch(queries, backend, top_k, lsh, cache)):
+            print(f"Query: {query}")
+            for item, score in result:
+                print(f"{item}; Score: {score}")
+
+@app.command("generate-corpus")
+def generate_corpus_command(
+        output_path: Path = Path("synthetic_corpus"),
+        documents: int = typer.Option(CorpusParameters.documents, min=1),
+        document_length: int = typer.Option(CorpusParameters.document_length, min=1, help="Mean words per document."),
+        vocabulary_size: int = typer.Option(CorpusParameters.vocabulary_size, min=1),
+        zipf_exponent: float = typer.Option(CorpusParameters.zipf_exponent, min=0),
+        seed: int = CorpusParameters.seed,
+):
+    parameters = CorpusParameters(documents, document_length, vocabulary_size, zipf_exponent, seed)
+    index_terms_path = generate_corpus(output_path, parameters)
+    print(f"Wrote {documents} documents to {output_path}, index terms to {index_terms_path}")
+
+@app.command()
+def benchmark(
+        output: Path = typer.Option(Path("benchmark_results.json"), help="Machine-readable results file."),
+        documents: int = typer.Option(CorpusParameters.documents, min=1),
+        document_length: int = typer.Option(CorpusParameters.document_length, min=1, help="Mean words per document."),
+        vocabulary_size: int = typer.Option(CorpusParameters.vocabulary_size, min=2),
+        zipf_exponent: float = typer.Option(CorpusParameters.zipf_exponent, min=0),
+        seed: int = CorpusParameters.seed,
+        workers: int = typer.Option(1, min=0, help="Indexing processes, 0 uses every core."),
+        memory_budget_mb: int = typer.Option(DEFAULT_MEMORY_BUDGET // 2 ** 20, min=1),
+        repeat: int = typer.Option(5, min=1, help="Runs of every query, the mean time is reported."),
+        top_k: int = typer.Option(10, min=1),
+        trace_memory: bool = typer.Option(True, help="Record peak memory of every phase (slows them down)."),
+):
+    parameters = CorpusParameters(documents, document_length, vocabulary_size, zipf_exponent, seed)
+    run_benchmark(parameters, output, workers, memory_budget_mb * 2 ** 20, repeat, top_k, trace_memory)
+    print(f"Results written to {output}")
+
+@app.command()
+def serve(host: str = "127.0.0.1", port: int = 8765):
+    run_server(host, port)
+
+
 if __name__ == "__main__":
     app()
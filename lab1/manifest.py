@@ -0,0 +1,98 @@
+from typing import Container, Optional
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+import hashlib
+import json
+
+from search_common import profiling
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class FileState:
+    mtime_ns: int
+    size: int
+    sha256: str
+
+
+@dataclass
+class CorpusChanges:
+    added: list[Path] = field(default_factory=list)
+    changed: list[Path] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    files: dict[str, FileState] = field(default_factory=dict)
+
+    @property
+    def to_index(self) -> list[Path]:
+        return self.added + self.changed
+
+    @property
+    def to_remove(self) -> list[str]:
+        return self.removed + [path.name for path in self.changed]
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class Manifest:
+    # corpus directory -> file name -> state at the time it was indexed
+    corpora: dict[str, dict[str, FileState]] = field(default_factory=dict)
+
+    def __post_init__(self):
+        for files in self.corpora.values():
+            for name, state in files.items():
+                if isinstance(state, dict):
+                    files[name] = FileState(**state)
+
+    @profiling.timed("manifest.scan")
+    def scan(self, dir_path: Path, names: Optional[Container[str]] = None) -> CorpusChanges:
+        # Files missing from names are ignored, as if they were not in the directory.
+        known = self.corpora.get(str(Path(dir_path).resolve()), {})
+        changes = CorpusChanges()
+        for path in sorted(Path(dir_path).glob('*')):
+            if not path.is_file() or (names is not None and path.name not in names):
+                continue
+            stat = path.stat()
+            previous = known.get(path.name)
+            # Only files whose mtime or size moved are hashed, so an unchanged corpus costs one stat per file.
+            if previous is not None and previous.mtime_ns == stat.st_mtime_ns and previous.size == stat.st_size:
+                changes.files[path.name] = previous
+                continue
+            state = FileState(stat.st_mtime_ns, stat.st_size, _file_hash(path))
+            changes.files[path.name] = state
+            profiling.count("manifest.hashed_files")
+            if previous is None:
+                changes.added.append(path)
+            elif previous.sha256 != state.sha256:
+                changes.changed.append(path)
+        changes.removed = [name for name in known if name not in changes.files]
+        return changes
+
+    def update(self, dir_path: Path, changes: CorpusChanges) -> None:
+        self.corpora[str(Path(dir_path).resolve())] = changes.files
+
+    def forget(self, name: str) -> None:
+        for files in self.corpora.values():
+            files.pop(name, None)
+
+    @profiling.timed("json.dump")
+    def save(self, path: Path) -> None:
+        with open(path, "w") as f:
+            json.dump(asdict(self), f)
+
+    @classmethod
+    @profiling.timed("json.load")
+    def read(cls, path: Path) -> 'Manifest':
+        try:
+            with open(path, "r") as f:
+                return cls(**json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return cls()
@@ -0,0 +1,149 @@
+from typing import Iterable, Iterator, Union
+from dataclasses import dataclass
+from bisect import bisect_left, insort
+import heapq
+
+
+# Offsets of the set bits of every byte value, so a bitmap is decoded with one lookup per non-empty byte.
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+
+@dataclass(frozen=True)
+class Bitmap:
+    # Document d is bit d % 8 of byte d // 8, the layout stored in segments.
+    data: bytes = b""
+
+    @classmethod
+    def from_doc_ids(cls, doc_ids: Iterable[int], documents_count: int) -> 'Bitmap':
+        data = bytearray((documents_count + 7) // 8)
+        for doc_id in doc_ids:
+            data[doc_id >> 3] |= 1 << (doc_id & 7)
+        return cls(bytes(data))
+
+    def _combine(self, other: 'Bitmap', operator) -> 'Bitmap':
+        # Whole bitmaps are combined as integers, one C level operation instead of a loop over the bytes.
+        length = max(len(self.data), len(other.data))
+        bits = operator(int.from_bytes(self.data, "little"), int.from_bytes(other.data, "little"))
+        return Bitmap(bits.to_bytes(length, "little"))
+
+    def __and__(self, other: 'Bitmap') -> 'Bitmap':
+        return self._combine(other, int.__and__)
+
+    def __or__(self, other: 'Bitmap') -> 'Bitmap':
+        return self._combine(other, int.__or__)
+
+    def __sub__(self, other: 'Bitmap') -> 'Bitmap':
+        return self._combine(other, lambda kept, removed: kept & ~removed)
+
+    def __contains__(self, doc_id: int) -> bool:
+        return 0 <= doc_id >> 3 < len(self.data) and self.data[doc_id >> 3] >> (doc_id & 7) & 1 == 1
+
+    def __len__(self) -> int:
+        return int.from_bytes(self.data, "little").bit_count()
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.doc_ids())
+
+    def doc_ids(self) -> list[int]:
+        # Word by word: a zero 64 bit word is skipped with one test, the bytes of the others go through the table.
+        data = self.data
+        full = len(data) & ~7
+        words = memoryview(data[:full]).cast("Q")
+        result = [position << 3 | bit for index, word in enumerate(words) if word
+                  for position in range(index << 3, (index << 3) + 8) if (value := data[position])
+                  for bit in _BYTE_BITS[value]]
+        result.extend(position << 3 | bit for position in range(full, len(data)) if (value := data[position])
+                      for bit in _BYTE_BITS[value])
+        return result
+
+
+Postings = Union[list[int], Bitmap]
+
+
+def add_doc_id(postings: list[int], doc_id: int) -> None:
+    # Documents are numbered in indexing order, so the common cases are a repeat of the last id or an append.
+    if postings and postings[-1] == doc_id:
+        return
+    if not postings or postings[-1] < doc_id:
+        postings.append(doc_id)
+        return
+    position = bisect_left(postings, doc_id)
+    if position == len(postings) or postings[position] != doc_id:
+        insort(postings, doc_id)
+
+
+def gallop(postings: list[int], target: int, low: int = 0) -> int:
+    # Exponential probe followed by a binary search: O(log distance) instead of O(log len).
+    step = 1
+    high = low
+    while high < len(postings) and postings[high] < target:
+        low = high + 1
+        high += step
+        step <<= 1
+    return bisect_left(postings, target, low, min(high, len(postings)))
+
+
+def intersect(shorter: list[int], longer: list[int]) -> list[int]:
+    if len(shorter) > len(longer):
+        shorter, longer = longer, shorter
+    result = []
+    position = 0
+    for doc_id in shorter:
+        position = gallop(longer, doc_id, position)
+        if position == len(longer):
+            break
+        if longer[position] == doc_id:
+            result.append(doc_id)
+    return result
+
+
+def intersect_many(postings: list[Postings]) -> list[int]:
+    if not postings:
+        return []
+    lists = sorted((item for item in postings if not isinstance(item, Bitmap)), key=len)
+    bitmaps = [item for item in postings if isinstance(item, Bitmap)]
+    if not lists:
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            result &= bitmap
+        return result.doc_ids()
+    # Start from the shortest list so the work is bounded by the most selective term.
+    result = lists[0]
+    for other in lists[1:]:
+        if not result:
+            return []
+        result = intersect(result, other)
+    for bitmap in bitmaps:
+        result = [doc_id for doc_id in result if doc_id in bitmap]
+    return list(result)
+
+
+def union_many(postings: list[Postings]) -> list[int]:
+    bitmaps = [item for item in postings if isinstance(item, Bitmap)]
+    lists = [item for item in postings if not isinstance(item, Bitmap)]
+    if bitmaps:
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            result |= bitmap
+        if lists:
+            result |= Bitmap.from_doc_ids((doc_id for item in lists for doc_id in item), len(result.data) * 8)
+        return result.doc_ids()
+    result = []
+    for doc_id in heapq.merge(*lists):
+        if not result or result[-1] != doc_id:
+            result.append(doc_id)
+    return result
+
+
+def difference(postings: Postings, excluded: Postings) -> list[int]:
+    if isinstance(excluded, Bitmap):
+        if isinstance(postings, Bitmap):
+            return (postings - excluded).doc_ids()
+        return [doc_id for doc_id in postings if doc_id not in excluded]
+    result = []
+    position = 0
+    for doc_id in postings:
+        position = gallop(excluded, doc_id, position)
+        if position == len(excluded) or excluded[position] != doc_id:
+            result.append(doc_id)
+    return result
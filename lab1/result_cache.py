@@ -0,0 +1,116 @@
+from typing import Any, Optional
+from collections import OrderedDict
+from pathlib import Path
+import json
+import logging
+import os
+import threading
+
+from search_common import profiling
+
+DEFAULT_CACHE_ENTRIES = 4096
+DEFAULT_CACHE_BYTES = 16 * 2 ** 20
+
+_open_caches: dict[Path, 'ResultCache'] = {}
+_open_caches_lock = threading.Lock()
+
+
+class ResultCache:
+    # LRU cache of search results bounded by entry count and by the size of the JSON encoded results. Entries
+    # belong to one generation of one index; the first lookup for another index or generation drops all of them.
+    def __init__(self, path: Path, max_entries: int = DEFAULT_CACHE_ENTRIES, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.identity: Optional[str] = None
+        self.generation: Optional[int] = None
+        # key -> (result, encoded size)
+        self._entries: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._bytes = 0
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def _validate(self, identity: str, generation: int) -> None:
+        if (identity, generation) != (self.identity, self.generation):
+            self._entries.clear()
+            self._bytes = 0
+            self.identity = identity
+            self.generation = generation
+            self._changed = True
+
+    def get(self, key: str, identity: str, generation: int) -> Optional[Any]:
+        with self._lock:
+            self._validate(identity, generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                profiling.count("cache.misses")
+                return None
+            profiling.count("cache.hits")
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, identity: str, generation: int, result: Any) -> None:
+        size = len(key) + len(json.dumps(result))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._validate(identity, generation)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+            self._changed = True
+
+    @profiling.timed("json.dump")
+    def save(self) -> None:
+        with self._lock:
+            if not self._changed:
+                return
+            data = {"identity": self.identity, "generation": self.generation,
+                    "entries": [[key, result] for key, (result, _) in self._entries.items()]}
+            self._changed = False
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    @profiling.timed("json.load")
+    def _read(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            logging.warning("Ignoring unreadable result cache %s", self.path)
+            return
+        # Caches written before indexes had an identity are dropped on the first lookup.
+        self.identity = data.get("identity")
+        self.generation = data["generation"]
+        for key, result in data["entries"]:
+            self._entries[key] = (result, len(key) + len(json.dumps(result)))
+            self._bytes += self._entries[key][1]
+
+    @classmethod
+    def open(cls, path: Path) -> 'ResultCache':
+        # One instance per file and process, so indexes reopened by the search server keep their cache.
+        path = Path(path).resolve()
+        with _open_caches_lock:
+            cache = _open_caches.get(path)
+            if cache is None:
+                cache = _open_caches[path] = cls(path)
+                cache._read()
+            return cache
+
+    @classmethod
+    def delete(cls, path: Path) -> None:
+        # Removes the file and forgets the open instance, which would otherwise write its entries back.
+        path = Path(path).resolve()
+        with _open_caches_lock:
+            _open_caches.pop(path, None)
+            if path.exists():
+                os.unlink(path)
@@ -0,0 +1,93 @@
+from typing import Container, Optional
+from dataclasses import dataclass, field
+from bisect import bisect_left
+import heapq
+
+
+@dataclass
+class WeightedPostings:
+    doc_ids: list[int] = field(default_factory=list)
+    # tf divided by the document norm; with the idf carried by the query weight, cosine similarity is a plain sum
+    # over the query terms
+    weights: list[float] = field(default_factory=list)
+    max_weight: float = 0
+
+    def add(self, doc_id: int, weight: float) -> None:
+        self.doc_ids.append(doc_id)
+        self.weights.append(weight)
+        self.max_weight = max(self.max_weight, weight)
+
+    def weight(self, doc_id: int) -> Optional[float]:
+        position = bisect_left(self.doc_ids, doc_id)
+        if position < len(self.doc_ids) and self.doc_ids[position] == doc_id:
+            return self.weights[position]
+        return None
+
+
+def _kth_score(accumulators: dict[int, float], k: int, excluded: Container[int]) -> Optional[float]:
+    scores = heapq.nlargest(k, (score for doc_id, score in accumulators.items() if doc_id not in excluded))
+    return scores[-1] if len(scores) == k else None
+
+
+def top_k_scores(query: list[tuple[WeightedPostings, float]], top_k: Optional[int] = None,
+                 min_score: float = 0, excluded: Container[int] = ()) -> list[tuple[int, float]]:
+    # Term-at-a-time scoring with MaxScore pruning. Terms are processed by decreasing upper bound; once the
+    # bounds of the remaining terms add up to less than the current k-th best score, documents that have not
+    # been seen yet cannot reach the top k, so the remaining terms only update existing accumulators. Excluded
+    # documents, e.g. removed ones still in their segment, are scored but never count towards the k best.
+    query = sorted(query, key=lambda item: item[0].max_weight * item[1], reverse=True)
+    remaining_bounds = [0.0] * (len(query) + 1)
+    for position in range(len(query) - 1, -1, -1):
+        postings, query_weight = query[position]
+        remaining_bounds[position] = remaining_bounds[position + 1] + postings.max_weight * query_weight
+
+    accumulators: dict[int, float] = {}
+    for position, (postings, query_weight) in enumerate(query):
+        threshold = min_score
+        if top_k is not None and len(accumulators) >= top_k:
+            threshold = max(threshold, _kth_score(accumulators, top_k, excluded) or min_score)
+        if remaining_bounds[position] >= threshold:
+            for doc_id, weight in zip(postings.doc_ids, postings.weights):
+                accumulators[doc_id] = accumulators.get(doc_id, 0) + weight * query_weight
+            continue
+        # Accumulators that cannot catch up with the threshold are dropped as well.
+        accumulators = {doc_id: score for doc_id, score in accumulators.items()
+                        if score + remaining_bounds[position] >= threshold}
+        if len(accumulators) < len(postings.doc_ids):
+            for doc_id in accumulators:
+                weight = postings.weight(doc_id)
+                if weight is not None:
+                    accumulators[doc_id] += weight * query_weight
+        else:
+            for doc_id, weight in zip(postings.doc_ids, postings.weights):
+                if doc_id in accumulators:
+                    accumulators[doc_id] += weight * query_weight
+
+    return _best(accumulators, top_k, min_score, excluded)
+
+
+def score_candidates(query: list[tuple[WeightedPostings, float]], candidates: set[int], top_k: Optional[int] = None,
+                     min_score: float = 0) -> list[tuple[int, float]]:
+    # Exact scores restricted to a candidate set, e.g. the documents an approximate index proposed.
+    accumulators = dict.fromkeys(candidates, 0.0)
+    for postings, query_weight in query:
+        if len(candidates) < len(postings.doc_ids):
+            for doc_id in candidates:
+                weight = postings.weight(doc_id)
+                if weight is not None:
+                    accumulators[doc_id] += weight * query_weight
+        else:
+            for doc_id, weight in zip(postings.doc_ids, postings.weights):
+                if doc_id in accumulators:
+                    accumulators[doc_id] += weight * query_weight
+    return _best(accumulators, top_k, min_score)
+
+
+def _best(accumulators: dict[int, float], top_k: Optional[int], min_score: float,
+          excluded: Container[int] = ()) -> list[tuple[int, float]]:
+    matches = [(doc_id, score) for doc_id, score in accumulators.items()
+               if score > min_score and doc_id not in excluded]
+    # Highest score first, ties in document order.
+    if top_k is None:
+        return sorted(matches, key=lambda item: (-item[1], item[0]))
+    return heapq.nsmallest(top_k, matches, key=lambda item: (-item[1], item[0]))
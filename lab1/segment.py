@@ -0,0 +1,295 @@
+from typing import Iterable, Iterator, Optional
+from pathlib import Path
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from postings import Bitmap, Postings
+
+
+SEGMENT_MAGIC = b"IIXS"
+SEGMENT_VERSION = 4
+
+# magic, version, flags, documents count, terms count, doc table offset, term dictionary offset,
+# term strings offset, postings offset, positions offset, generation
+_HEADER = struct.Struct("<4sHHIIQQQQQQ")
+# Version 3 segments have no generation, they are read as generation 0.
+_HEADER_V3 = struct.Struct("<4sHHIIQQQQQ")
+_MAGIC_AND_VERSION = struct.Struct("<4sH")
+_DOC_ENTRY = struct.Struct("<QI")
+# term string offset, term string length, postings offset, postings byte length, documents with term, encoding,
+# positions offset, positions byte length
+_TERM_ENTRY = struct.Struct("<QIQIIBQI")
+
+ENCODING_DELTA_VARINT = 0
+ENCODING_BITMAP = 1
+
+FLAG_NEW_INDEX_TERMS_ALLOWED = 1
+FLAG_POSITIONAL = 2
+# Terms missing from the dictionary are added while indexing instead of being skipped.
+FLAG_OPEN_VOCABULARY = 4
+# Documents and queries go through search_common.analysis.WIKIPEDIA_ANALYZER instead of the plain tokenizer.
+FLAG_ANALYZED = 8
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buffer, position: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def encode_postings(doc_ids: Iterable[int]) -> bytes:
+    out = bytearray()
+    previous = 0
+    for doc_id in doc_ids:
+        encode_varint(doc_id - previous, out)
+        previous = doc_id
+    return bytes(out)
+
+
+def decode_postings(buffer, start: int, end: int) -> list[int]:
+    result = []
+    previous = 0
+    position = start
+    while position < end:
+        delta, position = decode_varint(buffer, position)
+        previous += delta
+        result.append(previous)
+    return result
+
+
+def encode_positions(positions: Iterable[list[int]]) -> bytes:
+    # Per document, in posting order: number of positions followed by delta encoded positions.
+    out = bytearray()
+    for document_positions in positions:
+        encode_varint(len(document_positions), out)
+        previous = 0
+        for position in document_positions:
+            encode_varint(position - previous, out)
+            previous = position
+    return bytes(out)
+
+
+def decode_positions(buffer, start: int, end: int) -> list[list[int]]:
+    result = []
+    position = start
+    while position < end:
+        count, position = decode_varint(buffer, position)
+        document_positions = []
+        previous = 0
+        for _ in range(count):
+            delta, position = decode_varint(buffer, position)
+            previous += delta
+            document_positions.append(previous)
+        result.append(document_positions)
+    return result
+
+
+def encode_bitmap(doc_ids: Iterable[int], documents_count: int) -> bytes:
+    return Bitmap.from_doc_ids(doc_ids, documents_count).data
+
+
+class SegmentWriter:
+    # Terms must be added in sorted order; postings are streamed to a spill file so only the term
+    # dictionary is kept in memory while writing.
+    def __init__(self, path: Path, documents: list[str], flags: int = 0, dense_bitmaps: bool = True,
+                 generation: int = 0):
+        self._path = Path(path)
+        self._documents = documents
+        self._flags = flags
+        self._generation = generation
+        self._dense_bitmaps = dense_bitmaps
+        self._term_table = bytearray()
+        self._term_strings = bytearray()
+        self._terms_count = 0
+        self._last_term: Optional[bytes] = None
+        self._postings_size = 0
+        self._postings_file = tempfile.TemporaryFile(dir=self._path.parent)
+        self._positions_size = 0
+        self._positions_file = tempfile.TemporaryFile(dir=self._path.parent)
+
+    def __enter__(self) -> 'SegmentWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._postings_file.close()
+            self._positions_file.close()
+
+    def add(self, term: str, doc_ids: list[int], positions: Optional[list[list[int]]] = None) -> None:
+        encoded_term = term.encode("utf-8")
+        if self._last_term is not None and encoded_term <= self._last_term:
+            raise ValueError(f"Terms must be added in sorted order, got {term!r} after {self._last_term!r}")
+        self._last_term = encoded_term
+        encoding = ENCODING_DELTA_VARINT
+        encoded_postings = encode_postings(doc_ids)
+        # Very frequent terms are cheaper as a bitmap over all documents than as one varint per document.
+        if self._dense_bitmaps and (len(self._documents) + 7) // 8 < len(encoded_postings):
+            encoding = ENCODING_BITMAP
+            encoded_postings = encode_bitmap(doc_ids, len(self._documents))
+        encoded_positions = encode_positions(positions) if positions is not None else b""
+        self._term_table += _TERM_ENTRY.pack(len(self._term_strings), len(encoded_term), self._postings_size,
+                                             len(encoded_postings), len(doc_ids), encoding, self._positions_size,
+                                             len(encoded_positions))
+        self._term_strings += encoded_term
+        self._postings_file.write(encoded_postings)
+        self._postings_size += len(encoded_postings)
+        self._positions_file.write(encoded_positions)
+        self._positions_size += len(encoded_positions)
+        self._terms_count += 1
+
+    def close(self) -> None:
+        doc_table = bytearray()
+        doc_strings = bytearray()
+        for name in self._documents:
+            encoded = name.encode("utf-8")
+            doc_table += _DOC_ENTRY.pack(len(doc_strings), len(encoded))
+            doc_strings += encoded
+
+        doc_table_offset = _HEADER.size
+        term_table_offset = doc_table_offset + len(doc_table) + len(doc_strings)
+        term_strings_offset = term_table_offset + len(self._term_table)
+        postings_offset = term_strings_offset + len(self._term_strings)
+        positions_offset = postings_offset + self._postings_size
+        header = _HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self._flags, len(self._documents), self._terms_count,
+                              doc_table_offset, term_table_offset, term_strings_offset, postings_offset,
+                              positions_offset, self._generation)
+
+        # Written next to the target and renamed, so readers that still have the old segment mapped are not affected.
+        tmp_path = Path(f"{self._path}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(doc_table)
+            f.write(doc_strings)
+            f.write(self._term_table)
+            f.write(self._term_strings)
+            self._postings_file.seek(0)
+            shutil.copyfileobj(self._postings_file, f)
+            self._positions_file.seek(0)
+            shutil.copyfileobj(self._positions_file, f)
+        self._postings_file.close()
+        self._positions_file.close()
+        os.replace(tmp_path, self._path)
+
+
+def write_segment(path: Path, documents: list[str], postings: dict[str, list[int]], flags: int = 0,
+                  dense_bitmaps: bool = True, positions: Optional[dict[str, list[list[int]]]] = None,
+                  generation: int = 0) -> None:
+    with SegmentWriter(path, documents, flags, dense_bitmaps, generation) as writer:
+        for term in sorted(postings):
+            writer.add(term, postings[term], positions[term] if positions is not None else None)
+
+
+class SegmentReader:
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = _MAGIC_AND_VERSION.unpack_from(self._buffer)
+        if magic != SEGMENT_MAGIC or version not in (3, SEGMENT_VERSION):
+            self.close()
+            raise ValueError(f"{path} is not a supported index segment")
+        if version == SEGMENT_VERSION:
+            header = _HEADER.unpack_from(self._buffer)
+        else:
+            header = _HEADER_V3.unpack_from(self._buffer) + (0,)
+        # The generation is incremented on every save, so results derived from an older index can be recognised.
+        (_, _, self.flags, self.documents_count, self.terms_count, self._doc_table_offset, self._term_table_offset,
+         self._term_strings_offset, self._postings_offset, self._positions_offset, self.generation) = header
+        self._doc_strings_offset = self._doc_table_offset + self.documents_count * _DOC_ENTRY.size
+
+    def close(self) -> None:
+        self._buffer.close()
+
+    def document_name(self, doc_id: int) -> str:
+        offset, length = _DOC_ENTRY.unpack_from(self._buffer, self._doc_table_offset + doc_id * _DOC_ENTRY.size)
+        start = self._doc_strings_offset + offset
+        return self._buffer[start:start + length].decode("utf-8")
+
+    def document_names(self) -> list[str]:
+        return [self.document_name(doc_id) for doc_id in range(self.documents_count)]
+
+    def _term_entry(self, position: int) -> tuple[int, int, int, int, int, int, int, int]:
+        return _TERM_ENTRY.unpack_from(self._buffer, self._term_table_offset + position * _TERM_ENTRY.size)
+
+    def _term_at(self, position: int) -> bytes:
+        offset, length, *_ = self._term_entry(position)
+        start = self._term_strings_offset + offset
+        return self._buffer[start:start + length]
+
+    def _lower_bound(self, encoded: bytes) -> int:
+        # The term dictionary is sorted by utf-8 bytes, so a binary search only touches log(terms) entries.
+        low, high = 0, self.terms_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term_at(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_term(self, term: str) -> Optional[int]:
+        encoded = term.encode("utf-8")
+        position = self._lower_bound(encoded)
+        if position < self.terms_count and self._term_at(position) == encoded:
+            return position
+        return None
+
+    def __contains__(self, term: str) -> bool:
+        return self._find_term(term) is not None
+
+    def document_frequency(self, term: str) -> int:
+        position = self._find_term(term)
+        if position is None:
+            return 0
+        return self._term_entry(position)[4]
+
+    def postings(self, term: str) -> Optional[Postings]:
+        position = self._find_term(term)
+        if position is None:
+            return None
+        _, _, offset, length, _, encoding, _, _ = self._term_entry(position)
+        start = self._postings_offset + offset
+        if encoding == ENCODING_BITMAP:
+            return Bitmap(self._buffer[start:start + length])
+        return decode_postings(self._buffer, start, start + length)
+
+    def positions(self, term: str) -> Optional[list[list[int]]]:
+        # Aligned with postings(term): one list of positions per document.
+        position = self._find_term(term)
+        if position is None:
+            return None
+        *_, offset, length = self._term_entry(position)
+        start = self._positions_offset + offset
+        return decode_positions(self._buffer, start, start + length)
+
+    def terms_with_prefix(self, prefix: str) -> list[str]:
+        # Byte order keeps every term starting with the prefix in one run after its lower bound.
+        encoded = prefix.encode("utf-8")
+        result = []
+        for position in range(self._lower_bound(encoded), self.terms_count):
+            term = self._term_at(position)
+            if not term.startswith(encoded):
+                break
+            result.append(term.decode("utf-8"))
+        return result
+
+    def terms(self) -> Iterator[str]:
+        for position in range(self.terms_count):
+            yield self._term_at(position).decode("utf-8")
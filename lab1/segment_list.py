@@ -0,0 +1,81 @@
+from typing import Optional
+from dataclasses import dataclass, field
+from pathlib import Path
+import base64
+import json
+import os
+import uuid
+
+from search_common import profiling
+
+from postings import Bitmap
+
+# A segment is merged together with every newer one once the newer segments hold more than 1 / ratio of its live
+# documents, so segment sizes grow geometrically and an index keeps O(log documents) segments.
+SEGMENT_SIZE_RATIO = 4
+
+
+@dataclass
+class SegmentEntry:
+    name: str
+    documents_count: int
+    # Doc IDs of the segment that were removed; they are dropped when the segment is merged.
+    deleted: set[int] = field(default_factory=set)
+
+    @property
+    def live_documents(self) -> int:
+        return self.documents_count - len(self.deleted)
+
+
+@dataclass
+class SegmentList:
+    # The segments of an index, oldest first, and their deletions. Saving the list is what makes new segments
+    # and deletions visible, it is replaced in one rename.
+    generation: int = 0
+    segments: list[SegmentEntry] = field(default_factory=list)
+    # Numbers the segment files, so a new segment never reuses the name of one a reader may still have open.
+    next_segment: int = 0
+    # Random for every new index and kept by its saves, so an index recreated in the same place, whose generation
+    # starts over, is told apart from the one it replaced. Lists saved without one read as "".
+    identity: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+    def new_name(self, stem: str) -> str:
+        self.next_segment += 1
+        return f"{stem}.{self.next_segment - 1}.seg"
+
+    @profiling.timed("json.dump")
+    def save(self, path: Path) -> None:
+        data = {"identity": self.identity, "generation": self.generation, "next_segment": self.next_segment,
+                "segments": [
+            {"name": entry.name, "documents": entry.documents_count,
+             "deleted": base64.b64encode(Bitmap.from_doc_ids(entry.deleted, entry.documents_count).data).decode()}
+            for entry in self.segments]}
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    @profiling.timed("json.load")
+    def read(cls, path: Path) -> Optional['SegmentList']:
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return cls(data["generation"], [
+            SegmentEntry(entry["name"], entry["documents"], set(Bitmap(base64.b64decode(entry["deleted"])).doc_ids()))
+            for entry in data["segments"]], data["next_segment"], data.get("identity", ""))
+
+
+def merge_start(segments: list[SegmentEntry], ratio: int = SEGMENT_SIZE_RATIO) -> int:
+    # Position of the oldest segment that has to be merged with all newer ones, len(segments) when none has:
+    # segments too small next to the newer ones, and segments where most documents were removed.
+    newer = 0
+    start = len(segments)
+    for position in range(len(segments) - 1, -1, -1):
+        entry = segments[position]
+        if entry.live_documents < ratio * newer or len(entry.deleted) > entry.live_documents:
+            start = position
+        newer += entry.live_documents
+    return start
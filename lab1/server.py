@@ -0,0 +1,186 @@
+from typing import Any, Callable, Optional, Union
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+from boolean_query import QuerySyntaxError
+from inverted_index import InvertedIndex, INDEX_CACHE_PATH, INDEX_SEGMENT_PATH, INDEX_SEGMENTS_PATH, INDEX_TERMS_PATH
+from lsh import LSHParameters, lsh_available
+from result_cache import ResultCache
+from sharding import ShardedInvertedIndex, ShardedVectorIndex
+from sparse_tfidf import sparse_backend_available
+from vector import (VectorBackend, VectorIndex, VECTOR_CACHE_PATH, VECTOR_INDEX_TERMS_PATH, VECTOR_SEGMENT_PATH,
+                    VECTOR_SEGMENTS_PATH)
+
+
+class _BadRequest(Exception):
+    pass
+
+
+def _int_parameter(parameters: dict[str, list[str]], name: str, minimum: int,
+                   maximum: Optional[int] = None) -> Optional[int]:
+    if name not in parameters:
+        return None
+    try:
+        value = int(parameters[name][0])
+    except ValueError:
+        raise _BadRequest(f"{name} must be an integer")
+    if value < minimum or maximum is not None and value > maximum:
+        bounds = f"at least {minimum}" if maximum is None else f"between {minimum} and {maximum}"
+        raise _BadRequest(f"{name} must be {bounds}")
+    return value
+
+
+def _vector_options(parameters: dict[str, list[str]]) -> dict[str, Any]:
+    options: dict[str, Any] = {}
+    top_k = _int_parameter(parameters, "top_k", 1)
+    if top_k is not None:
+        options["top_k"] = top_k
+    if "backend" in parameters:
+        try:
+            options["backend"] = VectorBackend(parameters["backend"][0])
+        except ValueError:
+            raise _BadRequest(f"backend must be one of {', '.join(backend.value for backend in VectorBackend)}")
+        if (options["backend"] == VectorBackend.sparse and not sparse_backend_available()
+                or options["backend"] == VectorBackend.lsh and not lsh_available()):
+            raise _BadRequest(f"The {options['backend'].value} backend needs numpy and scipy installed")
+    # Options left out keep their defaults.
+    lsh = {field: value for field, value in [("tables", _int_parameter(parameters, "lsh_tables", 1)),
+                                             ("bits", _int_parameter(parameters, "lsh_bits", 1, 62)),
+                                             ("probes", _int_parameter(parameters, "lsh_probes", 0))]
+           if value is not None}
+    if lsh:
+        options["lsh"] = LSHParameters(**lsh)
+    return options
+
+
+def _file_version(*paths: str) -> tuple[Optional[int], ...]:
+    versions = []
+    for path in paths:
+        try:
+            versions.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            versions.append(None)
+    return tuple(versions)
+
+
+class _ReloadingIndex:
+    # Keeps one opened index and swaps it for a fresh one when its files change on disk, e.g. after an
+    # index-text-corpus run. The previous index is not closed explicitly: requests still using it keep their
+    # mapping and it is released once the last reference goes away.
+    def __init__(self, opener: Callable[[], Any], *paths: str):
+        self._opener = opener
+        self._paths = paths
+        self._lock = threading.Lock()
+        self._version: Optional[tuple[Optional[int], ...]] = None
+        self._index = None
+
+    def get(self, force_reload: bool = False):
+        version = _file_version(*self._paths)
+        if force_reload or version != self._version:
+            with self._lock:
+                if force_reload or version != self._version:
+                    self._index = self._opener()
+                    self._version = version
+                    logging.info("Loaded %s", self._paths[0])
+        return self._index
+
+    def close(self) -> None:
+        if self._index is not None:
+            self._index.close()
+
+
+def _open_inverted_index() -> Union[InvertedIndex, ShardedInvertedIndex]:
+    return ShardedInvertedIndex.open() or InvertedIndex.open()
+
+
+def _open_vector_index() -> Union[VectorIndex, ShardedVectorIndex]:
+    return ShardedVectorIndex.open() or VectorIndex.open()
+
+
+class SearchService:
+    # Sharded indexes are used as soon as their shard config exists. Their shards are reopened by the processes
+    # searching them whenever they are saved again, so only the config is watched for them.
+    def __init__(self):
+        self.inverted_index = _ReloadingIndex(_open_inverted_index, INDEX_SEGMENTS_PATH, INDEX_SEGMENT_PATH,
+                                              INDEX_TERMS_PATH, str(ShardedInvertedIndex.config_path()))
+        self.vector_index = _ReloadingIndex(_open_vector_index, VECTOR_SEGMENTS_PATH, VECTOR_SEGMENT_PATH,
+                                            VECTOR_INDEX_TERMS_PATH, str(ShardedVectorIndex.config_path()))
+
+    def search_boolean(self, query: str) -> dict:
+        return {"documents": self.inverted_index.get().search(query)}
+
+    def search_vector(self, query: str, top_k: Optional[int] = None, backend: VectorBackend = VectorBackend.auto,
+                      lsh: LSHParameters = LSHParameters()) -> dict:
+        result = self.vector_index.get().search(query, backend, top_k, lsh)
+        return {"documents": [{"name": name, "score": score} for name, score in result]}
+
+    def close(self) -> None:
+        # Stops the search processes of sharded indexes.
+        self.inverted_index.close()
+        self.vector_index.close()
+
+    def reload(self) -> dict:
+        self.inverted_index.get(force_reload=True)
+        self.vector_index.get(force_reload=True)
+        return {"reloaded": True}
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    service: SearchService
+
+    def _send(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parameters = parse_qs(url.query)
+        query = parameters.get("query", [None])[0]
+        routes = {"/search-boolean": self.service.search_boolean, "/search-vector": self.service.search_vector}
+        handler = routes.get(url.path)
+        if handler is None:
+            self._send(404, {"error": f"Unknown path {url.path}"})
+            return
+        if query is None:
+            self._send(400, {"error": "Missing query parameter"})
+            return
+        try:
+            options = _vector_options(parameters) if url.path == "/search-vector" else {}
+            self._send(200, handler(query, **options))
+        except _BadRequest as e:
+            self._send(400, {"error": str(e)})
+        except QuerySyntaxError as e:
+            self._send(400, {"error": f"Invalid query: {e}"})
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path != "/reload":
+            self._send(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._send(200, self.service.reload())
+
+    def log_message(self, format: str, *args) -> None:
+        logging.info("%s - %s", self.address_string(), format % args)
+
+
+def run_server(host: str, port: int) -> None:
+    service = SearchService()
+    handler = type("Handler", (SearchRequestHandler,), {"service": service})
+    with ThreadingHTTPServer((host, port), handler) as server:
+        print(f"Serving on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+            for path in (INDEX_CACHE_PATH, VECTOR_CACHE_PATH):
+                ResultCache.open(Path(path)).save()
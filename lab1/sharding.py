@@ -0,0 +1,280 @@
+from typing import Any, Generator, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict
+from itertools import repeat
+from pathlib import Path
+import heapq
+import json
+import logging
+import os
+import threading
+import zlib
+
+from search_common import profiling
+
+from inverted_index import InvertedIndex, INDEX_SEGMENTS_PATH
+from lsh import LSHParameters
+from spimi import DEFAULT_MEMORY_BUDGET
+from vector import VectorBackend, VectorIndex, CorpusStatistics, VECTOR_SEGMENTS_PATH
+
+SHARDS_PATH = "shards"
+SHARDS_CONFIG_PATH = "shards.json"
+
+INVERTED = "inverted"
+VECTOR = "vector"
+_INDEX_CLASSES = {INVERTED: InvertedIndex, VECTOR: VectorIndex}
+_SEGMENT_PATHS = {INVERTED: INDEX_SEGMENTS_PATH, VECTOR: VECTOR_SEGMENTS_PATH}
+
+# Shards opened by this process: directory -> (modification time of the segment or segment list, index). Pool
+# workers keep them between queries and only reopen a shard once it was saved again.
+_open_shards: dict[str, tuple[Optional[int], Union[InvertedIndex, VectorIndex]]] = {}
+# Corpus statistics read by this process: shard config path -> (its modification time, statistics).
+_corpus_statistics: dict[Path, tuple[int, Optional[CorpusStatistics]]] = {}
+
+
+def shard_of(name: str, shards: int) -> int:
+    # crc32 rather than hash(), which is salted per process; the shard of a document must never change.
+    return zlib.crc32(name.encode("utf-8")) % shards
+
+
+def _open_shard(kind: str, directory: str) -> Union[InvertedIndex, VectorIndex]:
+    try:
+        version = os.stat(Path(directory) / _SEGMENT_PATHS[kind]).st_mtime_ns
+    except FileNotFoundError:
+        version = None
+    cached = _open_shards.get(directory)
+    if cached is None or cached[0] != version:
+        if cached is not None:
+            cached[1].close()
+        cached = _open_shards[directory] = (version, _INDEX_CLASSES[kind].open(Path(directory)))
+    return cached[1]
+
+
+def _update_shard(kind: str, directory: str, method: str, *args) -> None:
+    with _INDEX_CLASSES[kind].load(directory=Path(directory)) as index:
+        getattr(index, method)(*args)
+
+
+def _index_shard(kind: str, directory: str, corpus: str, names: set[str], memory_budget: int) -> None:
+    with _INDEX_CLASSES[kind].load(directory=Path(directory)) as index:
+        index.index_text_corpus(Path(corpus), 1, memory_budget, names)
+
+
+def _shard_statistics(directory: str) -> CorpusStatistics:
+    return _open_shard(VECTOR, directory).corpus_statistics()
+
+
+def _has_document(kind: str, directory: str, name: str) -> bool:
+    index = _INDEX_CLASSES[kind].open(Path(directory))
+    try:
+        return index.has_document(name)
+    finally:
+        index.close()
+
+
+def _search_boolean_shard(directory: str, query: str, use_cache: bool) -> list[str]:
+    return _open_shard(INVERTED, directory).search(query, use_cache)
+
+
+def _read_corpus_statistics(path: Path) -> Optional[CorpusStatistics]:
+    version = os.stat(path).st_mtime_ns
+    cached = _corpus_statistics.get(path)
+    if cached is None or cached[0] != version:
+        with open(path, "r") as f:
+            statistics = json.load(f).get("statistics")
+        # Configs written before the statistics were kept there have none, or only a digest of them.
+        cached = _corpus_statistics[path] = (version, CorpusStatistics(**statistics)
+                                             if isinstance(statistics, dict) else None)
+    return cached[1]
+
+
+def _search_vector_shard(directory: str, queries: list[str], backend: VectorBackend, top_k: Optional[int],
+                         lsh: LSHParameters, use_cache: bool) -> list[list[tuple[str, float]]]:
+    # Queries are weighed with the statistics of the whole corpus kept in the shard config, so idf and the query
+    # norm are the ones of a single index and the scores of different shards compare.
+    statistics = _read_corpus_statistics(Path(directory).parent / SHARDS_CONFIG_PATH)
+    return _open_shard(VECTOR, directory).search_batch(queries, backend, top_k, lsh, use_cache, statistics)
+
+
+class _ShardedIndex:
+    # Documents are partitioned across shards by a hash of their name; each shard is a complete index of its
+    # documents in its own directory. Updates and queries fan out to the shards in a process pool.
+    kind: str
+
+    def __init__(self, shards: int, workers: int = 0):
+        self.shards = shards
+        self.workers = min(workers or os.cpu_count() or 1, shards)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # The search server queries one instance from several threads.
+        self._pool_lock = threading.Lock()
+
+    @classmethod
+    def _path(cls) -> Path:
+        return Path(SHARDS_PATH) / cls.kind
+
+    def _directories(self) -> list[str]:
+        return [str(self._path() / str(shard)) for shard in range(self.shards)]
+
+    def _map(self, function, *iterables) -> list[Any]:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            pool = self._pool
+        return list(pool.map(function, *iterables))
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _update_shards(self, method: str, *args) -> None:
+        self._map(_update_shard, repeat(self.kind), self._directories(), repeat(method), *map(repeat, args))
+
+    @profiling.timed("sharded.index_text_corpus")
+    def index_text_corpus(self, dir_path: Path, workers: int = 0, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        # Every shard indexes its files in its own process; workers caps how many run at once.
+        names: list[set[str]] = [set() for _ in range(self.shards)]
+        for path in Path(dir_path).glob('*'):
+            if path.is_file():
+                names[shard_of(path.name, self.shards)].add(path.name)
+        self.close()
+        self.workers = min(workers or os.cpu_count() or 1, self.shards)
+        self._map(_index_shard, repeat(self.kind), self._directories(), repeat(str(dir_path)), names,
+                  repeat(memory_budget // self.workers))
+
+    def has_document(self, name: str) -> bool:
+        return _has_document(self.kind, self._directories()[shard_of(name, self.shards)], name)
+
+    def remove_document(self, name: str) -> None:
+        # Checked before the shard is loaded for writing, so an unknown name leaves the shard untouched.
+        if not self.has_document(name):
+            raise KeyError(name)
+        _update_shard(self.kind, self._directories()[shard_of(name, self.shards)], "remove_document", name)
+
+    @classmethod
+    def config_path(cls) -> Path:
+        return cls._path() / SHARDS_CONFIG_PATH
+
+    @classmethod
+    def _read_config(cls) -> dict[str, Any]:
+        with open(cls.config_path(), "r") as f:
+            return json.load(f)
+
+    @classmethod
+    def _write_config(cls, config: dict[str, Any]) -> None:
+        # Replaced in one rename, shards may be reading it while a query runs.
+        path = cls.config_path()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(config, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, workers: int = 0) -> Optional['_ShardedIndex']:
+        try:
+            return cls(cls._read_config()["shards"], workers)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def create(cls, shards: int) -> None:
+        path = cls.config_path()
+        if path.exists():
+            logging.warning("%s already exists, the shard count cannot be changed.", path)
+            return
+        for shard in range(shards):
+            (cls._path() / str(shard)).mkdir(parents=True, exist_ok=True)
+        cls._write_config({"shards": shards})
+
+
+class ShardedInvertedIndex(_ShardedIndex):
+    kind = INVERTED
+
+    def replace_index_terms(self, path: Optional[Path], positional: bool = False, open_vocabulary: bool = False,
+                            analyzed: bool = False) -> None:
+        self._update_shards("replace_index_terms", path, positional, open_vocabulary, analyzed)
+
+    @profiling.timed("sharded.search")
+    def search(self, query: str, use_cache: bool = True) -> list[str]:
+        # A document only lives in one shard and every shard evaluates the whole query, intersections and
+        # negations included, against its documents; the union of the shard results is exact. Shards have no
+        # common doc order, so the union is sorted by name. A single index returns indexing order instead, which
+        # is the same for a corpus indexed in one run, but puts documents added later at the end.
+        results = self._map(_search_boolean_shard, self._directories(), repeat(query), repeat(use_cache))
+        return sorted(name for result in results for name in result)
+
+
+class ShardedVectorIndex(_ShardedIndex):
+    kind = VECTOR
+
+    def _update_statistics(self) -> None:
+        # The document frequencies and document count of the whole corpus are summed once per update and kept in
+        # the shard config. Shards only read them when weighing queries; their segments are never rewritten.
+        statistics = CorpusStatistics()
+        with profiling.phase("sharded.statistics"):
+            for shard_statistics in self._map(_shard_statistics, self._directories()):
+                statistics.add(shard_statistics)
+        config = self._read_config()
+        config["statistics"] = asdict(statistics)
+        self._write_config(config)
+
+    def replace_index_terms(self, path: Optional[Path], open_vocabulary: bool = False, analyzed: bool = False) -> None:
+        self._update_shards("replace_index_terms", path, open_vocabulary, analyzed)
+        self._update_statistics()
+
+    def index_text_corpus(self, dir_path: Path, workers: int = 0, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        super().index_text_corpus(dir_path, workers, memory_budget)
+        self._update_statistics()
+
+    def remove_document(self, name: str) -> None:
+        super().remove_document(name)
+        self._update_statistics()
+
+    @profiling.timed("sharded.search")
+    def search_batch(self, queries: list[str], backend: VectorBackend = VectorBackend.auto,
+                     top_k: Optional[int] = None, lsh: LSHParameters = LSHParameters(),
+                     use_cache: bool = True) -> list[list[tuple[str, float]]]:
+        if _read_corpus_statistics(self.config_path()) is None:
+            self._update_statistics()
+        shard_results = self._map(_search_vector_shard, self._directories(), repeat(queries), repeat(backend),
+                                  repeat(top_k), repeat(lsh), repeat(use_cache))
+        merged = []
+        for position in range(len(queries)):
+            # The best k of every shard contain the global best k.
+            scores = [match for result in shard_results for match in result[position]]
+            if top_k is None:
+                merged.append(sorted(scores, key=lambda item: (-item[1], item[0])))
+            else:
+                merged.append(heapq.nsmallest(top_k, scores, key=lambda item: (-item[1], item[0])))
+        return merged
+
+    def search(self, query: str, backend: VectorBackend = VectorBackend.auto, top_k: Optional[int] = None,
+               lsh: LSHParameters = LSHParameters(), use_cache: bool = True) -> list[tuple[str, float]]:
+        return self.search_batch([query], backend, top_k, lsh, use_cache)[0]
+
+
+@contextmanager
+def load_inverted_index(read_only: bool = False) -> Generator[Union[InvertedIndex, ShardedInvertedIndex], None, None]:
+    sharded = ShardedInvertedIndex.open()
+    if sharded is None:
+        with InvertedIndex.load(read_only) as index:
+            yield index
+        return
+    try:
+        yield sharded
+    finally:
+        sharded.close()
+
+
+@contextmanager
+def load_vector_index(read_only: bool = False) -> Generator[Union[VectorIndex, ShardedVectorIndex], None, None]:
+    sharded = ShardedVectorIndex.open()
+    if sharded is None:
+        with VectorIndex.load(read_only) as index:
+            yield index
+        return
+    try:
+        yield sharded
+    finally:
+        sharded.close()
@@ -0,0 +1,74 @@
+from typing import Any, Container, Iterable, Optional
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+
+def sparse_backend_available() -> bool:
+    return np is not None and sparse is not None
+
+
+class SparseTfIdf:
+    # Terms x documents matrix in CSR form; every statistic is computed with whole-matrix operations instead of
+    # per (document, term) Python objects.
+    def __init__(self, documents: list[str], terms: list[str], weights_by_term: "sparse.csr_matrix"):
+        self.documents = documents
+        self.terms = terms
+        self._term_ids = {term: term_id for term_id, term in enumerate(terms)}
+        # tf / norm of every document; the query carries idf, so scoring a query batch is a single product.
+        self._weights_by_term = weights_by_term
+
+    @classmethod
+    def from_segments(cls, segments: Iterable[tuple[list[str], list[str], Any, Any, list[int], Container[int]]]
+                      ) -> 'SparseTfIdf':
+        # (document names, terms, doc IDs, weights, term offsets, removed doc IDs) of every segment, with the
+        # term-major columns as stored in a vector segment. Segments are laid side by side in their order, so
+        # columns follow the doc order of the whole index, and removed documents get no entries.
+        documents: list[str] = []
+        term_ids: dict[str, int] = {}
+        rows, columns, values = [], [], []
+        for names, terms, doc_ids, weights, term_offsets, deleted in segments:
+            segment_rows = np.asarray([term_ids.setdefault(term, len(term_ids)) for term in terms], dtype=np.int64)
+            doc_ids = np.frombuffer(doc_ids, dtype=np.uint32)
+            live = ~np.isin(doc_ids, np.fromiter(deleted, dtype=np.uint32, count=len(deleted)))
+            rows.append(np.repeat(segment_rows, np.diff(np.asarray(term_offsets)))[live])
+            columns.append(doc_ids[live].astype(np.int64) + len(documents))
+            values.append(np.frombuffer(weights, dtype=np.float32)[live].astype(np.float64))
+            documents.extend(names)
+        matrix = sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                   shape=(len(term_ids), len(documents)))
+        return cls(documents, list(term_ids), matrix)
+
+    def search_batch(self, queries: list[dict[str, float]], top_k: Optional[int] = None,
+                     min_score: float = 0) -> list[list[tuple[str, float]]]:
+        rows, columns, values = [], [], []
+        for row, query in enumerate(queries):
+            for term, weight in query.items():
+                if term in self._term_ids:
+                    rows.append(row)
+                    columns.append(self._term_ids[term])
+                    values.append(weight)
+        queries_matrix = sparse.csr_matrix((np.asarray(values, dtype=np.float64), (rows, columns)),
+                                           shape=(len(queries), len(self.terms)))
+        scores = (queries_matrix @ self._weights_by_term).tocsr()
+
+        results = []
+        for row in range(len(queries)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            doc_ids = scores.indices[start:end]
+            values = scores.data[start:end]
+            keep = values > min_score
+            doc_ids, values = doc_ids[keep], values[keep]
+            if top_k is not None and top_k < len(values):
+                # Everything scoring at least the k-th best value, so ties at the cut are ordered like the rest.
+                kth = np.partition(values, len(values) - top_k)[len(values) - top_k]
+                keep = values >= kth
+                doc_ids, values = doc_ids[keep], values[keep]
+            # Highest score first, ties in document order.
+            order = np.lexsort((doc_ids, -values))[:top_k]
+            results.append([(self.documents[doc_ids[i]], float(values[i])) for i in order])
+        return results
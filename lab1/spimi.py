@@ -0,0 +1,166 @@
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import heapq
+import os
+
+from search_common.analysis import Analyzer
+
+from segment import encode_varint
+from tokenizer import tokenize_file
+
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+# Rough CPython cost of one (doc id, occurrences) entry, one stored position and one new term in a partial index.
+_POSTING_BYTES = 120
+_POSITION_BYTES = 36
+_TERM_BYTES = 200
+
+_RUN_FLAG_POSITIONAL = 1
+
+# (doc id, occurrences, positions); positions is empty unless the runs were built with positions.
+RunPosting = tuple[int, int, list[int]]
+RunPostings = list[RunPosting]
+
+_vocabulary: Optional[frozenset[str]] = None
+_positional = False
+_analyzer: Optional[Analyzer] = None
+
+
+def _init_worker(vocabulary: Optional[frozenset[str]], positional: bool, analyzer: Optional[Analyzer]) -> None:
+    global _vocabulary, _positional, _analyzer
+    _vocabulary = vocabulary
+    _positional = positional
+    _analyzer = analyzer
+
+
+def _read_varint(f: BinaryIO) -> Optional[int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        result |= (byte[0] & 0x7F) << shift
+        if byte[0] < 0x80:
+            return result
+        shift += 7
+
+
+def _flush_run(partial: dict[str, dict[int, Union[int, list[int]]]], path: Path) -> None:
+    # Run layout: a flags byte, then per term in sorted order: term length, term, number of postings and per
+    # posting the doc id delta and occurrences, followed by the delta encoded positions in positional runs.
+    out = bytearray([_RUN_FLAG_POSITIONAL if _positional else 0])
+    for term in sorted(partial):
+        encoded = term.encode("utf-8")
+        encode_varint(len(encoded), out)
+        out += encoded
+        postings = partial[term]
+        encode_varint(len(postings), out)
+        previous = 0
+        for doc_id in sorted(postings):
+            encode_varint(doc_id - previous, out)
+            previous = doc_id
+            if not _positional:
+                encode_varint(postings[doc_id], out)
+                continue
+            encode_varint(len(postings[doc_id]), out)
+            previous_position = 0
+            for position in postings[doc_id]:
+                encode_varint(position - previous_position, out)
+                previous_position = position
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def read_run(path: Path) -> Iterator[tuple[str, RunPostings]]:
+    with open(path, "rb") as f:
+        positional = f.read(1)[0] & _RUN_FLAG_POSITIONAL
+        while (term_length := _read_varint(f)) is not None:
+            term = f.read(term_length).decode("utf-8")
+            postings = []
+            doc_id = 0
+            for _ in range(_read_varint(f)):
+                doc_id += _read_varint(f)
+                occurrences = _read_varint(f)
+                positions = []
+                if positional:
+                    position = 0
+                    for _ in range(occurrences):
+                        position += _read_varint(f)
+                        positions.append(position)
+                postings.append((doc_id, occurrences, positions))
+            yield term, postings
+
+
+def _index_batch(batch: list[tuple[int, str]], run_dir: str, memory_budget: int) -> list[str]:
+    runs = []
+    partial: dict[str, dict[int, Union[int, list[int]]]] = {}
+    estimated_size = 0
+    for doc_id, path in batch:
+        for position, word in enumerate(tokenize_file(Path(path), analyzer=_analyzer)):
+            if _vocabulary is not None and word not in _vocabulary:
+                continue
+            postings = partial.get(word)
+            if postings is None:
+                postings = partial[word] = {}
+                estimated_size += _TERM_BYTES
+            if doc_id not in postings:
+                estimated_size += _POSTING_BYTES
+                postings[doc_id] = [] if _positional else 0
+            if _positional:
+                postings[doc_id].append(position)
+                estimated_size += _POSITION_BYTES
+            else:
+                postings[doc_id] += 1
+            # Checked per token, so one very long document cannot overshoot the budget; the postings of a
+            # document split this way are joined again by merge_runs.
+            if estimated_size >= memory_budget:
+                runs.append(os.path.join(run_dir, f"run-{os.getpid()}-{doc_id}-{len(runs)}"))
+                _flush_run(partial, Path(runs[-1]))
+                partial = {}
+                estimated_size = 0
+    if partial:
+        runs.append(os.path.join(run_dir, f"run-{os.getpid()}-{batch[-1][0]}-{len(runs)}"))
+        _flush_run(partial, Path(runs[-1]))
+    return runs
+
+
+def build_runs(documents: list[tuple[int, Path]], run_dir: Path, vocabulary: Optional[Iterable[str]] = None,
+               workers: int = 0, memory_budget: int = DEFAULT_MEMORY_BUDGET, positional: bool = False,
+               analyzer: Optional[Analyzer] = None) -> list[Path]:
+    workers = workers or os.cpu_count() or 1
+    # Several batches per worker keep the pool busy when document sizes are uneven.
+    batch_size = max(1, len(documents) // (workers * 4))
+    batches = [[(doc_id, str(path)) for doc_id, path in documents[start:start + batch_size]]
+               for start in range(0, len(documents), batch_size)]
+    frozen_vocabulary = frozenset(vocabulary) if vocabulary is not None else None
+    runs: list[Path] = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(frozen_vocabulary, positional, analyzer)) as pool:
+        for batch_runs in pool.map(_index_batch, batches, [str(run_dir)] * len(batches),
+                                   [memory_budget // workers] * len(batches)):
+            runs.extend(Path(run) for run in batch_runs)
+    return runs
+
+
+def merge_runs(sources: list[Iterator[tuple[str, RunPostings]]]) -> Iterator[tuple[str, RunPostings]]:
+    # k-way merge by term; postings of the same term from different sources are merged by doc id. A document
+    # found in several sources was split between runs, its occurrences are added up and positions concatenated
+    # in source order.
+    merged = heapq.merge(*(((term, position, postings) for term, postings in source)
+                           for position, source in enumerate(sources)))
+    current_term: Optional[str] = None
+    current: dict[int, RunPosting] = {}
+    for term, _, postings in merged:
+        if term != current_term:
+            if current_term is not None:
+                yield current_term, [current[doc_id] for doc_id in sorted(current)]
+            current_term = term
+            current = {}
+        for posting in postings:
+            previous = current.get(posting[0])
+            current[posting[0]] = posting if previous is None else (
+                posting[0], previous[1] + posting[1], previous[2] + posting[2])
+    if current_term is not None:
+        yield current_term, [current[doc_id] for doc_id in sorted(current)]
@@ -0,0 +1,56 @@
+from dataclasses import dataclass
+from itertools import accumulate
+from pathlib import Path
+import json
+import random
+
+WORDS_PER_LINE = 20
+
+
+@dataclass
+class CorpusParameters:
+    documents: int = 1000
+    # Mean words per document; lengths are spread uniformly between half and one and a half times the mean.
+    document_length: int = 300
+    vocabulary_size: int = 5000
+    # The word of rank r is drawn with probability proportional to 1 / r ** zipf_exponent.
+    zipf_exponent: float = 1.0
+    seed: int = 0
+
+
+def vocabulary(size: int) -> list[str]:
+    # Ordered by rank, the most frequent word first.
+    return [f"term{rank}" for rank in range(1, size + 1)]
+
+
+def term_probabilities(parameters: CorpusParameters) -> list[float]:
+    weights = [1 / rank ** parameters.zipf_exponent for rank in range(1, parameters.vocabulary_size + 1)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+
+def document_frequency_estimate(parameters: CorpusParameters, rank: int) -> float:
+    # Expected share of documents containing the word of the given rank (1 based), for a mean length document.
+    probability = term_probabilities(parameters)[rank - 1]
+    return 1 - (1 - probability) ** parameters.document_length
+
+
+def generate_corpus(dir_path: Path, parameters: CorpusParameters) -> Path:
+    # Writes the documents into dir_path and the whole vocabulary as an index terms file next to it.
+    dir_path = Path(dir_path)
+    dir_path.mkdir(parents=True, exist_ok=True)
+    generator = random.Random(parameters.seed)
+    words = vocabulary(parameters.vocabulary_size)
+    cumulative_weights = list(accumulate(1 / rank ** parameters.zipf_exponent
+                                         for rank in range(1, parameters.vocabulary_size + 1)))
+    width = len(str(parameters.documents))
+    for number in range(parameters.documents):
+        length = generator.randint(max(1, parameters.document_length // 2), parameters.document_length * 3 // 2)
+        document = generator.choices(words, cum_weights=cumulative_weights, k=length)
+        with open(dir_path / f"doc{number:0{width}}.txt", "w") as f:
+            for start in range(0, length, WORDS_PER_LINE):
+                f.write(" ".join(document[start:start + WORDS_PER_LINE]) + "\n")
+    index_terms_path = dir_path.parent / f"{dir_path.name}_index_terms.json"
+    with open(index_terms_path, "w") as f:
+        json.dump({"index_terms": {word: [] for word in words}}, f)
+    return index_terms_path
@@ -0,0 +1,58 @@
+from typing import Iterable, Iterator, Optional
+from collections.abc import Mapping
+from array import array
+from bisect import bisect_left
+import sys
+
+
+class TermDictionary(Mapping):
+    # Global term -> term ID mapping of an index. Every term string is stored once and interned, so the per
+    # document maps keyed by term ID and the tokens of later documents share it instead of holding copies. IDs
+    # are dense and assigned in insertion order; a compact array of the IDs in term order is built on demand for
+    # prefix lookups.
+    def __init__(self, terms: Iterable[str] = ()):
+        self._terms: list[str] = []
+        self._ids: dict[str, int] = {}
+        self._sorted: Optional[array] = None
+        for term in terms:
+            self.add(term)
+
+    def add(self, term: str) -> int:
+        term_id = self._ids.get(term)
+        if term_id is None:
+            term = sys.intern(term)
+            term_id = self._ids[term] = len(self._terms)
+            self._terms.append(term)
+            self._sorted = None
+        return term_id
+
+    def term(self, term_id: int) -> str:
+        return self._terms[term_id]
+
+    def __getitem__(self, term: str) -> int:
+        return self._ids[term]
+
+    def __contains__(self, term: object) -> bool:
+        return term in self._ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._terms)
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def _sorted_ids(self) -> array:
+        if self._sorted is None:
+            self._sorted = array("I", sorted(range(len(self._terms)), key=self._terms.__getitem__))
+        return self._sorted
+
+    def terms_with_prefix(self, prefix: str) -> list[str]:
+        # Range scan: the matching terms are contiguous in term order, starting at the first term >= prefix.
+        sorted_ids = self._sorted_ids()
+        result = []
+        for position in range(bisect_left(sorted_ids, prefix, key=self._terms.__getitem__), len(sorted_ids)):
+            term = self._terms[sorted_ids[position]]
+            if not term.startswith(prefix):
+                break
+            result.append(term)
+        return result
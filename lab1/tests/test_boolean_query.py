@@ -0,0 +1,80 @@
+import pytest
+
+from boolean_query import And, Not, Or, Phrase, Prefix, QueryPlan, QuerySyntaxError, Term, parse_query
+
+# doc ID -> words of the document
+DOCUMENTS = [
+    {"eagle", "brown"},
+    {"eagle"},
+    {"brown", "fox"},
+    {"eagle", "fox"},
+    {"falcon"},
+]
+
+
+def _search(query: str) -> list[int]:
+    postings = {}
+    for doc_id, words in enumerate(DOCUMENTS):
+        for word in words:
+            postings.setdefault(word, []).append(doc_id)
+    plan = QueryPlan(parse_query(query), lambda term: len(postings.get(term, [])), len(DOCUMENTS),
+                     lambda prefix: sorted(term for term in postings if term.startswith(prefix)))
+    return plan.execute(postings.get, lambda: list(range(len(DOCUMENTS))))
+
+
+def test_single_term():
+    assert parse_query('"eagle"') == Term("eagle")
+
+
+def test_or_binds_tighter_than_and():
+    assert parse_query('"a" | "b" & "c"') == And((Or((Term("a"), Term("b"))), Term("c")))
+
+
+def test_adjacent_terms_are_or_ed():
+    assert parse_query('"a" "b"') == parse_query('"a" | "b"')
+
+
+@pytest.mark.parametrize("query, expected", [
+    ('"eagle" NOT "brown"', '"eagle" & !"brown"'),
+    ('"eagle" !"brown"', '"eagle" & !"brown"'),
+    ('"eagle" "fox" NOT "brown"', '("eagle" | "fox") & !"brown"'),
+    ('"eagle" NOT "brown" & "fox"', '"eagle" & !"brown" & "fox"'),
+])
+def test_not_after_a_term_is_and_not(query, expected):
+    assert parse_query(query) == parse_query(expected)
+
+
+def test_not_after_or_negates_one_operand():
+    assert parse_query('"a" | NOT "b"') == Or((Not(Term("b")), Term("a")))
+
+
+def test_double_negation_cancels():
+    assert parse_query('!!"a"') == Term("a")
+
+
+def test_prefix_and_phrase():
+    assert parse_query('"eag*"') == Prefix("eag")
+    assert parse_query('"golden eagle"') == Phrase(("golden", "eagle"), "golden eagle")
+
+
+def test_operators_are_case_insensitive():
+    assert parse_query('"a" and "b" OR "c"') == parse_query('"a" & ("b" | "c")')
+
+
+@pytest.mark.parametrize("query", ['', '"a" &', '("a"', 'eagle', '"a', '"*"', '"a" )'])
+def test_syntax_errors(query):
+    with pytest.raises(QuerySyntaxError):
+        parse_query(query)
+
+
+@pytest.mark.parametrize("query, expected", [
+    ('"eagle"', [0, 1, 3]),
+    ('"eagle" NOT "brown"', [1, 3]),
+    ('"eagle" & "fox"', [3]),
+    ('"eagle" | "falcon" & !"fox"', [0, 1, 4]),
+    ('"f*"', [2, 3, 4]),
+    ('NOT "eagle"', [2, 4]),
+    ('"eagle" & "missing"', []),
+])
+def test_execution(query, expected):
+    assert _search(query) == expected
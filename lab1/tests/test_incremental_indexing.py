@@ -0,0 +1,262 @@
+import os
+
+import pytest
+
+from inverted_index import InvertedIndex
+from manifest import Manifest
+from segment_list import SEGMENT_SIZE_RATIO, SegmentEntry, SegmentList, merge_start
+from sparse_tfidf import sparse_backend_available
+from vector import VectorBackend, VectorIndex
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    # Index files are written to the current directory.
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "corpus"
+    path.mkdir()
+    (path / "a.txt").write_text("eagle brown")
+    (path / "b.txt").write_text("eagle fox")
+    (path / "c.txt").write_text("falcon")
+    return path
+
+
+def _touch(path, text):
+    # Keeps the size and bumps the mtime, so the change is only caught by the hash.
+    stat = path.stat()
+    path.write_text(text)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def _index(corpus) -> None:
+    with InvertedIndex.load() as index:
+        index.index_text_corpus(corpus)
+
+
+def test_scan_reports_changes(corpus):
+    manifest = Manifest()
+    changes = manifest.scan(corpus)
+    assert [path.name for path in changes.added] == ["a.txt", "b.txt", "c.txt"]
+    manifest.update(corpus, changes)
+
+    _touch(corpus / "a.txt", "eagle BROWN")
+    _touch(corpus / "b.txt", "eagle fox")
+    (corpus / "c.txt").unlink()
+    (corpus / "d.txt").write_text("owl")
+    changes = manifest.scan(corpus)
+    assert [path.name for path in changes.added] == ["d.txt"]
+    # b.txt was touched but its content is unchanged.
+    assert [path.name for path in changes.changed] == ["a.txt"]
+    assert changes.removed == ["c.txt"]
+    assert sorted(changes.files) == ["a.txt", "b.txt", "d.txt"]
+
+
+def test_scan_restricted_to_names(corpus):
+    changes = Manifest().scan(corpus, names={"b.txt"})
+    assert [path.name for path in changes.added] == ["b.txt"]
+
+
+def test_manifest_round_trip(corpus, tmp_path):
+    manifest = Manifest()
+    manifest.update(corpus, manifest.scan(corpus))
+    manifest.save(tmp_path / "manifest.json")
+    assert Manifest.read(tmp_path / "manifest.json") == manifest
+    assert Manifest.read(tmp_path / "missing.json") == Manifest()
+
+
+def test_reindexing_applies_only_the_changes(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"eagle"', use_cache=False) == ["a.txt", "b.txt"]
+
+    (corpus / "a.txt").write_text("falcon brown")
+    (corpus / "b.txt").unlink()
+    (corpus / "d.txt").write_text("eagle owl")
+    _index(corpus)
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"eagle"', use_cache=False) == ["d.txt"]
+        # Changed documents are indexed again under a new doc ID, results follow doc IDs.
+        assert sorted(index.search('"falcon"', use_cache=False)) == ["a.txt", "c.txt"]
+        assert index.search('"fox"', use_cache=False) == []
+        assert not index.has_document("b.txt")
+
+
+def test_unchanged_corpus_is_not_rewritten(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    segment = next(path for path in corpus.parent.iterdir() if path.suffix == ".seg")
+    modified = segment.stat().st_mtime_ns
+    _index(corpus)
+    assert segment.stat().st_mtime_ns == modified
+
+
+def test_removed_document_is_indexed_again(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+        index.remove_document("a.txt")
+    _index(corpus)
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"brown"', use_cache=False) == ["a.txt"]
+
+
+@pytest.mark.parametrize("index_class", [InvertedIndex, VectorIndex])
+def test_removing_an_unknown_document_fails_without_changes(corpus, index_class):
+    with index_class.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    segment = next(path for path in corpus.parent.iterdir() if path.suffix == ".seg")
+    modified = segment.stat().st_mtime_ns
+    with pytest.raises(KeyError):
+        with index_class.load() as index:
+            index.remove_document("missing.txt")
+    assert segment.stat().st_mtime_ns == modified
+
+
+def test_vector_reindexing_applies_only_the_changes(corpus):
+    with VectorIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    (corpus / "b.txt").unlink()
+    (corpus / "c.txt").write_text("eagle")
+    (corpus / "d.txt").write_text("owl")
+    with VectorIndex.load() as index:
+        index.index_text_corpus(corpus)
+    with VectorIndex.load(read_only=True) as index:
+        assert [name for name, _ in index.search('"eagle"', use_cache=False)] == ["c.txt", "a.txt"]
+
+
+def _segment_files(directory):
+    return {path.name: path.stat().st_mtime_ns for path in directory.iterdir() if path.suffix == ".seg"}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_added_documents_go_to_a_new_segment(corpus, workers):
+    # Enough documents that one more stays below the merge ratio.
+    for number in range(5):
+        (corpus / f"filler{number}.txt").write_text("falcon")
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, positional=True, open_vocabulary=True)
+        index.index_text_corpus(corpus, workers)
+    before = _segment_files(corpus.parent)
+    (corpus / "d.txt").write_text("brown eagle owl")
+    with InvertedIndex.load() as index:
+        index.index_text_corpus(corpus, workers)
+    after = _segment_files(corpus.parent)
+    assert len(after) == len(before) + 1
+    assert all(after[name] == modified for name, modified in before.items())
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"eagle"', use_cache=False) == ["a.txt", "b.txt", "d.txt"]
+        assert index.search('"brown eagle"', use_cache=False) == ["d.txt"]
+        assert index.search('"eagle" & !"fox"', use_cache=False) == ["a.txt", "d.txt"]
+
+
+def test_removal_only_marks_the_document(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    (corpus / "d.txt").write_text("eagle owl")
+    _index(corpus)
+    before = _segment_files(corpus.parent)
+    with InvertedIndex.load() as index:
+        index.remove_document("c.txt")
+    assert _segment_files(corpus.parent) == before
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"falcon"', use_cache=False) == []
+        assert not index.has_document("c.txt")
+
+
+def test_closed_vocabulary_survives_merges(corpus):
+    (corpus / "vocabulary.json").write_text('{"index_terms": {"eagle": [], "owl": []}}')
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(corpus / "vocabulary.json")
+    (corpus / "vocabulary.json").unlink()
+    _index(corpus)
+    for number in range(10):
+        (corpus / f"owl{number}.txt").write_text("owl falcon")
+        _index(corpus)
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"eagle"', use_cache=False) == ["a.txt", "b.txt"]
+        assert len(index.search('"owl"', use_cache=False)) == 10
+        assert index.search('"falcon"', use_cache=False) == []
+
+
+def test_segments_are_merged_by_size_ratio(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    for number in range(40):
+        (corpus / f"d{number}.txt").write_text(f"eagle word{number}")
+        _index(corpus)
+    segments = SegmentList.read(corpus.parent / "index_segments.json").segments
+    sizes = [entry.live_documents for entry in segments]
+    assert sum(sizes) == 43
+    assert all(sizes[position] >= SEGMENT_SIZE_RATIO * sum(sizes[position + 1:]) for position in range(len(sizes)))
+    assert set(_segment_files(corpus.parent)) == {entry.name for entry in segments}
+    with InvertedIndex.load(read_only=True) as index:
+        assert len(index.search('"eagle"', use_cache=False)) == 42
+
+
+def test_merge_start():
+    assert merge_start([SegmentEntry("a", 100), SegmentEntry("b", 10)]) == 2
+    assert merge_start([SegmentEntry("a", 100), SegmentEntry("b", 10), SegmentEntry("c", 10)]) == 1
+    assert merge_start([SegmentEntry("a", 30), SegmentEntry("b", 10)]) == 0
+    # Mostly removed documents get the segment rewritten even when it is large enough.
+    assert merge_start([SegmentEntry("a", 100, set(range(60))), SegmentEntry("b", 5)]) == 0
+
+
+def _vector_scores(backend=VectorBackend.python, query='"eagle" "owl"'):
+    with VectorIndex.load(read_only=True) as index:
+        return dict(index.search(query, backend, use_cache=False))
+
+
+def test_vector_updates_go_to_new_segments(corpus):
+    for number in range(5):
+        (corpus / f"filler{number}.txt").write_text("falcon")
+    with VectorIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    before = _segment_files(corpus.parent)
+    (corpus / "d.txt").write_text("eagle owl")
+    with VectorIndex.load() as index:
+        index.index_text_corpus(corpus)
+    after = _segment_files(corpus.parent)
+    assert len(after) == len(before) + 1
+    assert all(after[name] == modified for name, modified in before.items())
+    assert list(_vector_scores()) == ["d.txt", "a.txt", "b.txt"]
+
+    with VectorIndex.load() as index:
+        index.remove_document("a.txt")
+    assert _segment_files(corpus.parent) == after
+    backends = [VectorBackend.python]
+    if sparse_backend_available():
+        backends += [VectorBackend.lsh, VectorBackend.sparse]
+    for backend in backends:
+        assert list(_vector_scores(backend)) == ["d.txt", "b.txt"]
+
+
+def test_vector_merge_recomputes_the_statistics(corpus):
+    (corpus / "d.txt").write_text("owl falcon")
+    (corpus / "e.txt").write_text("eagle owl owl")
+    with VectorIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    # More removed than live documents, so the segment is merged and the removed ones stop counting.
+    with VectorIndex.load() as index:
+        for name in ["b.txt", "c.txt", "e.txt"]:
+            index.remove_document(name)
+    assert len(SegmentList.read(corpus.parent / "vector_index_segments.json").segments) == 1
+    merged = _vector_scores()
+    assert list(merged) == ["a.txt", "d.txt"]
+    for path in corpus.parent.iterdir():
+        if path.is_file():
+            path.unlink()
+    for name in ["b.txt", "c.txt", "e.txt"]:
+        (corpus / name).unlink()
+    with VectorIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    assert merged == pytest.approx(_vector_scores())
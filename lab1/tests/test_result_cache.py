@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import pytest
+
+from inverted_index import INDEX_CACHE_PATH, InvertedIndex
+from result_cache import ResultCache
+from vector import VectorIndex
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    # Index files are written to the current directory.
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "corpus"
+    path.mkdir()
+    (path / "a.txt").write_text("eagle brown")
+    (path / "b.txt").write_text("eagle fox")
+    return path
+
+
+def _remove_index_files(stem: str) -> None:
+    # Everything but the cache, like an index deleted by hand before a new one is built.
+    for path in Path(".").glob(f"{stem}*"):
+        if "cache" not in path.name:
+            path.unlink()
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(tmp_path / "cache.json", max_entries=2)
+    cache.put("a", "index", 1, ["a.txt"])
+    cache.put("b", "index", 1, ["b.txt"])
+    assert cache.get("a", "index", 1) == ["a.txt"]
+    cache.put("c", "index", 1, ["c.txt"])
+    assert cache.get("b", "index", 1) is None
+    assert cache.get("a", "index", 1) == ["a.txt"]
+    # Another index with the same generation starts from an empty cache.
+    assert cache.get("a", "other", 1) is None
+
+
+def test_recreated_inverted_index_does_not_serve_stale_results(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"eagle"') == ["a.txt", "b.txt"]
+
+    _remove_index_files("index")
+    (corpus / "a.txt").write_text("owl")
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    with InvertedIndex.load(read_only=True) as index:
+        assert index.search('"eagle"') == ["b.txt"]
+
+
+def test_recreated_vector_index_does_not_serve_stale_results(corpus):
+    (corpus / "b.txt").write_text("owl fox")
+    with VectorIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    with VectorIndex.load(read_only=True) as index:
+        assert index.search('"fox"') == [("b.txt", pytest.approx(2 ** -0.5, rel=1e-6))]
+
+    # The query weighs the same in the new index, only the document changed.
+    _remove_index_files("vector_index")
+    (corpus / "b.txt").write_text("fox")
+    with VectorIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    with VectorIndex.load(read_only=True) as index:
+        assert index.search('"fox"') == [("b.txt", pytest.approx(1, rel=1e-6))]
+
+
+def test_reset_drops_the_open_cache(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    # A server keeps its cache open and only saves it from time to time.
+    index = InvertedIndex.open()
+    index.search('"eagle"')
+    index.close()
+    ResultCache.open(Path(INDEX_CACHE_PATH)).save()
+    index = InvertedIndex.open()
+    index.search('"fox"')
+    index.close()
+
+    InvertedIndex.reset_index_terms()
+    assert not Path(INDEX_CACHE_PATH).exists()
+    # Saving the caches of the process does not bring it back.
+    ResultCache.open(Path(INDEX_CACHE_PATH)).save()
+    assert not Path(INDEX_CACHE_PATH).exists()
@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+from postings import Bitmap, difference, intersect_many, union_many
+from segment import SegmentReader, decode_postings, encode_bitmap, encode_postings, write_segment
+
+DOCUMENTS_COUNT = 1000
+
+
+def _random_postings(generator: random.Random, size: int) -> list[int]:
+    return sorted(generator.sample(range(DOCUMENTS_COUNT), size))
+
+
+@pytest.fixture
+def segment(tmp_path):
+    # Sizes on both sides of the bitmap threshold, so the segment holds both encodings.
+    generator = random.Random(0)
+    postings = {f"term{number}": _random_postings(generator, size)
+                for number, size in enumerate([1, 3, 50, 120, 400, 900, 1000] * 3)}
+    path = tmp_path / "index.seg"
+    write_segment(path, [f"doc{doc_id}" for doc_id in range(DOCUMENTS_COUNT)], postings)
+    reader = SegmentReader(path)
+    yield reader, postings
+    reader.close()
+
+
+def test_varint_round_trip():
+    doc_ids = [0, 1, 5, 127, 128, 300, 16383, 16384, 2 ** 31]
+    encoded = encode_postings(doc_ids)
+    assert decode_postings(encoded, 0, len(encoded)) == doc_ids
+
+
+def test_bitmap_layout():
+    # Document d is bit d % 8 of byte d // 8, the on-disk format of existing segments.
+    assert encode_bitmap([0, 9, 17], 20) == bytes([0b00000001, 0b00000010, 0b00000010])
+
+
+@pytest.mark.parametrize("documents_count", [1, 7, 8, 63, 64, 65, 1000])
+def test_bitmap_round_trip(documents_count):
+    generator = random.Random(documents_count)
+    doc_ids = sorted(generator.sample(range(documents_count), (documents_count + 1) // 2))
+    data = encode_bitmap(doc_ids, documents_count)
+    assert len(data) == (documents_count + 7) // 8
+    bitmap = Bitmap(data)
+    assert list(bitmap) == doc_ids
+    assert len(bitmap) == len(doc_ids)
+    assert [doc_id for doc_id in range(-1, documents_count + 16) if doc_id in bitmap] == doc_ids
+
+
+def test_segment_round_trip(segment):
+    reader, postings = segment
+    assert reader.document_names() == [f"doc{doc_id}" for doc_id in range(DOCUMENTS_COUNT)]
+    assert list(reader.terms()) == sorted(postings)
+    encodings = set()
+    for term, doc_ids in postings.items():
+        stored = reader.postings(term)
+        encodings.add(type(stored))
+        assert list(stored) == doc_ids
+        assert reader.document_frequency(term) == len(doc_ids)
+    assert encodings == {list, Bitmap}
+    assert reader.postings("missing") is None
+
+
+def test_segment_without_bitmaps(tmp_path):
+    path = tmp_path / "index.seg"
+    doc_ids = list(range(0, DOCUMENTS_COUNT, 2))
+    write_segment(path, [f"doc{doc_id}" for doc_id in range(DOCUMENTS_COUNT)], {"dense": doc_ids},
+                  dense_bitmaps=False)
+    reader = SegmentReader(path)
+    assert reader.postings("dense") == doc_ids
+    reader.close()
+
+
+def test_postings_operations_match_sets(segment):
+    reader, postings = segment
+    generator = random.Random(1)
+    for _ in range(200):
+        terms = generator.sample(sorted(postings), 3)
+        stored = [reader.postings(term) for term in terms]
+        expected = [set(postings[term]) for term in terms]
+        assert intersect_many(stored) == sorted(expected[0] & expected[1] & expected[2])
+        assert union_many(stored) == sorted(expected[0] | expected[1] | expected[2])
+        assert difference(stored[0], stored[1]) == sorted(expected[0] - expected[1])
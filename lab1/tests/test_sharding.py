@@ -0,0 +1,110 @@
+import json
+from math import log, sqrt
+from pathlib import Path
+from urllib.parse import parse_qs
+
+import pytest
+
+from inverted_index import InvertedIndex
+from lsh import LSHParameters
+from server import SearchService, _BadRequest, _vector_options
+from sharding import SHARDS_CONFIG_PATH, ShardedInvertedIndex, ShardedVectorIndex, shard_of
+from vector import VectorBackend
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    # Shard directories are created under the current directory.
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "corpus"
+    path.mkdir()
+    (path / "eagle.txt").write_text("eagle brown")
+    (path / "owl.txt").write_text("owl eagle")
+    (path / "fox.txt").write_text("fox brown")
+    (path / "wolf.txt").write_text("wolf")
+    return path
+
+
+def _segment_files(directory: Path) -> dict[str, int]:
+    return {path.name: path.stat().st_mtime_ns for path in directory.iterdir() if path.suffix == ".seg"}
+
+
+def test_vector_updates_only_touch_their_shard(corpus):
+    assert [shard_of(name, 2) for name in ["eagle.txt", "owl.txt", "hawk.txt", "fox.txt", "wolf.txt"]] == \
+        [1, 1, 1, 0, 0]
+    ShardedVectorIndex.create(2)
+    index = ShardedVectorIndex.open(workers=1)
+    try:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+        # fox.txt was weighed in its shard, where fox and brown are in one of two documents.
+        fox_weight = 1 / (log(2) * sqrt(2))
+        assert index.search('"fox"') == [("fox.txt", pytest.approx(log(4) * fox_weight))]
+        before = _segment_files(Path("shards/vector/0"))
+
+        (corpus / "hawk.txt").write_text("hawk eagle")
+        index.index_text_corpus(corpus)
+        config = json.loads(Path("shards/vector", SHARDS_CONFIG_PATH).read_text())
+        assert config["statistics"]["documents"] == 5
+        assert config["statistics"]["document_frequency"]["eagle"] == 3
+        assert _segment_files(Path("shards/vector/0")) == before
+        # idf comes from the whole corpus when the query is weighed, the other shard is not rewritten.
+        assert index.search('"fox"') == [("fox.txt", pytest.approx(log(5) * fox_weight))]
+    finally:
+        index.close()
+
+
+def test_sharded_boolean_results_are_ordered_by_name(corpus):
+    with InvertedIndex.load() as index:
+        index.replace_index_terms(None, open_vocabulary=True)
+        index.index_text_corpus(corpus)
+    ShardedInvertedIndex.create(2)
+    sharded = ShardedInvertedIndex.open(workers=1)
+    try:
+        sharded.replace_index_terms(None, open_vocabulary=True)
+        sharded.index_text_corpus(corpus)
+        # A corpus indexed in one run is in name order in a single index as well.
+        with InvertedIndex.load(read_only=True) as index:
+            assert sharded.search('"eagle" | "fox"', use_cache=False) == \
+                index.search('"eagle" | "fox"', use_cache=False) == ["eagle.txt", "fox.txt", "owl.txt"]
+
+        # Documents added later come last in a single index, the shards have no common order to keep them there.
+        (corpus / "bee.txt").write_text("fox")
+        with InvertedIndex.load() as index:
+            index.index_text_corpus(corpus)
+            assert index.search('"fox"', use_cache=False) == ["fox.txt", "bee.txt"]
+        sharded.index_text_corpus(corpus)
+        assert sharded.search('"fox"', use_cache=False) == ["bee.txt", "fox.txt"]
+    finally:
+        sharded.close()
+
+
+def test_service_searches_the_shards(corpus):
+    service = SearchService()
+    try:
+        assert service.search_boolean('"brown"') == {"documents": []}
+        # The shards are created while the service runs; it switches over once their config exists.
+        for cls in (ShardedInvertedIndex, ShardedVectorIndex):
+            cls.create(2)
+            sharded = cls.open(workers=1)
+            sharded.replace_index_terms(None, open_vocabulary=True)
+            sharded.index_text_corpus(corpus)
+            sharded.close()
+        sharded = ShardedVectorIndex.open(workers=1)
+        expected = sharded.search('"eagle" "brown"', top_k=2, use_cache=False)
+        sharded.close()
+        assert service.search_boolean('"brown"') == {"documents": ["eagle.txt", "fox.txt"]}
+        options = _vector_options(parse_qs("top_k=2&backend=python&lsh_tables=4&lsh_probes=0"))
+        assert options == {"top_k": 2, "backend": VectorBackend.python, "lsh": LSHParameters(tables=4, probes=0)}
+        result = service.search_vector('"eagle" "brown"', **options)
+        assert [(match["name"], match["score"]) for match in result["documents"]] == expected
+    finally:
+        service.close()
+
+
+@pytest.mark.parametrize("query, error", [("top_k=0", "top_k must be at least 1"),
+                                          ("lsh_bits=64", "lsh_bits must be between 1 and 62"),
+                                          ("backend=faiss", "backend must be one of auto, python, sparse, lsh")])
+def test_service_rejects_bad_vector_options(query, error):
+    with pytest.raises(_BadRequest, match=error):
+        _vector_options(parse_qs(query))
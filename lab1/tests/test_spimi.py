@@ -0,0 +1,22 @@
+from spimi import build_runs, merge_runs, read_run
+
+
+def _merged(tmp_path, memory_budget, positional):
+    (tmp_path / "a.txt").write_text("eagle fox eagle wolf fox eagle")
+    (tmp_path / "b.txt").write_text("fox prey")
+    run_dir = tmp_path / f"runs-{memory_budget}-{positional}"
+    run_dir.mkdir()
+    runs = build_runs([(0, tmp_path / "a.txt"), (1, tmp_path / "b.txt")], run_dir, workers=1,
+                      memory_budget=memory_budget, positional=positional)
+    return len(runs), list(merge_runs([read_run(run) for run in runs]))
+
+
+def test_budget_splits_documents_between_runs(tmp_path):
+    for positional in (False, True):
+        runs, merged = _merged(tmp_path, 10 ** 9, positional)
+        assert runs == 2
+        # A budget smaller than one term forces a flush after every token, in the middle of a.txt.
+        split_runs, split = _merged(tmp_path, 1, positional)
+        assert split_runs == 8
+        assert split == merged
+    assert dict(merged)["eagle"] == [(0, 3, [0, 2, 5])]
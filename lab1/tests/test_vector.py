@@ -0,0 +1,134 @@
+from collections import Counter
+from math import log, sqrt
+import random
+
+import pytest
+
+from lsh import SIGNATURE_BITS, LSHParameters, lsh_available
+from sparse_tfidf import sparse_backend_available
+from synthetic_corpus import CorpusParameters, generate_corpus, vocabulary
+import vector
+from vector import VectorBackend, VectorIndex
+from vector_segment import VectorSegmentReader
+
+PARAMETERS = CorpusParameters(documents=80, document_length=30, vocabulary_size=60, seed=3)
+WORDS = vocabulary(PARAMETERS.vocabulary_size)
+QUERIES = [[WORDS[0]], [WORDS[1], WORDS[7]], [WORDS[3], WORDS[20], WORDS[-1]], WORDS[::6], ["unknown", WORDS[5]]]
+
+needs_lsh = pytest.mark.skipif(not lsh_available(), reason="numpy and scipy are not installed")
+
+BACKENDS = [VectorBackend.python, VectorBackend.auto, pytest.param(VectorBackend.sparse, marks=pytest.mark.skipif(
+    not sparse_backend_available(), reason="numpy and scipy are not installed"))]
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    path = tmp_path_factory.mktemp("vector") / "corpus"
+    index_terms = generate_corpus(path, PARAMETERS)
+    documents = {file.name: Counter(file.read_text().split()) for file in sorted(path.iterdir())}
+    return path, index_terms, documents
+
+
+def _reference_cosine(documents: dict[str, Counter], query: list[str]) -> dict[str, float]:
+    # tf is relative to the document length, idf is log(N / df); every known query term weighs the same.
+    document_frequency = Counter(term for counts in documents.values() for term in counts)
+    idf = {term: log(len(documents) / frequency) for term, frequency in document_frequency.items()}
+    known = set(query) & set(document_frequency)
+    scores = {}
+    for name, counts in documents.items():
+        length = sum(counts.values())
+        weights = {term: count / length * idf[term] for term, count in counts.items()}
+        norm = sqrt(sum(weight ** 2 for weight in weights.values()))
+        score = sum(weights.get(term, 0) for term in known) / norm / sqrt(len(known)) if norm and known else 0
+        if score > 0:
+            scores[name] = score
+    return scores
+
+
+def _query(words: list[str]) -> str:
+    return " ".join(f'"{word}"' for word in words)
+
+
+@pytest.fixture(params=["in_memory", "segment"])
+def index(request, corpus, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path, index_terms, _ = corpus
+    index = VectorIndex()
+    index.replace_index_terms(index_terms)
+    index.index_text_corpus(path)
+    if request.param == "segment":
+        index.save()
+        index.close()
+        index = VectorIndex.open()
+    yield index
+    index.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("query", QUERIES)
+def test_backends_match_reference_cosine(index, corpus, backend, query):
+    expected = _reference_cosine(corpus[2], query)
+    result = index.search(_query(query), backend, use_cache=False)
+    assert dict(result) == pytest.approx(expected, rel=1e-5)
+    scores = [score for _, score in result]
+    assert scores == sorted(scores, reverse=True)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_top_k_is_the_best_k(index, corpus, backend):
+    query = QUERIES[3]
+    best = sorted(_reference_cosine(corpus[2], query).values(), reverse=True)[:5]
+    result = index.search(_query(query), backend, top_k=5, use_cache=False)
+    assert [score for _, score in result] == pytest.approx(best, rel=1e-5)
+
+
+def test_batch_matches_single_queries(index):
+    queries = [_query(query) for query in QUERIES]
+    assert index.search_batch(queries, use_cache=False) == [index.search(query, use_cache=False)
+                                                            for query in queries]
+
+
+@needs_lsh
+def test_lsh_scores_are_exact(index, corpus):
+    # Candidates are approximate, the scores of the returned documents are not.
+    query = QUERIES[1]
+    expected = _reference_cosine(corpus[2], query)
+    result = index.search(_query(query), VectorBackend.lsh, top_k=10, lsh=LSHParameters(tables=32, bits=4),
+                          use_cache=False)
+    assert result
+    for name, score in result:
+        assert score == pytest.approx(expected[name], rel=1e-5)
+
+
+@needs_lsh
+def test_lsh_recall(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = CorpusParameters(documents=1000, document_length=40, vocabulary_size=400, seed=5)
+    index = VectorIndex()
+    index.replace_index_terms(generate_corpus(tmp_path / "corpus", parameters))
+    index.index_text_corpus(tmp_path / "corpus")
+    index.save()
+    # The signatures of the default parameters are stored with the documents.
+    [segment_path] = tmp_path.glob("vector_index*.seg")
+    segment = VectorSegmentReader(segment_path)
+    assert (segment.signature_bits, segment.signature_seed) == (SIGNATURE_BITS, LSHParameters().seed)
+    assert len(segment.signatures) == parameters.documents * SIGNATURE_BITS // 8
+    segment.close()
+    words = vocabulary(parameters.vocabulary_size)
+    generator = random.Random(1)
+    queries = [_query(generator.sample(words[10:200], 3)) for _ in range(50)]
+    exact = [{name for name, _ in index.search(query, VectorBackend.python, top_k=10, use_cache=False)}
+             for query in queries]
+
+    # Exact scoring of whole segments only happens on fallbacks; candidates have to stay well below the corpus.
+    fallbacks, candidates = [], []
+    monkeypatch.setattr(vector, "top_k_scores", lambda *args: fallbacks.append(args) or [])
+    score_candidates = vector.score_candidates
+    monkeypatch.setattr(vector, "score_candidates",
+                        lambda query, docs, *args: candidates.append(len(docs)) or score_candidates(query, docs, *args))
+    recall = [len(expected & {name for name, _ in index.search(query, VectorBackend.lsh, top_k=10, use_cache=False)})
+              / len(expected) for query, expected in zip(queries, exact)]
+    index.close()
+    assert not fallbacks
+    assert sum(candidates) / len(candidates) < 0.6 * parameters.documents
+    assert sum(recall) / len(recall) >= 0.8
@@ -0,0 +1,68 @@
+from typing import Iterator, Optional, TextIO
+from pathlib import Path
+import re
+
+from search_common import profiling
+from search_common.analysis import Analyzer
+
+
+CHUNK_SIZE = 64 * 1024
+
+_TOKEN_PATTERN = re.compile(r"\S+")
+# Commas and dots are dropped rather than treated as separators, as the indexers always did.
+_STRIPPED_CHARACTERS = str.maketrans("", "", ",.")
+
+
+def _normalize(token: str) -> str:
+    return token.translate(_STRIPPED_CHARACTERS).lower()
+
+
+def _tokenize_chunk(text: str) -> tuple[list[str], str]:
+    terms = []
+    for match in _TOKEN_PATTERN.finditer(text):
+        # A token touching the end of the chunk may continue in the next one.
+        if match.end() == len(text):
+            return terms, match.group()
+        if term := _normalize(match.group()):
+            terms.append(term)
+    return terms, ""
+
+
+def _analyze_chunk(text: str, analyzer: Analyzer) -> tuple[list[str], str]:
+    # Everything after the last whitespace may continue in the next chunk; tokens and footnote markers never
+    # contain whitespace, so analyzing the rest on its own gives the same terms as analyzing the whole text.
+    cut = len(text)
+    while cut and not text[cut - 1].isspace():
+        cut -= 1
+    return analyzer.analyze(text[:cut]), text[cut:]
+
+
+def tokenize_stream(f: TextIO, chunk_size: int = CHUNK_SIZE, analyzer: Optional[Analyzer] = None) -> Iterator[str]:
+    carry = ""
+    while True:
+        with profiling.phase("file.read"):
+            chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        profiling.count("file.characters", len(chunk))
+        with profiling.phase("tokenize"):
+            text = carry + chunk if carry else chunk
+            terms, carry = _analyze_chunk(text, analyzer) if analyzer else _tokenize_chunk(text)
+        profiling.count("tokenize.tokens", len(terms))
+        yield from terms
+    if carry and analyzer:
+        yield from analyzer.analyze(carry)
+    elif carry and (term := _normalize(carry)):
+        yield term
+
+
+def tokenize_text(document: str) -> Iterator[str]:
+    for match in _TOKEN_PATTERN.finditer(document):
+        if term := _normalize(match.group()):
+            yield term
+
+
+def tokenize_file(path: Path, chunk_size: int = CHUNK_SIZE, analyzer: Optional[Analyzer] = None) -> Iterator[str]:
+    profiling.count("file.opened")
+    with open(path, "r") as f:
+        yield from tokenize_stream(f, chunk_size, analyzer)
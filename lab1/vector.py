@@ -1,87 +1,386 @@
-from typing import Generator
-from dataclasses import dataclass, asdict, field
+from typing import Callable, Generator, Iterable, Iterator, Optional, Union
+from collections.abc import Container, Mapping
+from dataclasses import dataclass, field, replace
+from enum import Enum
+from array import array
+from bisect import bisect_left
 import json
 from contextlib import contextmanager
 from pathlib import Path
-from collections import defaultdict
+from collections import Counter, defaultdict
+import heapq
 import logging
-from math import log
+from math import log, sqrt
+import os
 import re
+import tempfile
 
+from search_common import profiling
+from search_common.analysis import WIKIPEDIA_ANALYZER, Analyzer
+
+from lsh import (LSHParameters, RandomProjectionLSH, SIGNATURE_BITS, document_signatures, lsh_available,
+                 pack_signatures, unpack_signatures)
+from manifest import Manifest
+from result_cache import ResultCache
+from scoring import WeightedPostings, score_candidates, top_k_scores
+from segment_list import SegmentEntry, SegmentList, merge_start
+from sparse_tfidf import SparseTfIdf, sparse_backend_available
+from spimi import DEFAULT_MEMORY_BUDGET, build_runs, merge_runs, read_run
+from term_dictionary import TermDictionary
+from tokenizer import tokenize_file
+from vector_segment import (VectorSegmentReader, write_vector_segment, FLAG_ANALYZED, FLAG_NEW_INDEX_TERMS_ALLOWED,
+                            FLAG_OPEN_VOCABULARY)
+
+VECTOR_SEGMENTS_PATH = "vector_index_segments.json"
+VECTOR_SEGMENT_STEM = "vector_index"
+VECTOR_MANIFEST_PATH = "vector_index_manifest.json"
+VECTOR_CACHE_PATH = "vector_index_query_cache.json"
+# Indexes saved before segment lists have a single segment under this name, with idf in its weights; its counts
+# are read once and written as a segment of the current format on the next save.
+VECTOR_SEGMENT_PATH = "vector_index.seg"
+# Indexes saved before the segment format are still read once and converted on the next save.
 VECTOR_INDEX_TERMS_PATH = "vector_index_terms.json"
 
-COSINE_SIMILIARITY_THRESHOLD = -1
+# Documents have to score above this to be returned; it is also the starting bound for pruning.
+COSINE_SIMILIARITY_THRESHOLD = 0
+# LSH results come from at least this many candidates per requested result, fewer are scored exactly instead.
+MIN_CANDIDATES_PER_RESULT = 4
+
+
+class VectorBackend(str, Enum):
+    auto = "auto"
+    python = "python"
+    sparse = "sparse"
+    # Approximate: candidates from random-projection LSH buckets, re-ranked exactly. Never picked by auto.
+    lsh = "lsh"
+
 
 @dataclass
-class DocumentTermData:
-    occurrences: int = 0
-    tf: float = 0
-    idf: float = 0
-    tf_idf: float = 0
+class CorpusStatistics:
+    documents: int = 0
+    # term -> documents containing the term; vocabulary terms that no document contains are listed with 0
+    document_frequency: dict[str, int] = field(default_factory=dict)
+
+    def add(self, other: 'CorpusStatistics') -> None:
+        self.documents += other.documents
+        for term, frequency in other.document_frequency.items():
+            self.document_frequency[term] = self.document_frequency.get(term, 0) + frequency
+
+    def terms_with_prefix(self, prefix: str) -> list[str]:
+        return sorted(term for term in self.document_frequency if term.startswith(prefix))
+
+
+def _tf_formula(term_occurrences_in_document: int, overall_terms_occurrences_in_document: int) -> float:
+    return term_occurrences_in_document / overall_terms_occurrences_in_document
+
+
+def _idf_formula(overall_documents: int, term_is_in_documents: int) -> float:
+    return log(overall_documents / term_is_in_documents)
+
+
+class MemoryVectorSegment:
+    # Documents that are not in a saved segment yet, as the term-major columns write_vector_segment stores and
+    # behind the read interface of VectorSegmentReader. Norms use the idf given when it is built.
+    def __init__(self, documents: Mapping[str, Mapping[int, int]], vocabulary: TermDictionary,
+                 idf: Callable[[str], float]):
+        self._documents = list(documents)
+        self.lengths = [sum(counts.values()) for counts in documents.values()]
+        self.norms = []
+        columns: list[tuple[list[int], list[int], list[float]]] = [([], [], []) for _ in vocabulary]
+        term_idf: dict[int, float] = {}
+        for doc_id, (counts, length) in enumerate(zip(documents.values(), self.lengths)):
+            for term_id in counts:
+                if term_id not in term_idf:
+                    term_idf[term_id] = idf(vocabulary.term(term_id))
+            norm = sqrt(sum((_tf_formula(occurrences, length) * term_idf[term_id]) ** 2
+                            for term_id, occurrences in counts.items()))
+            self.norms.append(norm)
+            for term_id, occurrences in counts.items():
+                doc_ids, term_counts, weights = columns[term_id]
+                doc_ids.append(doc_id)
+                term_counts.append(occurrences)
+                weights.append(_tf_formula(occurrences, length) / norm if norm else 0)
+        self._terms = sorted(vocabulary)
+        self._columns = {term: columns[vocabulary[term]] for term in self._terms}
+        # idf the norms were computed with, by sorted term
+        self.idf = [term_idf.get(vocabulary[term], 0.0) for term in self._terms]
+        # The same columns laid out flat, like the ones of a mapped segment.
+        self.doc_ids, self.counts, self.weights = array("I"), array("I"), array("f")
+        self._offsets = []
+        for term in self._terms:
+            self._offsets.append(len(self.doc_ids))
+            doc_ids, term_counts, weights = self._columns[term]
+            self.doc_ids.extend(doc_ids)
+            self.counts.extend(term_counts)
+            self.weights.extend(weights)
+        self._offsets.append(len(self.doc_ids))
+
+    @property
+    def documents_count(self) -> int:
+        return len(self._documents)
+
+    @property
+    def terms_count(self) -> int:
+        return len(self._terms)
+
+    def document_name(self, doc_id: int) -> str:
+        return self._documents[doc_id]
+
+    def document_names(self) -> list[str]:
+        return list(self._documents)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self._columns
+
+    def document_frequency(self, term: str) -> int:
+        column = self._columns.get(term)
+        return 0 if column is None else len(column[0])
+
+    def weighted_postings(self, term: str) -> Optional[WeightedPostings]:
+        column = self._columns.get(term)
+        if column is None:
+            return None
+        doc_ids, _, weights = column
+        return WeightedPostings(doc_ids, weights, max(weights, default=0))
+
+    def term_offsets(self) -> list[int]:
+        return self._offsets
+
+    def term_columns(self) -> list[tuple[str, list[int], list[int], list[float]]]:
+        return [(term, *self._columns[term]) for term in self._terms]
+
+    def terms_with_prefix(self, prefix: str) -> list[str]:
+        result = []
+        for position in range(bisect_left(self._terms, prefix), len(self._terms)):
+            if not self._terms[position].startswith(prefix):
+                break
+            result.append(self._terms[position])
+        return result
+
+    def terms(self) -> Iterator[str]:
+        return iter(self._terms)
+
+
+VectorSegment = Union[VectorSegmentReader, MemoryVectorSegment]
+
+
+def _segment_documents(reader: VectorSegmentReader, deleted: Container[int],
+                       vocabulary: TermDictionary) -> dict[str, dict[int, int]]:
+    # Counts of the live documents of a saved segment, keyed by the term IDs of vocabulary. Every term of the
+    # segment is added to it, with or without live documents, so a merge keeps the vocabulary.
+    names = reader.document_names()
+    documents: dict[int, dict[int, int]] = {doc_id: {} for doc_id in range(reader.documents_count)
+                                            if doc_id not in deleted}
+    offsets = reader.term_offsets()
+    for position, term in enumerate(reader.terms()):
+        term_id = vocabulary.add(term)
+        for entry in range(offsets[position], offsets[position + 1]):
+            counts = documents.get(reader.doc_ids[entry])
+            if counts is not None:
+                counts[term_id] = reader.counts[entry]
+    return {names[doc_id]: counts for doc_id, counts in documents.items()}
 
 
 @dataclass
 class VectorIndex:
-    index_terms: defaultdict[str, dict[str, list[str]]] = field(default_factory=dict)
+    # Saved documents live in immutable segments, like the ones of InvertedIndex: new documents are written as one
+    # more segment and removed ones are marked in the deletion set of their segment. Segments store tf / norm and
+    # idf is applied to the query, so an update never rewrites the documents already saved. Norms are computed
+    # with the corpus statistics of when their segment was written and refreshed when segments are merged;
+    # removed documents count in the statistics until then.
+    # "index_terms" -> term dictionary of the documents that are not saved yet
+    index_terms: defaultdict[str, Mapping[str, int]] = field(default_factory=dict)
     new_index_terms_allowed: bool = True
-    indexed_documents: dict[str, dict[str, DocumentTermData]] = field(default_factory=dict)
+    # Index every term met while indexing, not only the ones of the index terms file.
+    open_vocabulary: bool = False
+    # Stem and drop stop words like the custom_wikipedia_analyzer of the Elasticsearch mapping, instead of only
+    # lowercasing.
+    analyzed: bool = False
+    # document name -> term ID -> occurrences of the documents that are not saved yet
+    indexed_documents: dict[str, dict[int, int]] = field(default_factory=dict)
+    document_lengths: dict[str, int] = field(default_factory=dict)
+    # term ID -> documents not saved yet containing the term
+    document_frequency: dict[int, int] = field(default_factory=dict)
+    _segments: SegmentList = field(default_factory=SegmentList, init=False, repr=False)
+    # Opened readers, in the order of _segments.segments.
+    _readers: list[VectorSegmentReader] = field(default_factory=list, init=False, repr=False)
+    # name -> (position in _readers, doc ID) of the live saved documents, read on first use.
+    _locations: Optional[dict[str, tuple[int, int]]] = field(default=None, init=False, repr=False)
+    _vocabulary: Optional[frozenset[str]] = field(default=None, init=False, repr=False)
+    # Segment files merged away; they are unlinked once the segment list no longer names them.
+    _obsolete: list[str] = field(default_factory=list, init=False, repr=False)
+    _manifest: Optional[Manifest] = field(default=None, init=False, repr=False)
+    # Columns of the documents that are not saved yet, built when they are first searched.
+    _pending: Optional[MemoryVectorSegment] = field(default=None, init=False, repr=False)
+    _sparse: Optional[SparseTfIdf] = field(default=None, init=False, repr=False)
+    # position of the segment -> its LSH tables
+    _lsh: dict[int, RandomProjectionLSH] = field(default_factory=dict, init=False, repr=False)
+    _dirty: bool = field(default=True, init=False, repr=False)
+    # Where the index files live; shards of a sharded index each have their own directory.
+    _directory: Path = field(default=Path("."), init=False, repr=False)
+
+    def __post_init__(self):
+        vocabulary = TermDictionary(self.index_terms.get("index_terms", {}))
+        self.index_terms["index_terms"] = vocabulary
+        # Indexes saved as JSON key the documents' terms by string, and before only counts were stored they keep
+        # tf, idf and tf-idf next to the occurrences.
+        for name, terms in self.indexed_documents.items():
+            self.indexed_documents[name] = {
+                vocabulary.add(term): data["occurrences"] if isinstance(data, dict) else data
+                for term, data in terms.items()}
+        if self.indexed_documents or self.document_frequency:
+            self.document_lengths = {name: sum(terms.values()) for name, terms in self.indexed_documents.items()}
+            self.document_frequency = dict(Counter(term_id for terms in self.indexed_documents.values()
+                                                   for term_id in terms))
+
+    def _get_manifest(self) -> Manifest:
+        if self._manifest is None:
+            self._manifest = Manifest.read(self._directory / VECTOR_MANIFEST_PATH)
+        return self._manifest
+
+    def _document_locations(self) -> dict[str, tuple[int, int]]:
+        if self._locations is None:
+            self._locations = {}
+            for position, (reader, entry) in enumerate(zip(self._readers, self._segments.segments)):
+                for doc_id, name in enumerate(reader.document_names()):
+                    if doc_id not in entry.deleted:
+                        self._locations[name] = (position, doc_id)
+        return self._locations
+
+    def _closed_vocabulary(self) -> frozenset[str]:
+        # The oldest segment keeps every index term, with or without documents, through all merges.
+        if self._vocabulary is None:
+            terms = self._readers[0].terms() if self._readers else self.index_terms["index_terms"]
+            self._vocabulary = frozenset(terms)
+        return self._vocabulary
+
+    def _documents_count(self) -> int:
+        return sum(reader.documents_count for reader in self._readers) + len(self.indexed_documents)
+
+    def _document_frequency(self, term: str) -> int:
+        vocabulary = self.index_terms["index_terms"]
+        frequency = self.document_frequency.get(vocabulary[term], 0) if term in vocabulary else 0
+        return frequency + sum(reader.document_frequency(term) for reader in self._readers)
+
+    def _knows(self, term: str) -> bool:
+        return term in self.index_terms["index_terms"] or any(term in reader for reader in self._readers)
+
+    def _terms_with_prefix(self, prefix: str) -> list[str]:
+        terms = set(self.index_terms["index_terms"].terms_with_prefix(prefix))
+        for reader in self._readers:
+            terms.update(reader.terms_with_prefix(prefix))
+        return sorted(terms)
+
+    def _add_document(self, name: str, counts: dict[int, int]) -> None:
+        if name in self.indexed_documents:
+            self._discard_document(name)
+        self.indexed_documents[name] = counts
+        self.document_lengths[name] = sum(counts.values())
+        for term_id in counts:
+            self.document_frequency[term_id] = self.document_frequency.get(term_id, 0) + 1
+        self._changed()
+
+    def _discard_document(self, name: str) -> None:
+        for term_id in self.indexed_documents.pop(name):
+            self.document_frequency[term_id] -= 1
+            if self.document_frequency[term_id] == 0:
+                del self.document_frequency[term_id]
+        del self.document_lengths[name]
+        self._changed()
+
+    def _changed(self) -> None:
+        self._dirty = True
+        self._invalidate_search_structures()
+
+    def has_document(self, name: str) -> bool:
+        return name in self.indexed_documents or name in self._document_locations()
+
+    def remove_document(self, name: str) -> None:
+        if name in self.indexed_documents:
+            self._discard_document(name)
+        else:
+            position, doc_id = self._document_locations().pop(name)
+            self._segments.segments[position].deleted.add(doc_id)
+            self._changed()
+        self._get_manifest().forget(name)
+
+    def _analyzer(self) -> Optional[Analyzer]:
+        return WIKIPEDIA_ANALYZER if self.analyzed else None
 
-    def replace_index_terms(self, path: Path) -> None:
+    def replace_index_terms(self, path: Optional[Path], open_vocabulary: bool = False, analyzed: bool = False) -> None:
+        # Without a path the index starts with an empty vocabulary, which only makes sense with open_vocabulary.
         if not self.new_index_terms_allowed:
             logging.warning("Adding index terms after initialisation is not allowed.")
             return
-        with open(path, "r") as f:
-            index_terms = json.load(f)
-            self.index_terms["index_terms"] = {}
-            for key in index_terms["index_terms"].keys():
-                self.index_terms["index_terms"][key] = []
-            self.new_index_terms_allowed = False
-
-    def index_text_corpus(self, dir_path: Path):
-        pathlist = Path(dir_path).glob('*')
-        for path in pathlist:
+        if self.indexed_documents or self._document_locations():
+            # Term IDs of the indexed documents belong to the old dictionary.
+            logging.warning("Replacing the index terms of a non-empty index is not allowed.")
+            return
+        # Segments without live documents only hold the old vocabulary.
+        self._obsolete.extend(entry.name for entry in self._segments.segments)
+        self.close()
+        self._segments.segments = []
+        self._locations = None
+        self.index_terms["index_terms"] = TermDictionary()
+        if path is not None:
             with open(path, "r") as f:
-                document = "".join(f.readlines())
-                self._index_document(path.name, document)
-        self._calculate_tf()
-        self._calculate_idf()
-        self._calculate_tf_idf()
-
-    def _calculate_tf(self):
-        for name, value in self.indexed_documents.items():
-            overall_terms_in_document = sum(item.occurrences for item in value.values())
-            for term, info in value.items():
-                info.tf = self.__tf_formula(info.occurrences, overall_terms_in_document)
-
-    def _calculate_idf(self):
-        overall_documents = len(self.indexed_documents)
-        for name, value in self.indexed_documents.items():
-            for term, info in value.items():
-                documents_term_in = sum(1 for db_document_terms in self.indexed_documents.values() if term in db_document_terms)
-                info.idf = self.__idf_formula(overall_documents, documents_term_in)
-
-    def _calculate_tf_idf(self):
-        for name, value in self.indexed_documents.items():
-            for info in value.values():
-                info.tf_idf = info.tf * info.idf
+                keys = json.load(f)["index_terms"].keys()
+                self.index_terms["index_terms"] = TermDictionary(WIKIPEDIA_ANALYZER.iter_terms(keys) if analyzed
+                                                                 else keys)
+        self._vocabulary = None
+        self.new_index_terms_allowed = False
+        self.open_vocabulary = open_vocabulary
+        self.analyzed = analyzed
+        self._changed()
 
-    @classmethod
-    def __tf_formula(cls, term_occurrences_in_document: int, overall_terms_occurrences_in_document: int) -> float:
-        return term_occurrences_in_document / overall_terms_occurrences_in_document
+    def index_text_corpus(self, dir_path: Path, workers: int = 1, memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                          names: Optional[Container[str]] = None):
+        # names restricts the index to some of the corpus files, e.g. the ones of one shard.
+        manifest = self._get_manifest()
+        changes = manifest.scan(dir_path, names)
+        for name in changes.to_remove + [path.name for path in changes.added]:
+            if self.has_document(name):
+                self.remove_document(name)
+        if workers != 1 and changes.to_index:
+            self._index_text_corpus_parallel(changes.to_index, workers, memory_budget)
+        else:
+            for path in changes.to_index:
+                self._index_document(path.name, tokenize_file(path, analyzer=self._analyzer()))
+        manifest.update(dir_path, changes)
 
-    @classmethod
-    def __idf_formula(cls, overall_documents: int, term_is_in_documents: int) -> float:
-        return log(overall_documents / term_is_in_documents)
+    def _index_text_corpus_parallel(self, paths: list[Path], workers: int, memory_budget: int):
+        documents: list[dict[int, int]] = [{} for _ in paths]
+        vocabulary = self.index_terms["index_terms"]
+        with tempfile.TemporaryDirectory(dir=self._directory) as run_dir:
+            with profiling.phase("spimi.build_runs"):
+                runs = build_runs(list(enumerate(paths)), Path(run_dir),
+                                  None if self.open_vocabulary else self._closed_vocabulary(), workers, memory_budget,
+                                  analyzer=self._analyzer())
+            with profiling.phase("spimi.merge_runs"):
+                for term, postings in merge_runs([read_run(run) for run in runs]):
+                    term_id = vocabulary.add(term)
+                    for doc_id, occurrences, _ in postings:
+                        documents[doc_id][term_id] = occurrences
+        for path, counts in zip(paths, documents):
+            self._add_document(path.name, counts)
 
-    def _index_document(self, name: str, document: str):
-        words = list(document.replace(",", "").replace(".", "").replace("\n", " ").lower().split(" "))
-        self.indexed_documents[name] = {}
+    @profiling.timed("vector.index_document")
+    def _index_document(self, name: str, terms: Iterable[str]):
+        vocabulary = self.index_terms["index_terms"]
+        if not self.open_vocabulary:
+            closed_vocabulary = self._closed_vocabulary()
+            terms = (word for word in terms if word in closed_vocabulary)
+        self._add_document(name, dict(Counter(map(vocabulary.add, terms))))
 
-        for word in words:
-            if word in self.index_terms["index_terms"]:
-                document_data = self.indexed_documents[name].get(word, DocumentTermData())
-                document_data.occurrences += 1
-                self.indexed_documents[name][word] = document_data
+    def corpus_statistics(self) -> CorpusStatistics:
+        vocabulary = self.index_terms["index_terms"]
+        statistics = CorpusStatistics(self._documents_count(), {
+            term: self.document_frequency.get(term_id, 0) for term_id, term in enumerate(vocabulary)})
+        for reader in self._readers:
+            offsets = reader.term_offsets()
+            statistics.add(CorpusStatistics(0, {term: offsets[position + 1] - offsets[position]
+                                                for position, term in enumerate(reader.terms())}))
+        return statistics
 
     @classmethod
     def _extract_terms(self, query: str) -> list[str]:
@@ -93,54 +392,334 @@ class VectorIndex:
             words.append(query[index_start + 1:terms_between[position + 1]])
         return words
 
-    def _calculate_query_weight(self, query: list[str]) -> dict[str, float]:
-        result = {}
-        for word in query:
-            if word in self.index_terms["index_terms"]:
-                result[word] = 1.0
-            else:
-                continue
-        return result
+    def _analyze_words(self, words: list[str]) -> list[str]:
+        if not self.analyzed:
+            return words
+        # Wildcards are only lowercased; their prefix is matched against the analyzed terms.
+        return [term for word in words
+                for term in ([word.lower()] if word.endswith("*") else WIKIPEDIA_ANALYZER.analyze(word))]
 
-    def _cosine_similarity(self, query: list[str]):
-        query_weight = self._calculate_query_weight(query)
-        sum_query_normilized = sum(value ** 2 for value in query_weight.values()) ** (1 / 2)
+    @classmethod
+    def _expand_wildcards(cls, words: list[str], terms_with_prefix: Callable[[str], list[str]]) -> list[str]:
+        # "eag*" stands for every indexed term starting with "eag"; each of them is weighted like a query term.
         result = []
-        for document_name, value in self.indexed_documents.items():
-            sum_indexed_terms = 0
-            sum_upper = 0
-            for term, term_weight in query_weight.items():
-                documnet_term_data = DocumentTermData(**value.get(term, {}))
-
-                sum_upper += documnet_term_data.tf_idf * term_weight
-                sum_indexed_terms += documnet_term_data.tf_idf ** 2
-            sum_indexed_terms **= (1 / 2)
-            if sum_indexed_terms == 0:
-                continue
-            similiarity = sum_upper / (sum_indexed_terms * sum_query_normilized)
-            if similiarity > COSINE_SIMILIARITY_THRESHOLD:
-                result.append((document_name, similiarity))
-        return sorted(result, key=lambda x: x[1], reverse=True)
-
-    def search(self, query: str) -> list[tuple[str, float]]:
-        words = self._extract_terms(query)
-        result = self._cosine_similarity(words)
+        for word in words:
+            if word.endswith("*") and len(word) > 1:
+                result.extend(terms_with_prefix(word[:-1]))
+            else:
+                result.append(word)
         return result
 
+    def _query_weights(self, query: str, statistics: Optional[CorpusStatistics] = None) -> dict[str, float]:
+        # Every known query term has the same tf, and the query vector is normalised over all of them, terms that
+        # no document contains included. The weights carry the idf, the documents' weights do not.
+        words = self._analyze_words(self._extract_terms(query))
+        if statistics is not None:
+            words = self._expand_wildcards(words, statistics.terms_with_prefix)
+            documents = statistics.documents
+            frequency = {word: statistics.document_frequency[word] for word in words
+                         if word in statistics.document_frequency}
+        else:
+            words = self._expand_wildcards(words, self._terms_with_prefix)
+            documents = self._documents_count()
+            frequency = {word: self._document_frequency(word) for word in words if self._knows(word)}
+        norm = sqrt(len(frequency))
+        weights = {term: _idf_formula(documents, term_frequency) / norm
+                   for term, term_frequency in frequency.items() if term_frequency}
+        return {term: weight for term, weight in weights.items() if weight > 0}
+
+    def _pending_segment(self) -> MemoryVectorSegment:
+        if self._pending is None:
+            documents = self._documents_count()
+            self._pending = MemoryVectorSegment(self.indexed_documents, self.index_terms["index_terms"],
+                                                lambda term: _idf_formula(documents, self._document_frequency(term)))
+        return self._pending
+
+    def _views(self) -> list[tuple[VectorSegment, set[int]]]:
+        views: list[tuple[VectorSegment, set[int]]] = [
+            (reader, entry.deleted) for reader, entry in zip(self._readers, self._segments.segments)]
+        if self.indexed_documents or not views:
+            views.append((self._pending_segment(), set()))
+        return views
+
+    def _invalidate_search_structures(self) -> None:
+        self._pending = None
+        self._sparse = None
+        self._lsh.clear()
+
+    def _lsh_index(self, position: int, segment: VectorSegment, parameters: LSHParameters) -> RandomProjectionLSH:
+        # Probes only change which buckets a query reads, the tables are shared.
+        parameters = replace(parameters, probes=0)
+        lsh_index = self._lsh.get(position)
+        if lsh_index is None or lsh_index.parameters != parameters:
+            bits = parameters.tables * parameters.bits
+            with profiling.phase("vector.build_lsh"):
+                if (isinstance(segment, VectorSegmentReader) and segment.signature_seed == parameters.seed
+                        and segment.signature_bits >= bits):
+                    signatures = unpack_signatures(segment.signatures, segment.documents_count,
+                                                   segment.signature_bits)
+                else:
+                    # Saved documents are projected with the idf of the index as it is now, pending ones with the
+                    # idf their norms were computed with.
+                    terms = list(segment.terms())
+                    idf = segment.idf if isinstance(segment, MemoryVectorSegment) else [
+                        _idf_formula(self._documents_count(), self._document_frequency(term)) for term in terms]
+                    signatures = document_signatures(terms, segment.term_offsets(), segment.doc_ids,
+                                                     segment.weights, idf, segment.documents_count,
+                                                     parameters.seed, bits)
+                lsh_index = self._lsh[position] = RandomProjectionLSH(parameters, signatures)
+        return lsh_index
+
+    def _cosine_similarity(self, query_weights: dict[str, float], top_k: Optional[int] = None,
+                           lsh: Optional[LSHParameters] = None) -> list[tuple[str, float]]:
+        # Every segment returns its best k, which contain the best k of the whole index; ties are broken in the
+        # doc order of the whole index, segment by segment.
+        matches = []
+        for position, (segment, deleted) in enumerate(self._views()):
+            query_postings = []
+            for term, weight in query_weights.items():
+                postings = segment.weighted_postings(term)
+                if postings is not None:
+                    query_postings.append((postings, weight))
+            segment_matches = None
+            # Without a k every match is asked for, which buckets cannot promise.
+            if lsh is not None and top_k is not None:
+                lsh_index = self._lsh_index(position, segment, lsh)
+                with profiling.phase("vector.score"):
+                    candidates = set(lsh_index.candidates(query_weights, lsh.probes).tolist()) - deleted
+                    profiling.count("vector.lsh_candidates", len(candidates))
+                    if len(candidates) >= MIN_CANDIDATES_PER_RESULT * top_k:
+                        segment_matches = score_candidates(query_postings, candidates, top_k,
+                                                           COSINE_SIMILIARITY_THRESHOLD)
+                # Too few candidates, or too few of them matching, to trust the top k: the segment is scored
+                # exactly, so small segments and rare queries lose nothing.
+                if segment_matches is None or len(segment_matches) < top_k:
+                    profiling.count("vector.lsh_fallbacks")
+                    segment_matches = None
+            if segment_matches is None:
+                with profiling.phase("vector.score"):
+                    segment_matches = top_k_scores(query_postings, top_k, COSINE_SIMILIARITY_THRESHOLD, deleted)
+            matches.extend((-score, position, doc_id, segment.document_name(doc_id))
+                           for doc_id, score in segment_matches)
+        best = sorted(matches) if top_k is None else heapq.nsmallest(top_k, matches)
+        return [(name, -score) for score, _, _, name in best]
+
+    @profiling.timed("vector.sparse_index")
+    def _sparse_index(self) -> SparseTfIdf:
+        if self._sparse is None:
+            self._sparse = SparseTfIdf.from_segments(
+                (segment.document_names(), list(segment.terms()), segment.doc_ids, segment.weights,
+                 segment.term_offsets(), deleted) for segment, deleted in self._views())
+        return self._sparse
+
+    def _use_sparse(self, backend: VectorBackend, queries_count: int) -> bool:
+        if backend == VectorBackend.sparse:
+            if not sparse_backend_available():
+                raise RuntimeError("The sparse backend needs numpy and scipy installed")
+            return True
+        # Building the matrices costs about as much as one pass over the index, so for a single query they only
+        # pay off once they exist.
+        return (backend == VectorBackend.auto and sparse_backend_available()
+                and (queries_count > 1 or self._sparse is not None))
+
+    def _search_uncached(self, weights: list[dict[str, float]], backend: VectorBackend, top_k: Optional[int],
+                         lsh: LSHParameters) -> list[list[tuple[str, float]]]:
+        if backend == VectorBackend.lsh:
+            if not lsh_available():
+                raise RuntimeError("The lsh backend needs numpy and scipy installed")
+            return [self._cosine_similarity(query_weights, top_k, lsh) for query_weights in weights]
+        if self._use_sparse(backend, len(weights)):
+            sparse_index = self._sparse_index()
+            with profiling.phase("vector.score"):
+                return sparse_index.search_batch(weights, top_k, COSINE_SIMILIARITY_THRESHOLD)
+        return [self._cosine_similarity(query_weights, top_k) for query_weights in weights]
+
+    @classmethod
+    def _cache_key(cls, query_weights: dict[str, float], backend: VectorBackend, top_k: Optional[int],
+                   lsh: LSHParameters) -> str:
+        # Term order and repetitions do not change the weights, and the weights carry the idf of the statistics
+        # the query was weighed with. The exact backends agree with each other, approximate results also depend
+        # on the LSH parameters.
+        approximate = [lsh.tables, lsh.bits, lsh.probes, lsh.seed] if backend == VectorBackend.lsh else None
+        return json.dumps([sorted(query_weights.items()), top_k, approximate])
+
+    def search_batch(self, queries: list[str], backend: VectorBackend = VectorBackend.auto,
+                     top_k: Optional[int] = None, lsh: LSHParameters = LSHParameters(),
+                     use_cache: bool = True, statistics: Optional[CorpusStatistics] = None
+                     ) -> list[list[tuple[str, float]]]:
+        # statistics replace the index's own when queries are weighed, e.g. the ones of the whole corpus when the
+        # index is one shard of it.
+        weights = [self._query_weights(query, statistics) for query in queries]
+        # Only saved indexes have an identity and a generation that identify their content.
+        cache = ResultCache.open(self._directory / VECTOR_CACHE_PATH) if use_cache and not self._dirty else None
+        if cache is None:
+            return self._search_uncached(weights, backend, top_k, lsh)
+        keys = [self._cache_key(query_weights, backend, top_k, lsh) for query_weights in weights]
+        results = [cache.get(key, self._segments.identity, self._segments.generation) for key in keys]
+        missing = [position for position, result in enumerate(results) if result is None]
+        if missing:
+            computed = self._search_uncached([weights[position] for position in missing], backend, top_k, lsh)
+            for position, result in zip(missing, computed):
+                results[position] = result
+                cache.put(keys[position], self._segments.identity, self._segments.generation, result)
+        return [[(name, score) for name, score in result] for result in results]
+
+    def search(self, query: str, backend: VectorBackend = VectorBackend.auto, top_k: Optional[int] = None,
+               lsh: LSHParameters = LSHParameters(), use_cache: bool = True,
+               statistics: Optional[CorpusStatistics] = None) -> list[tuple[str, float]]:
+        return self.search_batch([query], backend, top_k, lsh, use_cache, statistics)[0]
+
+    def _write_segment(self, segment: MemoryVectorSegment) -> None:
+        name = self._segments.new_name(VECTOR_SEGMENT_STEM)
+        # LSH signatures of the unit tf-idf vectors, with the default seed; any tables x bits that fit in them are
+        # read from the segment instead of projecting its documents at query time.
+        signatures = b""
+        if lsh_available():
+            with profiling.phase("vector.build_lsh"):
+                signatures = pack_signatures(document_signatures(
+                    list(segment.terms()), segment.term_offsets(), segment.doc_ids, segment.weights, segment.idf,
+                    segment.documents_count, LSHParameters().seed, SIGNATURE_BITS))
+        write_vector_segment(self._directory / name, segment.document_names(), segment.lengths, segment.norms,
+                             segment.term_columns(), self._flags(), self._segments.generation + 1, signatures,
+                             SIGNATURE_BITS, LSHParameters().seed)
+        self._readers.append(VectorSegmentReader(self._directory / name))
+        self._segments.segments.append(SegmentEntry(name, segment.documents_count))
+
+    def _clear_pending(self) -> None:
+        self.index_terms["index_terms"] = TermDictionary()
+        self.indexed_documents = {}
+        self.document_lengths = {}
+        self.document_frequency = {}
+
+    @profiling.timed("vector.merge")
+    def _merge(self, start: int) -> None:
+        readers, entries = self._readers[start:], self._segments.segments[start:]
+        del self._readers[start:], self._segments.segments[start:]
+        vocabulary = TermDictionary()
+        documents: dict[str, dict[int, int]] = {}
+        for reader, entry in zip(readers, entries):
+            documents.update(_segment_documents(reader, entry.deleted, vocabulary))
+        # Norms of the merged documents are computed again, with statistics that no longer count the removed ones.
+        merged_frequency = Counter(term_id for counts in documents.values() for term_id in counts)
+        overall_documents = len(documents) + sum(reader.documents_count for reader in self._readers)
+
+        def idf(term: str) -> float:
+            return _idf_formula(overall_documents, merged_frequency[vocabulary[term]] +
+                                sum(reader.document_frequency(term) for reader in self._readers))
+
+        # Newer segments without live documents are dropped, the oldest one is kept for its vocabulary.
+        if documents or not self._readers:
+            self._write_segment(MemoryVectorSegment(documents, vocabulary, idf))
+        for reader, entry in zip(readers, entries):
+            reader.close()
+            self._obsolete.append(entry.name)
+
+    @profiling.timed("vector.save")
     def save(self) -> None:
-        with open(VECTOR_INDEX_TERMS_PATH, "w") as f:
-            json.dump(asdict(self), f, default=str, indent=4)
+        if self._manifest is not None:
+            self._manifest.save(self._directory / VECTOR_MANIFEST_PATH)
+        if not self._dirty:
+            return
+        # A new index is saved even without documents, its segment keeps the vocabulary and the options.
+        if self.indexed_documents or not self._readers:
+            self._write_segment(self._pending_segment())
+            self._clear_pending()
+        start = merge_start(self._segments.segments)
+        if start < len(self._segments.segments):
+            self._merge(start)
+        self._locations = None
+        self._invalidate_search_structures()
+        self._segments.generation += 1
+        self._segments.save(self._directory / VECTOR_SEGMENTS_PATH)
+        for name in self._obsolete:
+            os.unlink(self._directory / name)
+        self._obsolete = []
+        self._dirty = False
+
+    def _flags(self) -> int:
+        flags = FLAG_NEW_INDEX_TERMS_ALLOWED if self.new_index_terms_allowed else 0
+        if self.open_vocabulary:
+            flags |= FLAG_OPEN_VOCABULARY
+        if self.analyzed:
+            flags |= FLAG_ANALYZED
+        return flags
+
+    def close(self) -> None:
+        for reader in self._readers:
+            reader.close()
+        self._readers = []
+
+    def _attach_segments(self, segments: SegmentList, readers: list[VectorSegmentReader]) -> None:
+        flags = readers[0].flags
+        self.new_index_terms_allowed = bool(flags & FLAG_NEW_INDEX_TERMS_ALLOWED)
+        self.open_vocabulary = bool(flags & FLAG_OPEN_VOCABULARY)
+        self.analyzed = bool(flags & FLAG_ANALYZED)
+        self._segments = segments
+        self._readers = readers
+        self._dirty = False
 
     @classmethod
-    @contextmanager
-    def load(cls) -> Generator['VectorIndex', None, None]:
+    def _from_legacy_segment(cls, path: Path) -> 'VectorIndex':
+        # Its weights include the idf of when it was saved; only the counts are kept.
+        reader = VectorSegmentReader(path)
+        try:
+            index = cls(new_index_terms_allowed=bool(reader.flags & FLAG_NEW_INDEX_TERMS_ALLOWED),
+                        open_vocabulary=bool(reader.flags & FLAG_OPEN_VOCABULARY),
+                        analyzed=bool(reader.flags & FLAG_ANALYZED))
+            for name, counts in _segment_documents(reader, (), index.index_terms["index_terms"]).items():
+                index._add_document(name, counts)
+        finally:
+            reader.close()
+        index._obsolete.append(VECTOR_SEGMENT_PATH)
+        return index
+
+    @classmethod
+    def _open_segments(cls, directory: Path) -> Optional[tuple[SegmentList, list[VectorSegmentReader]]]:
+        segments = SegmentList.read(directory / VECTOR_SEGMENTS_PATH)
+        if segments is None:
+            return None
+        readers = []
         try:
-            with open(VECTOR_INDEX_TERMS_PATH, "r") as f:
-                index_terms = json.load(f)
-                query = cls(**index_terms)
-        except (FileNotFoundError, json.JSONDecodeError):
-            query = cls()
+            for entry in segments.segments:
+                readers.append(VectorSegmentReader(directory / entry.name))
+        except FileNotFoundError:
+            # A merge unlinked the segment after this list was read; the new list names its replacement.
+            for reader in readers:
+                reader.close()
+            return cls._open_segments(directory)
+        return segments, readers
+
+    @classmethod
+    @profiling.timed("vector.open")
+    def open(cls, directory: Path = Path(".")) -> 'VectorIndex':
+        opened = cls._open_segments(directory)
+        if opened is not None:
+            index = cls()
+            index._attach_segments(*opened)
+        else:
+            try:
+                index = cls._from_legacy_segment(directory / VECTOR_SEGMENT_PATH)
+            except FileNotFoundError:
+                try:
+                    with open(directory / VECTOR_INDEX_TERMS_PATH, "r") as f, profiling.phase("json.load"):
+                        index_terms = json.load(f)
+                        # Norms were persisted by older versions, they are derived now.
+                        index_terms.pop("document_norms", None)
+                        index = cls(**index_terms)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    index = cls()
+        index._directory = directory
+        return index
+
+    @classmethod
+    @contextmanager
+    def load(cls, read_only: bool = False, directory: Path = Path(".")) -> Generator['VectorIndex', None, None]:
+        query = cls.open(directory)
         try:
             yield query
+            # Nothing is saved when the caller failed, a half applied change must not reach the segment list.
+            if not read_only:
+                query.save()
+            ResultCache.open(directory / VECTOR_CACHE_PATH).save()
         finally:
-            query.save()
\ No newline at end of file
+            query.close()
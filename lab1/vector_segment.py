@@ -0,0 +1,212 @@
+from typing import Iterator, Optional
+from array import array
+from pathlib import Path
+import mmap
+import os
+import struct
+import sys
+
+from scoring import WeightedPostings
+
+
+VECTOR_SEGMENT_MAGIC = b"VIXS"
+# Version 3 stores weights without idf and LSH signatures, versions 1 and 2 stored weights with the idf of the
+# whole index.
+VECTOR_SEGMENT_VERSION = 3
+
+# magic, version, flags, documents count, terms count, entries count, doc table offset, term table offset,
+# term strings offset, doc IDs offset, counts offset, weights offset, lengths offset, norms offset, generation,
+# LSH signature bits per document, LSH seed, signatures offset
+_HEADER = struct.Struct("<4sHHIIQQQQQQQQQQIqQ")
+# Version 2 segments have no LSH signatures, version 1 segments no generation either; they are read as
+# generation 0.
+_HEADER_V2 = struct.Struct("<4sHHIIQQQQQQQQQQ")
+_HEADER_V1 = struct.Struct("<4sHHIIQQQQQQQQQ")
+_MAGIC_AND_VERSION = struct.Struct("<4sH")
+_DOC_ENTRY = struct.Struct("<QI")
+# term string offset, term string length, first entry, documents with term, largest weight
+_TERM_ENTRY = struct.Struct("<QIQIf")
+
+FLAG_NEW_INDEX_TERMS_ALLOWED = 1
+FLAG_OPEN_VOCABULARY = 2
+# Documents and queries go through search_common.analysis.WIKIPEDIA_ANALYZER instead of the plain tokenizer.
+FLAG_ANALYZED = 4
+
+# Columns are written as native 4 byte arrays and read back with zero-copy memoryview casts.
+_COLUMN_ALIGNMENT = 8
+
+
+def _aligned(offset: int) -> int:
+    return (offset + _COLUMN_ALIGNMENT - 1) // _COLUMN_ALIGNMENT * _COLUMN_ALIGNMENT
+
+
+def write_vector_segment(path: Path, documents: list[str], lengths: list[int], norms: list[float],
+                         terms: list[tuple[str, list[int], list[int], list[float]]], flags: int = 0,
+                         generation: int = 0, signatures: bytes = b"", signature_bits: int = 0,
+                         signature_seed: int = 0) -> None:
+    # terms: (term, doc IDs, occurrences, weights) sorted by term, with the entries of a term sorted by doc ID. The
+    # weights are tf / norm; idf is left to the query, so they stay valid when the rest of the corpus changes.
+    # signatures: signature_bits / 8 bytes of packed LSH signature bits per document, or nothing.
+    if sys.byteorder != "little":
+        raise RuntimeError("Vector segments are only supported on little-endian machines")
+    doc_table = bytearray()
+    doc_strings = bytearray()
+    for name in documents:
+        encoded = name.encode("utf-8")
+        doc_table += _DOC_ENTRY.pack(len(doc_strings), len(encoded))
+        doc_strings += encoded
+
+    term_table = bytearray()
+    term_strings = bytearray()
+    doc_ids, counts, weights = array("I"), array("I"), array("f")
+    for term, term_doc_ids, term_counts, term_weights in terms:
+        encoded = term.encode("utf-8")
+        term_table += _TERM_ENTRY.pack(len(term_strings), len(encoded), len(doc_ids), len(term_doc_ids),
+                                       max(term_weights, default=0))
+        term_strings += encoded
+        doc_ids.extend(term_doc_ids)
+        counts.extend(term_counts)
+        weights.extend(term_weights)
+
+    doc_table_offset = _HEADER.size
+    term_table_offset = doc_table_offset + len(doc_table) + len(doc_strings)
+    term_strings_offset = term_table_offset + len(term_table)
+    doc_ids_offset = _aligned(term_strings_offset + len(term_strings))
+    counts_offset = doc_ids_offset + 4 * len(doc_ids)
+    weights_offset = counts_offset + 4 * len(counts)
+    lengths_offset = weights_offset + 4 * len(weights)
+    norms_offset = lengths_offset + 4 * len(documents)
+    signatures_offset = norms_offset + 4 * len(documents)
+    header = _HEADER.pack(VECTOR_SEGMENT_MAGIC, VECTOR_SEGMENT_VERSION, flags, len(documents), len(terms),
+                          len(doc_ids), doc_table_offset, term_table_offset, term_strings_offset, doc_ids_offset,
+                          counts_offset, weights_offset, lengths_offset, norms_offset, generation,
+                          signature_bits if signatures else 0, signature_seed, signatures_offset)
+
+    # Written next to the target and renamed, so readers that still have the old segment mapped are not affected.
+    tmp_path = Path(f"{path}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(doc_table)
+        f.write(doc_strings)
+        f.write(term_table)
+        f.write(term_strings)
+        f.write(bytes(doc_ids_offset - term_strings_offset - len(term_strings)))
+        for column in (doc_ids, counts, weights, array("I", lengths), array("f", norms)):
+            column.tofile(f)
+        f.write(signatures)
+    os.replace(tmp_path, path)
+
+
+class VectorSegmentReader:
+    # Nothing is decoded up front: the columns are memoryviews over the mapping, so opening is constant time
+    # and processes searching the same segment share the page cache.
+    def __init__(self, path: Path):
+        if sys.byteorder != "little":
+            raise RuntimeError("Vector segments are only supported on little-endian machines")
+        with open(path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = _MAGIC_AND_VERSION.unpack_from(self._buffer)
+        if magic != VECTOR_SEGMENT_MAGIC or not 1 <= version <= VECTOR_SEGMENT_VERSION:
+            self._buffer.close()
+            raise ValueError(f"{path} is not a supported vector segment")
+        self.version = version
+        if version == VECTOR_SEGMENT_VERSION:
+            header = _HEADER.unpack_from(self._buffer)
+        elif version == 2:
+            header = _HEADER_V2.unpack_from(self._buffer) + (0, 0, 0)
+        else:
+            header = _HEADER_V1.unpack_from(self._buffer) + (0, 0, 0, 0)
+        (_, _, self.flags, self.documents_count, self.terms_count, self.entries_count, self._doc_table_offset,
+         self._term_table_offset, self._term_strings_offset, doc_ids_offset, counts_offset, weights_offset,
+         lengths_offset, norms_offset, self.generation, self.signature_bits, self.signature_seed,
+         signatures_offset) = header
+        self._doc_strings_offset = self._doc_table_offset + self.documents_count * _DOC_ENTRY.size
+        self._view = memoryview(self._buffer)
+        self.doc_ids = self._column(doc_ids_offset, self.entries_count, "I")
+        self.counts = self._column(counts_offset, self.entries_count, "I")
+        self.weights = self._column(weights_offset, self.entries_count, "f")
+        self.lengths = self._column(lengths_offset, self.documents_count, "I")
+        self.norms = self._column(norms_offset, self.documents_count, "f")
+        self.signatures = self._view[signatures_offset:signatures_offset + self.documents_count *
+                                     self.signature_bits // 8]
+
+    def _column(self, offset: int, count: int, item_format: str) -> memoryview:
+        return self._view[offset:offset + 4 * count].cast(item_format)
+
+    def close(self) -> None:
+        for column in (self.doc_ids, self.counts, self.weights, self.lengths, self.norms, self.signatures,
+                       self._view):
+            column.release()
+        self._buffer.close()
+
+    def document_name(self, doc_id: int) -> str:
+        offset, length = _DOC_ENTRY.unpack_from(self._buffer, self._doc_table_offset + doc_id * _DOC_ENTRY.size)
+        start = self._doc_strings_offset + offset
+        return self._buffer[start:start + length].decode("utf-8")
+
+    def document_names(self) -> list[str]:
+        return [self.document_name(doc_id) for doc_id in range(self.documents_count)]
+
+    def _term_entry(self, position: int) -> tuple[int, int, int, int, float]:
+        return _TERM_ENTRY.unpack_from(self._buffer, self._term_table_offset + position * _TERM_ENTRY.size)
+
+    def _term_at(self, position: int) -> bytes:
+        offset, length, *_ = self._term_entry(position)
+        start = self._term_strings_offset + offset
+        return self._buffer[start:start + length]
+
+    def _lower_bound(self, encoded: bytes) -> int:
+        low, high = 0, self.terms_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term_at(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_term(self, term: str) -> Optional[int]:
+        encoded = term.encode("utf-8")
+        position = self._lower_bound(encoded)
+        if position < self.terms_count and self._term_at(position) == encoded:
+            return position
+        return None
+
+    def __contains__(self, term: str) -> bool:
+        return self._find_term(term) is not None
+
+    def document_frequency(self, term: str) -> int:
+        position = self._find_term(term)
+        return 0 if position is None else self._term_entry(position)[3]
+
+    def entries(self, position: int) -> slice:
+        _, _, first, documents, _ = self._term_entry(position)
+        return slice(first, first + documents)
+
+    def weighted_postings(self, term: str) -> Optional[WeightedPostings]:
+        position = self._find_term(term)
+        if position is None:
+            return None
+        *_, max_weight = self._term_entry(position)
+        entries = self.entries(position)
+        return WeightedPostings(self.doc_ids[entries], self.weights[entries], max_weight)
+
+    def term_offsets(self) -> list[int]:
+        # First entry of every term followed by the number of entries, i.e. the index pointer of a
+        # terms x documents matrix.
+        return [self._term_entry(position)[2] for position in range(self.terms_count)] + [self.entries_count]
+
+    def terms_with_prefix(self, prefix: str) -> list[str]:
+        # Byte order keeps every term starting with the prefix in one run after its lower bound.
+        encoded = prefix.encode("utf-8")
+        result = []
+        for position in range(self._lower_bound(encoded), self.terms_count):
+            term = self._term_at(position)
+            if not term.startswith(encoded):
+                break
+            result.append(term.decode("utf-8"))
+        return result
+
+    def terms(self) -> Iterator[str]:
+        for position in range(self.terms_count):
+            yield self._term_at(position).decode("utf-8")
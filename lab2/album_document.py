@@ -1,6 +1,13 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 from datetime import date
-from typing import Optional
+from pathlib import Path
+from typing import Any, Optional, Union
+
+from search_common import profiling
+
+# Files of an album folder, in the order of the Album text fields they fill.
+TEXT_FILES = ("description.txt", "critical_reception.txt", "additional_notes.txt")
+TEXT_FIELDS = ("description", "critical_reception", "additional_notes")
 
 
 @dataclass
@@ -14,4 +21,30 @@ class Album:
     additional_notes: str
 
     _id: Optional[str] = None
-    _score: Optional[float] = None
\ No newline at end of file
+    _score: Optional[float] = None
+
+
+def read_texts(text_path: Path) -> list[str]:
+    res = []
+    for path in TEXT_FILES:
+        with open(text_path / path, "r") as f, profiling.phase("file.read"):
+            res.append(f.read())
+    return res
+
+
+def source_filter(display_texts: bool) -> Union[bool, dict[str, list[str]]]:
+    # The text fields are most of every document; leaving them out on the server saves transfer and parsing.
+    return True if display_texts else {"excludes": list(TEXT_FIELDS)}
+
+
+def album_from_hit(hit: dict[str, Any]) -> Album:
+    # Text fields excluded by source_filter are left empty.
+    return Album(**{**dict.fromkeys(TEXT_FIELDS, ""), **hit["_source"]}, _id=hit["_id"], _score=hit.get("_score"))
+
+
+def to_source(album: Album) -> dict:
+    # _id and _score are hit metadata, not document fields.
+    document = asdict(album)
+    del document["_id"]
+    del document["_score"]
+    return document
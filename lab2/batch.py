@@ -0,0 +1,102 @@
+from typing import Any, Iterable, Iterator, Optional, TextIO
+from dataclasses import dataclass, field
+from itertools import repeat
+from pathlib import Path
+import json
+import time
+
+from elasticsearch import ApiError, Elasticsearch
+from elastic_transport import TransportError
+from search_common import profiling
+
+from album_document import source_filter
+from pipeline import bounded_map, chunks
+from queries import BoolQuery
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 4
+DEFAULT_HITS = 10
+
+
+@dataclass
+class QueryDefinition:
+    id: str
+    query: Optional[BoolQuery]
+    # Set instead of query when the line could not be read.
+    error: Optional[str] = None
+
+
+@dataclass
+class BatchReport:
+    queries: int = 0
+    failed: int = 0
+    seconds: float = 0
+    # Milliseconds Elasticsearch spent on each successful query.
+    took: list[int] = field(default_factory=list)
+
+
+def read_query_definitions(path: Path) -> Iterator[QueryDefinition]:
+    # One JSON object per line: {"id": ..., "clauses": [...]} with clauses as accepted by BoolQuery.from_clauses,
+    # or a query saved by the add-* commands (the content of query.json). The id defaults to the line number.
+    with open(path, "r") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            query_id = str(number)
+            try:
+                data = json.loads(line)
+                query_id = str(data.pop("id", number))
+                query = BoolQuery.from_clauses(data["clauses"]) if "clauses" in data else BoolQuery(**data)
+            except (ValueError, KeyError, TypeError) as e:
+                yield QueryDefinition(query_id, None, repr(e))
+                continue
+            yield QueryDefinition(query_id, query)
+
+
+def _result(definition: QueryDefinition, response: dict[str, Any]) -> dict[str, Any]:
+    if "error" in response:
+        return {"id": definition.id, "error": response["error"]}
+    return {"id": definition.id, "took": response["took"], "total": response["hits"]["total"]["value"],
+            "hits": [{"_id": hit["_id"], "_score": hit["_score"], "_source": hit["_source"]}
+                     for hit in response["hits"]["hits"]]}
+
+
+def _msearch(es: Elasticsearch, index: str, batch: list[QueryDefinition], size: int,
+             display_texts: bool) -> list[dict[str, Any]]:
+    valid = [definition for definition in batch if definition.query is not None]
+    searches = []
+    for definition in valid:
+        searches.append({"index": index})
+        searches.append({"query": definition.query.to_dict(), "size": size, "_source": source_filter(display_texts)})
+    responses: Iterator[dict[str, Any]] = iter(())
+    if searches:
+        try:
+            with profiling.phase("es.msearch"):
+                responses = iter(es.msearch(searches=searches)["responses"])
+        except (ApiError, TransportError) as e:
+            # The whole request failed even after retries; its queries are reported and the batch goes on.
+            responses = repeat({"error": repr(e)})
+    return [_result(definition, next(responses)) if definition.query is not None
+            else {"id": definition.id, "error": definition.error} for definition in batch]
+
+
+def run_batch(es: Elasticsearch, index: str, definitions: Iterable[QueryDefinition], output: TextIO,
+              size: int = DEFAULT_HITS, batch_size: int = DEFAULT_BATCH_SIZE,
+              concurrency: int = DEFAULT_CONCURRENCY, display_texts: bool = False) -> BatchReport:
+    # Up to concurrency _msearch requests of batch_size queries are in flight; results are written in input order
+    # as each request completes, so neither the queries nor the results have to fit in memory.
+    report = BatchReport()
+    start = time.perf_counter()
+    for results in bounded_map(lambda batch: _msearch(es, index, batch, size, display_texts),
+                               chunks(definitions, batch_size), concurrency):
+        for result in results:
+            report.queries += 1
+            if "error" in result:
+                report.failed += 1
+            else:
+                report.took.append(result["took"])
+                profiling.count("es.took_ms", result["took"])
+            output.write(json.dumps(result, default=str) + "\n")
+        output.flush()
+    report.seconds = time.perf_counter() - start
+    return report
@@ -0,0 +1,131 @@
+from typing import Any, Iterable, Iterator, Optional, TextIO
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date
+from pathlib import Path
+from uuid import uuid4
+import csv
+import json
+import sys
+import time
+
+from elasticsearch import Elasticsearch, helpers
+from search_common import profiling
+
+from album_document import Album, TEXT_FILES, read_texts, to_source
+from local_engine import LocalEngine
+from pipeline import bounded_map, chunks
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_PARALLELISM = 4
+# Separates the musicians of one album in a CSV manifest.
+CSV_LIST_SEPARATOR = ";"
+
+
+@dataclass
+class ChunkReport:
+    number: int
+    documents: int
+    seconds: float
+    failed: list[dict[str, Any]] = field(default_factory=list)
+
+
+@dataclass
+class BulkReport:
+    documents: int = 0
+    seconds: float = 0
+    # Manifest rows that could not be turned into documents, e.g. because their folder is missing.
+    skipped: list[str] = field(default_factory=list)
+    failed: list[dict[str, Any]] = field(default_factory=list)
+
+
+def read_manifest(path: Path) -> Iterator[dict[str, Any]]:
+    # One row per album: album_name, release_date (ISO date), musicians, box_office, folder (relative to the
+    # texts directory) and optionally id. CSV manifests separate musicians with CSV_LIST_SEPARATOR, JSON lines
+    # manifests hold a list.
+    with open(path, "r", newline="") as f:
+        if path.suffix.lower() == ".csv":
+            for row in csv.DictReader(f):
+                row["musicians"] = [name.strip() for name in row["musicians"].split(CSV_LIST_SEPARATOR)
+                                    if name.strip()]
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _album_folders(texts_path: Path) -> set[Path]:
+    return {path.parent.relative_to(texts_path) for path in texts_path.rglob(TEXT_FILES[0])}
+
+
+def iter_actions(manifest_path: Path, texts_path: Path, report: BulkReport) -> Iterator[dict[str, Any]]:
+    folders = _album_folders(texts_path)
+    for row in read_manifest(manifest_path):
+        folder = Path(row["folder"])
+        try:
+            texts = read_texts(texts_path / folder)
+            album = Album(album_name=row["album_name"], release_date=date.fromisoformat(row["release_date"]),
+                          musicians=row["musicians"], box_office=int(row["box_office"]), description=texts[0],
+                          critical_reception=texts[1], additional_notes=texts[2])
+        except (OSError, KeyError, ValueError) as e:
+            report.skipped.append(f"{row.get('album_name', folder)}: {e!r}")
+            continue
+        folders.discard(folder)
+        yield {"_id": row.get("id") or str(uuid4()), "_source": to_source(album)}
+    for folder in sorted(folders):
+        report.skipped.append(f"{folder}: not in the manifest")
+
+
+@contextmanager
+def bulk_load_settings(es: Elasticsearch, index: str) -> Iterator[None]:
+    # Refreshing and replicating every chunk is wasted work while nothing searches the index; both are restored
+    # (a missing setting back to the cluster default) and the index refreshed once at the end.
+    with profiling.phase("es.settings"):
+        settings = es.indices.get_settings(index=index)[index]["settings"]["index"]
+        es.indices.put_settings(index=index, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    try:
+        yield
+    finally:
+        with profiling.phase("es.settings"):
+            es.indices.put_settings(index=index, settings={"index": {
+                "refresh_interval": settings.get("refresh_interval"),
+                "number_of_replicas": settings.get("number_of_replicas"),
+            }})
+            es.indices.refresh(index=index)
+
+
+def _send_chunk(es: Elasticsearch, index: str, number: int, chunk: list[dict[str, Any]]) -> ChunkReport:
+    start = time.perf_counter()
+    with profiling.phase("es.bulk"):
+        if isinstance(es, LocalEngine):
+            # There is no transport for the helper to go through; the engine applies the actions directly.
+            errors = es.apply_actions(index, chunk)
+        else:
+            _, errors = helpers.bulk(es, chunk, index=index, chunk_size=len(chunk), raise_on_error=False,
+                                     raise_on_exception=False)
+    return ChunkReport(number, len(chunk), time.perf_counter() - start, errors)
+
+
+def _print_chunk(chunk: ChunkReport, out: TextIO) -> None:
+    rate = chunk.documents / chunk.seconds if chunk.seconds else 0
+    print(f"chunk {chunk.number}: {chunk.documents} documents in {chunk.seconds:.2f}s ({rate:.0f} docs/s), "
+          f"{len(chunk.failed)} failed", file=out)
+
+
+def bulk_index(es: Elasticsearch, index: str, actions: Iterable[dict[str, Any]],
+               chunk_size: int = DEFAULT_CHUNK_SIZE, parallelism: int = DEFAULT_PARALLELISM,
+               report: Optional[BulkReport] = None, out: TextIO = sys.stdout) -> BulkReport:
+    report = report if report is not None else BulkReport()
+    start = time.perf_counter()
+    numbered_chunks = enumerate(chunks(actions, chunk_size), start=1)
+    with bulk_load_settings(es, index):
+        for chunk in bounded_map(lambda numbered: _send_chunk(es, index, *numbered), numbered_chunks,
+                                 parallelism):
+            report.documents += chunk.documents
+            report.failed.extend(chunk.failed)
+            profiling.count("bulk.documents", chunk.documents)
+            profiling.count("bulk.failed", len(chunk.failed))
+            _print_chunk(chunk, out)
+    report.seconds = time.perf_counter() - start
+    return report
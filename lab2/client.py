@@ -0,0 +1,137 @@
+from typing import Any, Collection, Optional, Union
+import asyncio
+import random
+import threading
+import time
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from elastic_transport import (AsyncTransport, ConnectionError, ConnectionTimeout, Transport,
+                               TransportApiResponse)
+from elastic_transport.client_utils import DEFAULT, resolve_default
+
+from config import (ELASTIC_CA_CERTS, ELASTIC_CONNECTIONS_PER_NODE, ELASTIC_HOSTS, ELASTIC_MAX_RETRIES,
+                    ELASTIC_MAX_RETRY_BACKOFF, ELASTIC_PASSWORD, ELASTIC_REQUEST_TIMEOUT, ELASTIC_RETRY_BACKOFF,
+                    ELASTIC_USER, SEARCH_BACKEND)
+from local_engine import LocalEngine
+
+# Overloaded or restarting nodes; retrying them right away only adds to the load.
+RETRY_ON_STATUS = (429, 502, 503, 504)
+
+_lock = threading.Lock()
+_client: Optional[Union[Elasticsearch, LocalEngine]] = None
+_async_client: Optional[AsyncElasticsearch] = None
+
+
+def _backoff(attempt: int) -> float:
+    # Exponential with jitter, so clients that failed together do not retry together.
+    return min(ELASTIC_MAX_RETRY_BACKOFF, ELASTIC_RETRY_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+def _should_retry(attempt: int, max_retries: int, response: Optional[TransportApiResponse], timed_out: bool,
+                  retry_on_timeout: bool, retry_on_status: Collection[int]) -> bool:
+    if attempt >= max_retries:
+        return False
+    if response is None:
+        # Connection errors are always retried, on another node if there is one; timeouts only when asked to.
+        return retry_on_timeout or not timed_out
+    return response.meta.status in retry_on_status
+
+
+def _retry_options(transport: Union[Transport, AsyncTransport],
+                   kwargs: dict[str, Any]) -> tuple[int, bool, Collection[int]]:
+    # Per request options (client.options(...)) win over the ones the client was created with.
+    return (resolve_default(kwargs.pop("max_retries", DEFAULT), transport.max_retries),
+            resolve_default(kwargs.pop("retry_on_timeout", DEFAULT), transport.retry_on_timeout),
+            resolve_default(kwargs.pop("retry_on_status", DEFAULT), transport.retry_on_status))
+
+
+class BackoffTransport(Transport):
+    # The default transport retries immediately; here every attempt is a single try of the underlying transport
+    # (which still fails over to another node) followed by a growing pause.
+    def perform_request(self, method: str, target: str, **kwargs: Any) -> TransportApiResponse:
+        max_retries, retry_on_timeout, retry_on_status = _retry_options(self, kwargs)
+        attempt = 0
+        while True:
+            try:
+                response = super().perform_request(method, target, max_retries=0, retry_on_timeout=retry_on_timeout,
+                                                   retry_on_status=retry_on_status, **kwargs)
+            except (ConnectionError, ConnectionTimeout) as error:
+                if not _should_retry(attempt, max_retries, None, isinstance(error, ConnectionTimeout),
+                                     retry_on_timeout, retry_on_status):
+                    raise
+            else:
+                if not _should_retry(attempt, max_retries, response, False, retry_on_timeout, retry_on_status):
+                    return response
+            time.sleep(_backoff(attempt))
+            attempt += 1
+
+
+class AsyncBackoffTransport(AsyncTransport):
+    async def perform_request(self, method: str, target: str, **kwargs: Any) -> TransportApiResponse:
+        max_retries, retry_on_timeout, retry_on_status = _retry_options(self, kwargs)
+        attempt = 0
+        while True:
+            try:
+                response = await super().perform_request(method, target, max_retries=0,
+                                                         retry_on_timeout=retry_on_timeout,
+                                                         retry_on_status=retry_on_status, **kwargs)
+            except (ConnectionError, ConnectionTimeout) as error:
+                if not _should_retry(attempt, max_retries, None, isinstance(error, ConnectionTimeout),
+                                     retry_on_timeout, retry_on_status):
+                    raise
+            else:
+                if not _should_retry(attempt, max_retries, response, False, retry_on_timeout, retry_on_status):
+                    return response
+            await asyncio.sleep(_backoff(attempt))
+            attempt += 1
+
+
+def _client_options() -> dict[str, Any]:
+    return {
+        "hosts": ELASTIC_HOSTS,
+        "basic_auth": (ELASTIC_USER, ELASTIC_PASSWORD),
+        "verify_certs": True,
+        "ca_certs": ELASTIC_CA_CERTS,
+        "connections_per_node": ELASTIC_CONNECTIONS_PER_NODE,
+        "request_timeout": ELASTIC_REQUEST_TIMEOUT,
+        "max_retries": ELASTIC_MAX_RETRIES,
+        "retry_on_timeout": True,
+        "retry_on_status": RETRY_ON_STATUS,
+    }
+
+
+def get_client() -> Union[Elasticsearch, LocalEngine]:
+    # One client per process: its connection pool keeps connections (and their TLS sessions) alive between
+    # requests and is safe to share between threads. With the local backend it is the in-process engine instead.
+    global _client
+    with _lock:
+        if _client is None and SEARCH_BACKEND == "local":
+            _client = LocalEngine.load()
+        elif _client is None:
+            _client = Elasticsearch(transport_class=BackoffTransport, **_client_options())
+        return _client
+
+
+def get_async_client() -> AsyncElasticsearch:
+    # Needs aiohttp (the "async" extra). The client belongs to the event loop that first uses it.
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            _async_client = AsyncElasticsearch(transport_class=AsyncBackoffTransport, **_client_options())
+        return _async_client
+
+
+def close_client() -> None:
+    global _client
+    with _lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+
+
+async def close_async_client() -> None:
+    global _async_client
+    with _lock:
+        client, _async_client = _async_client, None
+    if client is not None:
+        await client.close()
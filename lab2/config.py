@@ -6,4 +6,16 @@ load_dotenv(find_dotenv())
 
 ELASTIC_USER = os.environ.get("ELASTIC_USER")
 ELASTIC_PASSWORD = os.environ.get("ELASTIC_PASSWORD")
+# Comma separated; requests are spread over the nodes and fail over between them.
+ELASTIC_HOSTS = os.environ.get("ELASTIC_HOSTS", "https://localhost:9200").split(",")
+ELASTIC_CA_CERTS = os.environ.get("ELASTIC_CA_CERTS", "./http_ca.crt")
+# Kept-alive connections per node shared by every thread of the process.
+ELASTIC_CONNECTIONS_PER_NODE = int(os.environ.get("ELASTIC_CONNECTIONS_PER_NODE", 10))
+ELASTIC_REQUEST_TIMEOUT = float(os.environ.get("ELASTIC_REQUEST_TIMEOUT", 30))
+ELASTIC_MAX_RETRIES = int(os.environ.get("ELASTIC_MAX_RETRIES", 3))
+# Seconds before the first retry, doubled for every further one up to ELASTIC_MAX_RETRY_BACKOFF.
+ELASTIC_RETRY_BACKOFF = float(os.environ.get("ELASTIC_RETRY_BACKOFF", 0.5))
+ELASTIC_MAX_RETRY_BACKOFF = float(os.environ.get("ELASTIC_MAX_RETRY_BACKOFF", 30))
 INDEX = "lab_index"
+# "elasticsearch", or "local" to run every command against the in-process engine of local_engine.py.
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "elasticsearch")
@@ -0,0 +1,45 @@
+from typing import Any, Iterator, TextIO, Union
+import json
+
+from elasticsearch import Elasticsearch
+
+from search_common import profiling
+
+DEFAULT_PAGE_SIZE = 1000
+# How long the point in time is kept between two pages.
+KEEP_ALIVE = "1m"
+
+
+def iter_hits(es: Elasticsearch, index: str, query: dict[str, Any], page_size: int = DEFAULT_PAGE_SIZE,
+              source: Union[bool, dict[str, list[str]]] = True) -> Iterator[dict[str, Any]]:
+    # Every hit of the query, one page in memory at a time. The point in time keeps the pages consistent while
+    # the index changes, and search_after continues from the last hit instead of skipping over from + size hits.
+    # Hits come in index order, which is the cheapest sort; scores are not computed.
+    with profiling.phase("es.open_point_in_time"):
+        pit_id = es.open_point_in_time(index=index, keep_alive=KEEP_ALIVE)["id"]
+    try:
+        search_after = None
+        while True:
+            with profiling.phase("es.search"):
+                response = es.search(pit={"id": pit_id, "keep_alive": KEEP_ALIVE}, query=query, size=page_size,
+                                     sort=["_shard_doc"], search_after=search_after, source=source,
+                                     track_total_hits=False)
+            profiling.count("es.took_ms", response["took"])
+            pit_id = response.get("pit_id", pit_id)
+            hits = response["hits"]["hits"]
+            if not hits:
+                return
+            yield from hits
+            search_after = hits[-1]["sort"]
+    finally:
+        with profiling.phase("es.close_point_in_time"):
+            es.close_point_in_time(id=pit_id)
+
+
+def export_hits(es: Elasticsearch, index: str, query: dict[str, Any], output: TextIO,
+                page_size: int = DEFAULT_PAGE_SIZE, source: Union[bool, dict[str, list[str]]] = True) -> int:
+    exported = 0
+    for hit in iter_hits(es, index, query, page_size, source):
+        output.write(json.dumps({"_id": hit["_id"], "_source": hit["_source"]}, default=str) + "\n")
+        exported += 1
+    return exported
@@ -0,0 +1,545 @@
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from datetime import date, datetime
+from math import log
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+from search_common import analysis, profiling
+
+LOCAL_INDEX_PATH = "local_index.json"
+
+# BM25 parameters, the Elasticsearch defaults.
+K1 = 1.2
+B = 0.75
+# Fuzzy queries are rewritten to at most this many of the closest terms, like Elasticsearch's max_expansions.
+MAX_EXPANSIONS = 50
+NGRAM = 3
+
+Scores = dict[int, float]
+
+
+class LocalEngineError(ValueError):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        # HTTP status Elasticsearch answers the same request with.
+        self.status = status
+
+
+def _keyword_analyzer(value: str) -> list[str]:
+    return [value]
+
+
+# Analyzers named in the mapping; text fields with an analyzer missing here are analyzed like standard.
+ANALYZERS: dict[str, Callable[[str], list[str]]] = {name: analyzer.analyze
+                                                    for name, analyzer in analysis.ANALYZERS.items()}
+
+
+def _values(value: Any) -> list[Any]:
+    # Arrays index every element, like Elasticsearch does.
+    return value if isinstance(value, list) else [value]
+
+
+def fuzziness_distance(fuzziness: Union[int, str, None], term: str) -> int:
+    if fuzziness is None or str(fuzziness).upper() == "AUTO":
+        # AUTO:3,6
+        return 0 if len(term) < 3 else 1 if len(term) < 6 else 2
+    return int(fuzziness)
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    # Levenshtein distance with adjacent transpositions (Elasticsearch's default), cut off at limit + 1.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous: list[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def _ngrams(term: str) -> set[str]:
+    padded = "\0" * (NGRAM - 1) + term + "\0" * (NGRAM - 1)
+    return {padded[start:start + NGRAM] for start in range(len(padded) - NGRAM + 1)}
+
+
+class FuzzyTermIndex:
+    # N-gram index over a term dictionary. A term within k edits of the query shares all but at most
+    # k * (NGRAM + 1) of the query's n-grams (a transposition can break one more than a substitution), so only
+    # terms reaching that count are verified with the edit distance.
+    def __init__(self, terms: Iterable[str]):
+        self._terms_by_ngram: dict[str, list[str]] = defaultdict(list)
+        self._terms_by_length: dict[int, list[str]] = defaultdict(list)
+        for term in terms:
+            for ngram in _ngrams(term):
+                self._terms_by_ngram[ngram].append(term)
+            self._terms_by_length[len(term)].append(term)
+
+    def _candidates(self, term: str, distance: int) -> Iterable[str]:
+        ngrams = _ngrams(term)
+        required = len(ngrams) - distance * (NGRAM + 1)
+        if required <= 0:
+            # Short terms: the filter would let everything through, the length bound is tighter.
+            return (candidate for length in range(len(term) - distance, len(term) + distance + 1)
+                    for candidate in self._terms_by_length.get(length, ()))
+        shared = Counter(candidate for ngram in ngrams for candidate in self._terms_by_ngram.get(ngram, ()))
+        return (candidate for candidate, count in shared.items() if count >= required)
+
+    def expand(self, term: str, distance: int) -> list[tuple[str, int]]:
+        # (term, edits) of the closest terms within distance.
+        matches = []
+        for candidate in self._candidates(term, distance):
+            edits = edit_distance(term, candidate, distance)
+            if edits <= distance:
+                matches.append((candidate, edits))
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return matches[:MAX_EXPANSIONS]
+
+
+class InvertedField:
+    # Text and keyword fields: term -> doc -> occurrences. Keyword fields index whole values and have no length
+    # normalisation, as with norms disabled in Elasticsearch.
+    def __init__(self, analyzer: Callable[[str], list[str]], norms: bool):
+        self.analyzer = analyzer
+        self.norms = norms
+        self.postings: dict[str, dict[int, int]] = defaultdict(dict)
+        self.lengths: dict[int, int] = {}
+        self._total_length = 0
+        self._fuzzy: Optional[FuzzyTermIndex] = None
+
+    def _tokens(self, value: Any) -> list[str]:
+        return [token for element in _values(value) if element is not None for token in self.analyzer(str(element))]
+
+    def add(self, doc: int, value: Any) -> None:
+        tokens = self._tokens(value)
+        for term, occurrences in Counter(tokens).items():
+            if term not in self.postings:
+                self._fuzzy = None
+            self.postings[term][doc] = occurrences
+        self.lengths[doc] = len(tokens)
+        self._total_length += len(tokens)
+
+    def remove(self, doc: int, value: Any) -> None:
+        for term in set(self._tokens(value)):
+            self.postings[term].pop(doc, None)
+            if not self.postings[term]:
+                del self.postings[term]
+                self._fuzzy = None
+        self._total_length -= self.lengths.pop(doc, 0)
+
+    def term_scores(self, term: str) -> Scores:
+        documents = self.postings.get(term)
+        if not documents:
+            return {}
+        count = len(self.lengths)
+        idf = log(1 + (count - len(documents) + 0.5) / (len(documents) + 0.5))
+        average_length = self._total_length / count if count else 0
+        scores = {}
+        for doc, occurrences in documents.items():
+            normalisation = 1 - B + B * self.lengths[doc] / average_length if self.norms and average_length else 1
+            scores[doc] = idf * occurrences * (K1 + 1) / (occurrences + K1 * normalisation)
+        return scores
+
+    def fuzzy_scores(self, term: str, fuzziness: Union[int, str, None]) -> Scores:
+        # Each document scores with its best matching expansion.
+        if self._fuzzy is None:
+            self._fuzzy = FuzzyTermIndex(self.postings)
+        scores: Scores = {}
+        for expansion, _ in self._fuzzy.expand(term, fuzziness_distance(fuzziness, term)):
+            for doc, score in self.term_scores(expansion).items():
+                scores[doc] = max(scores.get(doc, 0), score)
+        return scores
+
+    def match_scores(self, text: str, fuzziness: Union[int, str, None] = None,
+                     operator: str = "or") -> Scores:
+        terms = self.analyzer(text)
+        per_term = [self.term_scores(term) if fuzziness is None else self.fuzzy_scores(term, fuzziness)
+                    for term in terms]
+        scores: Scores = {}
+        for term_scores in per_term:
+            for doc, score in term_scores.items():
+                scores[doc] = scores.get(doc, 0) + score
+        if operator.lower() == "and":
+            scores = {doc: score for doc, score in scores.items()
+                      if all(doc in term_scores for term_scores in per_term)}
+        return scores
+
+
+class SortedField:
+    # Numeric and date fields: values kept sorted next to their doc, so ranges are two binary searches.
+    def __init__(self, parse: Callable[[Any], float]):
+        self.parse = parse
+        self.values: list[float] = []
+        self.docs: list[int] = []
+
+    def add(self, doc: int, value: Any) -> None:
+        for element in _values(value):
+            if element is None:
+                continue
+            parsed = self.parse(element)
+            position = bisect_right(self.values, parsed)
+            self.values.insert(position, parsed)
+            self.docs.insert(position, doc)
+
+    def remove(self, doc: int, value: Any) -> None:
+        for element in _values(value):
+            if element is None:
+                continue
+            parsed = self.parse(element)
+            position = bisect_left(self.values, parsed)
+            while self.docs[position] != doc:
+                position += 1
+            del self.values[position]
+            del self.docs[position]
+
+    def range_docs(self, gte: Any = None, lte: Any = None, gt: Any = None, lt: Any = None) -> set[int]:
+        start, end = 0, len(self.values)
+        if gte is not None:
+            start = max(start, bisect_left(self.values, self.parse(gte)))
+        if gt is not None:
+            start = max(start, bisect_right(self.values, self.parse(gt)))
+        if lte is not None:
+            end = min(end, bisect_right(self.values, self.parse(lte)))
+        if lt is not None:
+            end = min(end, bisect_left(self.values, self.parse(lt)))
+        return set(self.docs[start:end])
+
+
+def _parse_date(value: Any) -> float:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day).timestamp()
+    return datetime.fromisoformat(str(value)).timestamp()
+
+
+def _create_field(properties: dict[str, Any]) -> Union[InvertedField, SortedField]:
+    kind = properties["type"]
+    if kind == "text":
+        return InvertedField(ANALYZERS.get(properties.get("analyzer", "standard"), ANALYZERS["standard"]), norms=True)
+    if kind == "keyword":
+        return InvertedField(_keyword_analyzer, norms=False)
+    if kind in ("integer", "long", "float", "double"):
+        return SortedField(float)
+    if kind == "date":
+        return SortedField(_parse_date)
+    raise LocalEngineError(f"Unsupported field type {kind!r}")
+
+
+RANGE_BOUNDS = {"gte", "lte", "gt", "lt"}
+# Dates are parsed as ISO 8601 and ranges never add to the score, so these are accepted without effect.
+RANGE_IGNORED_OPTIONS = {"format", "boost"}
+
+
+def _field_query(body: dict[str, Any], value_key: str) -> tuple[str, dict[str, Any]]:
+    # {"field": value} or {"field": {value_key: value, ...options}}
+    (field, value), = body.items()
+    return field, value if isinstance(value, dict) else {value_key: value}
+
+
+class LocalIndex:
+    def __init__(self, mappings: Optional[dict[str, Any]] = None, settings: Optional[dict[str, Any]] = None):
+        self.mappings = mappings or {"properties": {}}
+        self.settings = settings or {}
+        # Doc numbers are positions in _sources; removed documents leave None behind.
+        self._sources: list[Optional[tuple[str, dict[str, Any]]]] = []
+        self._docs: dict[str, int] = {}
+        self._fields = {name: _create_field(properties)
+                        for name, properties in self.mappings.get("properties", {}).items()}
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def documents(self) -> Iterator[tuple[str, dict[str, Any]]]:
+        return (entry for entry in self._sources if entry is not None)
+
+    def add(self, id: str, source: dict[str, Any]) -> str:
+        result = "updated" if self.remove(id) else "created"
+        doc = len(self._sources)
+        self._sources.append((id, source))
+        self._docs[id] = doc
+        for name, value in source.items():
+            field = self._fields.get(name)
+            if field is not None:
+                field.add(doc, value)
+        return result
+
+    def remove(self, id: str) -> bool:
+        doc = self._docs.pop(id, None)
+        if doc is None:
+            return False
+        _, source = self._sources[doc]
+        for name, value in source.items():
+            field = self._fields.get(name)
+            if field is not None:
+                field.remove(doc, value)
+        self._sources[doc] = None
+        return True
+
+    def _field(self, name: str, kind: type) -> Any:
+        field = self._fields.get(name)
+        if not isinstance(field, kind):
+            raise LocalEngineError(f"Field {name!r} does not support this query")
+        return field
+
+    def evaluate(self, query: dict[str, Any]) -> Scores:
+        # Matching docs with their scores; filter and must_not clauses and ranges do not add to the score.
+        (kind, body), = query.items()
+        if kind == "match_all":
+            return dict.fromkeys(self._docs.values(), 1.0)
+        if kind == "bool":
+            return self._evaluate_bool(body)
+        if kind == "range":
+            field, options = _field_query(body, "gte")
+            unknown = options.keys() - RANGE_BOUNDS - RANGE_IGNORED_OPTIONS
+            if unknown:
+                raise LocalEngineError(f"Unsupported range options {sorted(unknown)!r}")
+            bounds = {key: value for key, value in options.items() if key in RANGE_BOUNDS}
+            return dict.fromkeys(self._field(field, SortedField).range_docs(**bounds), 1.0)
+        if kind == "term":
+            field, options = _field_query(body, "value")
+            if isinstance(self._fields.get(field), SortedField):
+                return dict.fromkeys(self._fields[field].range_docs(options["value"], options["value"]), 1.0)
+            return self._field(field, InvertedField).term_scores(str(options["value"]))
+        if kind == "match":
+            field, options = _field_query(body, "query")
+            return self._field(field, InvertedField).match_scores(str(options["query"]), options.get("fuzziness"),
+                                                                  options.get("operator", "or"))
+        if kind == "fuzzy":
+            field, options = _field_query(body, "value")
+            return self._field(field, InvertedField).fuzzy_scores(str(options["value"]), options.get("fuzziness"))
+        raise LocalEngineError(f"Unsupported query {kind!r}")
+
+    def _evaluate_bool(self, body: dict[str, Any]) -> Scores:
+        must = [self.evaluate(clause) for clause in _values(body.get("must", []))]
+        filters = [self.evaluate(clause) for clause in _values(body.get("filter", []))]
+        should = [self.evaluate(clause) for clause in _values(body.get("should", []))]
+        excluded = set()
+        for clause in _values(body.get("must_not", [])):
+            excluded.update(self.evaluate(clause))
+        required = must + filters
+        if required:
+            # Smallest first, so the intersection never grows.
+            required.sort(key=len)
+            candidates = set(required[0]).intersection(*required[1:])
+        elif should:
+            # Without must or filter clauses at least one should clause has to match.
+            candidates = set().union(*should)
+        else:
+            candidates = set(self._docs.values())
+        candidates -= excluded
+        if not must and not should:
+            return dict.fromkeys(candidates, 0.0 if filters else 1.0)
+        return {doc: sum(scores.get(doc, 0) for scores in must + should) for doc in candidates}
+
+    def search(self, query: Optional[dict[str, Any]], size: int = 10,
+               sort: Optional[list[Any]] = None, search_after: Optional[list[Any]] = None) -> tuple[int, list[dict]]:
+        with profiling.phase("local.evaluate"):
+            scores = self.evaluate(query or {"match_all": {}})
+        if sort == ["_shard_doc"]:
+            # Index order, used for paging through every hit.
+            docs = sorted(doc for doc in scores if search_after is None or doc > search_after[0])
+        elif sort is None:
+            docs = sorted(scores, key=lambda doc: (-scores[doc], doc))
+        else:
+            raise LocalEngineError(f"Unsupported sort {sort!r}")
+        hits = []
+        for doc in docs[:size]:
+            id, source = self._sources[doc]
+            hit = {"_index": None, "_id": id, "_score": scores[doc], "_source": source}
+            if sort is not None:
+                hit["_score"], hit["sort"] = None, [doc]
+            hits.append(hit)
+        return len(scores), hits
+
+
+def _filter_source(source: dict[str, Any], source_filter: Union[bool, dict[str, list[str]]]) -> dict[str, Any]:
+    if source_filter is True:
+        return source
+    if source_filter is False:
+        return {}
+    includes = source_filter.get("includes")
+    excludes = set(source_filter.get("excludes", ()))
+    return {key: value for key, value in source.items()
+            if key not in excludes and (includes is None or key in includes)}
+
+
+class _LocalIndices:
+    def __init__(self, engine: 'LocalEngine', ignore_status: Iterable[int] = ()):
+        self._engine = engine
+        self._ignore_status = set(ignore_status)
+
+    def _fail(self, status: int, message: str) -> dict:
+        if status in self._ignore_status:
+            return {"acknowledged": False}
+        raise LocalEngineError(message, status)
+
+    def create(self, index: str, mappings: Optional[dict] = None, settings: Optional[dict] = None, **_) -> dict:
+        with self._engine.lock:
+            if index in self._engine.indexes:
+                return self._fail(400, f"Index {index!r} already exists")
+            self._engine.indexes[index] = LocalIndex(mappings, settings)
+            self._engine.changed = True
+        return {"acknowledged": True, "index": index}
+
+    def delete(self, index: str, **_) -> dict:
+        with self._engine.lock:
+            if self._engine.indexes.pop(index, None) is None:
+                return self._fail(404, f"No index {index!r}")
+            self._engine.changed = True
+        return {"acknowledged": True}
+
+    def get_settings(self, index: str, **_) -> dict:
+        return {index: {"settings": {"index": dict(self._engine.index_named(index).settings.get("index", {}))}}}
+
+    def put_settings(self, index: str, settings: dict, **_) -> dict:
+        # Refresh and replica settings have no effect here, they are only kept for get_settings.
+        with self._engine.lock:
+            stored = self._engine.index_named(index).settings.setdefault("index", {})
+            for key, value in settings.get("index", {}).items():
+                if value is None:
+                    stored.pop(key, None)
+                else:
+                    stored[key] = value
+            self._engine.changed = True
+        return {"acknowledged": True}
+
+    def refresh(self, index: str, **_) -> dict:
+        return {}
+
+
+class _LocalOptions:
+    # What es.options(ignore_status=...) returns: the same engine, with the given statuses not raised.
+    def __init__(self, engine: 'LocalEngine', ignore_status: Iterable[int]):
+        self._engine = engine
+        self.indices = _LocalIndices(engine, ignore_status)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._engine, name)
+
+
+class LocalEngine:
+    # Answers the subset of the Elasticsearch client API the CLI uses from indexes kept in this process. Documents
+    # are stored in a JSON file and the field indexes are rebuilt when it is loaded, which suits small catalogues
+    # and tests.
+    def __init__(self, path: Path = Path(LOCAL_INDEX_PATH)):
+        self.path = path
+        self.indexes: dict[str, LocalIndex] = {}
+        self.changed = False
+        self.lock = threading.RLock()
+        self.indices = _LocalIndices(self)
+
+    def options(self, ignore_status: Union[int, Iterable[int]] = (), **_) -> Union['LocalEngine', _LocalOptions]:
+        if not ignore_status:
+            return self
+        return _LocalOptions(self, [ignore_status] if isinstance(ignore_status, int) else ignore_status)
+
+    def index_named(self, index: str) -> LocalIndex:
+        local_index = self.indexes.get(index)
+        if local_index is None:
+            # Elasticsearch creates missing indexes on the first write, with dynamic mappings; the mapping has to
+            # be set first here.
+            raise LocalEngineError(f"No index {index!r}, run set-mapping first", 404)
+        return local_index
+
+    def index(self, index: str, document: dict[str, Any], id: Optional[str] = None, **_) -> dict:
+        with self.lock, profiling.phase("local.index"):
+            id = id if id is not None else os.urandom(10).hex()
+            result = self.index_named(index).add(id, json.loads(json.dumps(document, default=str)))
+            self.changed = True
+        return {"_index": index, "_id": id, "result": result}
+
+    def delete(self, index: str, id: str, **_) -> dict:
+        with self.lock:
+            removed = self.index_named(index).remove(id)
+            self.changed = self.changed or removed
+        return {"_index": index, "_id": id, "result": "deleted" if removed else "not_found"}
+
+    def apply_actions(self, index: str, actions: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
+        # Index actions as passed to helpers.bulk; returns the failed ones in the same shape as the helper does.
+        errors = []
+        for action in actions:
+            try:
+                self.index(action.get("_index", index), action["_source"], action.get("_id"))
+            except LocalEngineError as e:
+                errors.append({"index": {"_id": action.get("_id"), "status": e.status, "error": str(e)}})
+        return errors
+
+    def search(self, index: Optional[str] = None, query: Optional[dict[str, Any]] = None, size: int = 10,
+               source: Union[bool, dict[str, list[str]]] = True, sort: Optional[list[Any]] = None,
+               search_after: Optional[list[Any]] = None, pit: Optional[dict[str, Any]] = None, **_) -> dict:
+        start = time.perf_counter()
+        if pit is not None:
+            index = pit["id"]
+        with self.lock:
+            total, hits = self.index_named(index).search(query, size, sort, search_after)
+        for hit in hits:
+            hit["_index"] = index
+            hit["_source"] = _filter_source(hit["_source"], source)
+        response = {"took": int((time.perf_counter() - start) * 1000), "timed_out": False,
+                    "hits": {"total": {"value": total, "relation": "eq"},
+                             "max_score": max((hit["_score"] or 0 for hit in hits), default=None), "hits": hits}}
+        if pit is not None:
+            response["pit_id"] = index
+        return response
+
+    def msearch(self, searches: list[dict[str, Any]], index: Optional[str] = None, **_) -> dict:
+        start = time.perf_counter()
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                body = {"source": body["_source"], **body} if "_source" in body else body
+                body.pop("_source", None)
+                responses.append({**self.search(header.get("index", index), **body), "status": 200})
+            except LocalEngineError as e:
+                responses.append({"error": {"type": "local_engine_exception", "reason": str(e)},
+                                  "status": e.status})
+        return {"took": int((time.perf_counter() - start) * 1000), "responses": responses}
+
+    def open_point_in_time(self, index: str, **_) -> dict:
+        # Documents only change through this process, so the index itself is the point in time.
+        self.index_named(index)
+        return {"id": index}
+
+    def close_point_in_time(self, id: str, **_) -> dict:
+        return {"succeeded": True}
+
+    @classmethod
+    def load(cls, path: Path = Path(LOCAL_INDEX_PATH)) -> 'LocalEngine':
+        engine = cls(path)
+        try:
+            with open(path, "r") as f, profiling.phase("json.load"):
+                data = json.load(f)
+        except FileNotFoundError:
+            return engine
+        with profiling.phase("local.build"):
+            for name, stored in data.items():
+                local_index = engine.indexes[name] = LocalIndex(stored["mappings"], stored["settings"])
+                for id, source in stored["documents"]:
+                    local_index.add(id, source)
+        return engine
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.changed:
+                return
+            data = {name: {"mappings": local_index.mappings, "settings": local_index.settings,
+                           "documents": list(local_index.documents())}
+                    for name, local_index in self.indexes.items()}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f, profiling.phase("json.dump"):
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+            self.changed = False
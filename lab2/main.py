@@ -1,28 +1,46 @@
 from elasticsearch import Elasticsearch
-from config import ELASTIC_USER, ELASTIC_PASSWORD, INDEX
+from config import INDEX
+from mapping import INDEX_MAPPING, INDEX_SETTINGS
+from client import close_client, get_client
 from typing import Optional, Generator
 import typer
 from datetime import datetime
-from album_document import Album
-from dataclasses import asdict
+from album_document import Album, album_from_hit, read_texts, source_filter, to_source
 from uuid import uuid4, UUID
 from enum import Enum
 from queries import BoolQuery, QueryOption
 from contextlib import contextmanager
 from pathlib import Path
+from search_common import profiling
+from batch import (DEFAULT_BATCH_SIZE, DEFAULT_CONCURRENCY, DEFAULT_HITS, read_query_definitions,
+                   run_batch)
+from export import DEFAULT_PAGE_SIZE, export_hits
+from bulk import BulkReport, DEFAULT_CHUNK_SIZE, DEFAULT_PARALLELISM, bulk_index as run_bulk_index, iter_actions
 
 app = typer.Typer()
 
 
+@app.callback()
+def main(
+        ctx: typer.Context,
+        profile: bool = typer.Option(False, help="Print a per-phase time, memory and counter breakdown."),
+        profile_output: Optional[Path] = typer.Option(None, help="Also run cProfile and write its stats here."),
+):
+    ctx.call_on_close(close_client)
+    if profile or profile_output is not None:
+        profiling.enable(profile_output)
+        ctx.call_on_close(profiling.report)
+
+
+def _count_took(response) -> None:
+    # Time Elasticsearch spent on the request itself; the rest of an es.* phase is network and client overhead.
+    profiling.count("es.took_ms", response["took"])
+
+
 @contextmanager
 def connect_es() -> Generator[Elasticsearch, None, None]:
-    es = Elasticsearch("https://localhost:9200",  basic_auth=(ELASTIC_USER, ELASTIC_PASSWORD), verify_certs=True,
-                   ca_certs="./http_ca.crt")
-    try:
-        yield es
-    finally:
-        es: Elasticsearch
-        # es.transport.close()
+    # The shared client is closed once, when the command finishes.
+    yield get_client()
 
 
 @app.command()
@@ -34,104 +52,54 @@ def index_document(
     text_path: Path = typer.Option(...),
 ) -> None:
     with connect_es() as es:
-        res = []
-        for path in ("description.txt", "critical_reception.txt", "additional_notes.txt"):
-            with open(text_path / path, "r") as f:
-                res.append(f.read())
-
-        document = asdict(
+        res = read_texts(text_path)
+        document = to_source(
             Album(album_name=album_name, release_date=release_date.date(), musicians=musicians, box_office=box_office,
                   description=res[0], critical_reception=res[1], additional_notes=res[2])
         )
-        del document['_id']
-        response = es.index(index=INDEX, id=str(uuid4()), document=document)
+        with profiling.phase("es.index"):
+            response = es.index(index=INDEX, id=str(uuid4()), document=document)
         print(response['result'])
 
 
+@app.command()
+def bulk_index(
+    manifest_path: Path = typer.Argument(..., help="CSV or JSON lines file with one album per row."),
+    texts_path: Path = typer.Option(Path("texts"), help="Directory with a folder of text files per album."),
+    chunk_size: int = typer.Option(DEFAULT_CHUNK_SIZE, min=1, help="Documents per bulk request."),
+    parallelism: int = typer.Option(DEFAULT_PARALLELISM, min=1, help="Bulk requests sent at the same time."),
+) -> None:
+    report = BulkReport()
+    with connect_es() as es:
+        run_bulk_index(es, INDEX, iter_actions(manifest_path, texts_path, report), chunk_size, parallelism, report)
+    rate = report.documents / report.seconds if report.seconds else 0
+    print(f"Indexed {report.documents - len(report.failed)} of {report.documents} documents in "
+          f"{report.seconds:.2f}s ({rate:.0f} docs/s)")
+    for skipped in report.skipped:
+        print(f"Skipped {skipped}")
+    for failed in report.failed:
+        print(f"Failed {failed}")
+    if report.failed:
+        raise typer.Exit(code=1)
+
+
 @app.command()
 def set_mapping(force_delete: bool = typer.Option(default=False)):
-    analyzer = {
-        "analysis": {
-            "filter": {
-                "english_stop": {
-                    "type": "stop",
-                    "stopwords": "_english_"
-                },
-                "english_keywords": {
-                    "type": "keyword_marker",
-                    "keywords": ["example"]
-                },
-                "english_stemmer": {
-                    "type": "stemmer",
-                    "language": "english"
-                },
-                "english_possessive_stemmer": {
-                    "type": "stemmer",
-                    "language": "possessive_english"
-                }
-            },
-            "analyzer": {
-                "custom_wikipedia_analyzer": {
-                    "tokenizer": "standard",
-                    "char_filter": [
-                        "wikipedia_symbols"
-                    ],
-                    "filter": [
-                        "lowercase",
-                        "english_possessive_stemmer",
-                        "english_stop",
-                        "english_stemmer"
-                    ]
-                }
-            },
-            "char_filter": {
-                "wikipedia_symbols": {
-                    "type": "pattern_replace",
-                    "pattern": "\[\d+\]",
-                    "replacement": " "
-                },
-            }
-        }
-    }
-    mapping = {
-            "properties": {
-                "album_name": {
-                    "type": "keyword"
-                },
-                "musicians": {
-                    "type": "keyword"
-                },
-                "box_office": {
-                    "type": "integer"
-                },
-                "release_date": {
-                    "type": "date"
-                },
-                "description": {
-                    "type": "text",
-                    "analyzer": "standard"
-                },
-                "critical_reception": {
-                    "type": "text",
-                    "analyzer": "custom_wikipedia_analyzer"
-                },
-                "additional_notes": {
-                    "type": "text",
-                    "analyzer": "english"
-                }
-            }
-        }
     with connect_es() as es:
         es: Elasticsearch
         if force_delete:
-            es.options(ignore_status=[400, 404]).indices.delete(index=INDEX)
-        es.indices.create(index=INDEX, mappings=mapping, settings=analyzer)
+            with profiling.phase("es.delete_index"):
+                es.options(ignore_status=[400, 404]).indices.delete(index=INDEX)
+        with profiling.phase("es.create_index"):
+            es.indices.create(index=INDEX, mappings=INDEX_MAPPING, settings=INDEX_SETTINGS)
 
 
 @app.command()
 def search_by_album_name(album_name: str = typer.Argument(...)):
     with connect_es() as es:
-        res = es.search(index=INDEX, query={"fuzzy": {"album_name": {"value": album_name}}})
+        with profiling.phase("es.search"):
+            res = es.search(index=INDEX, query={"fuzzy": {"album_name": {"value": album_name}}})
+        _count_took(res)
         for hit in res['hits']['hits']:
             print(Album(**hit['_source'], _id=hit['_id']))
 
@@ -139,7 +107,8 @@ def search_by_album_name(album_name: str = typer.Argument(...)):
 @app.command()
 def delete(id: UUID):
     with connect_es() as es:
-        response = es.delete(index=INDEX, id=str(id))
+        with profiling.phase("es.delete"):
+            response = es.delete(index=INDEX, id=str(id))
         print(response['result'])
 
 
@@ -190,19 +159,45 @@ def add_match(
         query.add_match(option, key, value)
 
 @app.command()
-def search(display_texts: bool = typer.Option(default=False)):
+def search(
+        display_texts: bool = typer.Option(default=False),
+        export: Optional[Path] = typer.Option(None, help="Write every matching document to this JSON lines file."),
+        page_size: int = typer.Option(DEFAULT_PAGE_SIZE, min=1, help="Hits fetched per request when exporting."),
+):
     with BoolQuery.load() as query:
         query: BoolQuery
         search_query = query.to_dict()
         with connect_es() as es:
-            res = es.search(index=INDEX, query=search_query)
+            if export is not None:
+                with open(export, "w") as f:
+                    exported = export_hits(es, INDEX, search_query, f, page_size, source_filter(display_texts))
+                print(f"Exported {exported} documents to {export}")
+                return
+            with profiling.phase("es.search"):
+                res = es.search(index=INDEX, query=search_query, source=source_filter(display_texts))
+            _count_took(res)
             for hit in res['hits']['hits']:
-                album = Album(**hit['_source'], _id=hit['_id'], _score=hit['_score'])
-                if not display_texts:
-                    album.description = ""
-                    album.additional_notes = ""
-                    album.critical_reception = ""
-                print(album)
+                print(album_from_hit(hit))
+
+
+@app.command()
+def search_batch(
+    queries_path: Path = typer.Argument(..., help="JSON lines file with one query definition per line."),
+    output: Path = typer.Option(Path("results.jsonl"), help="JSON lines file the results are streamed to."),
+    size: int = typer.Option(DEFAULT_HITS, min=0, help="Hits returned per query."),
+    batch_size: int = typer.Option(DEFAULT_BATCH_SIZE, min=1, help="Queries per _msearch request."),
+    concurrency: int = typer.Option(DEFAULT_CONCURRENCY, min=1, help="_msearch requests sent at the same time."),
+    display_texts: bool = typer.Option(default=False),
+):
+    with connect_es() as es, open(output, "w") as f:
+        report = run_batch(es, INDEX, read_query_definitions(queries_path), f, size, batch_size, concurrency,
+                           display_texts)
+    rate = report.queries / report.seconds if report.seconds else 0
+    print(f"{report.queries} queries, {report.failed} failed, in {report.seconds:.2f}s ({rate:.0f} queries/s)")
+    if report.took:
+        took = sorted(report.took)
+        print(f"took ms: median {took[len(took) // 2]}, p95 {took[min(len(took) - 1, len(took) * 95 // 100)]}, "
+              f"max {took[-1]}")
 
 
 @app.command()
@@ -0,0 +1,73 @@
+# Shared by set-mapping and the local engine, which reads the field types and analyzers from it.
+INDEX_SETTINGS = {
+    "analysis": {
+        "filter": {
+            "english_stop": {
+                "type": "stop",
+                "stopwords": "_english_"
+            },
+            "english_keywords": {
+                "type": "keyword_marker",
+                "keywords": ["example"]
+            },
+            "english_stemmer": {
+                "type": "stemmer",
+                "language": "english"
+            },
+            "english_possessive_stemmer": {
+                "type": "stemmer",
+                "language": "possessive_english"
+            }
+        },
+        "analyzer": {
+            "custom_wikipedia_analyzer": {
+                "tokenizer": "standard",
+                "char_filter": [
+                    "wikipedia_symbols"
+                ],
+                "filter": [
+                    "lowercase",
+                    "english_possessive_stemmer",
+                    "english_stop",
+                    "english_stemmer"
+                ]
+            }
+        },
+        "char_filter": {
+            "wikipedia_symbols": {
+                "type": "pattern_replace",
+                "pattern": r"\[\d+\]",
+                "replacement": " "
+            },
+        }
+    }
+}
+
+INDEX_MAPPING = {
+    "properties": {
+        "album_name": {
+            "type": "keyword"
+        },
+        "musicians": {
+            "type": "keyword"
+        },
+        "box_office": {
+            "type": "integer"
+        },
+        "release_date": {
+            "type": "date"
+        },
+        "description": {
+            "type": "text",
+            "analyzer": "standard"
+        },
+        "critical_reception": {
+            "type": "text",
+            "analyzer": "custom_wikipedia_analyzer"
+        },
+        "additional_notes": {
+            "type": "text",
+            "analyzer": "english"
+        }
+    }
+}
@@ -0,0 +1,29 @@
+from typing import Callable, Iterable, Iterator, TypeVar
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Requests read ahead per worker; bounds memory however long the input is.
+READ_AHEAD = 2
+
+
+def bounded_map(function: Callable[[T], R], items: Iterable[T], workers: int) -> Iterator[R]:
+    # Like ThreadPoolExecutor.map, but items are consumed lazily and results are yielded in input order as soon
+    # as they are ready, so requests stay pipelined while earlier results are written out.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for item in items:
+            if len(in_flight) >= READ_AHEAD * workers:
+                yield in_flight.popleft().result()
+            in_flight.append(pool.submit(function, item))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def chunks(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
@@ -6,6 +6,8 @@ from contextlib import contextmanager
 import os
 from datetime import date
 
+from search_common import profiling
+
 
 QUERY_PATH = "query.json"
 
@@ -49,7 +51,7 @@ class BoolQuery:
             fuzziness = "AUTO"
         query_value.append({"match": {key: {"query": value, "fuzziness": fuzziness}}})
 
-    def add_range(self, option: QueryOption, key: str, gte: Optional[Union[float, date]], lte: Optional[Union[float, date]]):
+    def add_range(self, option: QueryOption, key: str, gte: Optional[Union[float, date]] = None, lte: Optional[Union[float, date]] = None):
         query_value = self._get_option(option)
         query_value.append({"range": {key: {"gte": gte, "lte": lte}}})
 
@@ -61,15 +63,33 @@ class BoolQuery:
         query_value = self._get_option(option)
         query_value.append({"match": {key: value}})
 
+    @classmethod
+    def from_clauses(cls, clauses: list[dict[str, Any]]) -> 'BoolQuery':
+        # Clauses use the vocabulary of the add-* commands, e.g.
+        # {"option": "must", "type": "term", "key": "musicians", "value": "Rachel Goswell"},
+        # {"option": "filter", "type": "range", "key": "box_office", "gte": 40000} or
+        # {"option": "should", "type": "fuzzy", "key": "album_name", "value": "Loveles", "fuzziness": 1}.
+        query = cls()
+        add = {"term": query.add_term, "match": query.add_match, "range": query.add_range,
+               "fuzzy": query.add_fuzziness}
+        for clause in clauses:
+            clause = dict(clause)
+            option = QueryOption(clause.pop("option"))
+            kind = clause.pop("type")
+            if kind not in add:
+                raise ValueError(f"Unknown clause type {kind!r}, expected one of {', '.join(add)}")
+            add[kind](option, **clause)
+        return query
+
     def save(self) -> None:
-        with open(QUERY_PATH, "w") as f:
+        with open(QUERY_PATH, "w") as f, profiling.phase("json.dump"):
             json.dump(asdict(self), f, default=str, indent=4)
 
     @classmethod
     @contextmanager
     def load(cls) -> Generator['BoolQuery', None, None]:
         try:
-            with open(QUERY_PATH, "r") as f:
+            with open(QUERY_PATH, "r") as f, profiling.phase("json.load"):
                 data = json.load(f)
                 query = cls(**data)
         except FileNotFoundError:
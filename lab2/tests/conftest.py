@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The lab modules are imported flat, as main.py does when it is run from the lab directory.
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,54 @@
+import pytest
+from elastic_transport import ApiResponseMeta, BaseNode, ConnectionTimeout, HttpHeaders, NodeConfig
+from elastic_transport._node import NodeApiResponse
+
+import client
+from client import BackoffTransport
+
+
+class ScriptedNode(BaseNode):
+    # Answers with the next outcome of the class level script: an exception to raise or a status to return.
+    script: list = []
+    calls = 0
+
+    def perform_request(self, method, target, body=None, headers=None, request_timeout=None):
+        ScriptedNode.calls += 1
+        outcome = ScriptedNode.script.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        meta = ApiResponseMeta(status=outcome, http_version="1.1", headers=HttpHeaders(), duration=0.0,
+                               node=self.config)
+        return NodeApiResponse(meta, b"{}")
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(client.time, "sleep", lambda seconds: None)
+    ScriptedNode.calls = 0
+
+
+def _transport(**options):
+    return BackoffTransport([NodeConfig("http", "localhost", 9200)], node_class=ScriptedNode, max_retries=3,
+                            **options)
+
+
+def test_timeout_is_not_retried_without_retry_on_timeout():
+    ScriptedNode.script = [ConnectionTimeout("timed out"), 200]
+    with pytest.raises(ConnectionTimeout):
+        _transport(retry_on_timeout=False).perform_request("GET", "/")
+    assert ScriptedNode.calls == 1
+
+
+def test_timeout_is_retried_with_retry_on_timeout():
+    ScriptedNode.script = [ConnectionTimeout("timed out"), 200]
+    assert _transport(retry_on_timeout=True).perform_request("GET", "/").meta.status == 200
+    assert ScriptedNode.calls == 2
+
+
+def test_per_request_retry_options_win():
+    ScriptedNode.script = [503, 200]
+    response = _transport(retry_on_status=(503,)).perform_request("GET", "/", retry_on_status=())
+    assert response.meta.status == 503
+    ScriptedNode.script = [ConnectionTimeout("timed out"), 200]
+    assert _transport(retry_on_timeout=False).perform_request("GET", "/", retry_on_timeout=True).meta.status == 200
+    assert ScriptedNode.calls == 3
@@ -0,0 +1,170 @@
+from math import log
+
+import pytest
+
+from local_engine import B, K1, LocalEngine, LocalEngineError, LocalIndex, edit_distance, fuzziness_distance
+
+MAPPINGS = {"properties": {
+    "album_name": {"type": "keyword"},
+    "musicians": {"type": "keyword"},
+    "box_office": {"type": "integer"},
+    "release_date": {"type": "date"},
+    "description": {"type": "text", "analyzer": "standard"},
+}}
+
+ALBUMS = {
+    "souvlaki": {"album_name": "Souvlaki", "musicians": ["Neil Halstead", "Rachel Goswell"], "box_office": 50000,
+                 "release_date": "1994-02-01", "description": "dream pop album with guitar layers"},
+    "loveless": {"album_name": "Loveless", "musicians": ["Kevin Shields"], "box_office": 60000,
+                 "release_date": "1991-11-04", "description": "shoegaze album with guitar noise"},
+    "iron_maiden": {"album_name": "Iron Maiden", "musicians": ["Steve Harris"], "box_office": 2500000,
+                    "release_date": "1980-04-14", "description": "heavy metal debut"},
+    "just_for_a_day": {"album_name": "Just for a Day", "musicians": ["Neil Halstead"], "box_office": 30000,
+                       "release_date": "1991-09-02", "description": "shoegaze debut album"},
+}
+
+
+@pytest.fixture
+def index() -> LocalIndex:
+    index = LocalIndex(MAPPINGS)
+    for id, source in ALBUMS.items():
+        index.add(id, source)
+    return index
+
+
+def _ids(index: LocalIndex, query: dict) -> set[str]:
+    _, hits = index.search(query, size=100)
+    return {hit["_id"] for hit in hits}
+
+
+def test_bool_must_intersects_and_must_not_excludes(index):
+    query = {"bool": {"must": [{"match": {"description": "album"}}],
+                      "must_not": [{"term": {"musicians": "Kevin Shields"}}]}}
+    assert _ids(index, query) == {"souvlaki", "just_for_a_day"}
+
+
+def test_bool_filter_does_not_score(index):
+    scores = index.evaluate({"bool": {"filter": [{"term": {"musicians": "Neil Halstead"}}]}})
+    assert scores == {0: 0.0, 3: 0.0}
+    with_must = index.evaluate({"bool": {"must": [{"match": {"description": "shoegaze"}}],
+                                         "filter": [{"term": {"musicians": "Neil Halstead"}}]}})
+    assert with_must == {3: index.evaluate({"match": {"description": "shoegaze"}})[3]}
+
+
+def test_bool_should_alone_needs_one_match(index):
+    query = {"bool": {"should": [{"match": {"description": "metal"}}, {"match": {"description": "dream"}}]}}
+    assert _ids(index, query) == {"souvlaki", "iron_maiden"}
+
+
+def test_bool_should_next_to_must_only_adds_score(index):
+    must = {"match": {"description": "album"}}
+    scores = index.evaluate({"bool": {"must": [must], "should": [{"match": {"description": "noise"}}]}})
+    assert set(scores) == set(index.evaluate(must))
+    assert max(scores, key=scores.get) == 1
+
+
+def test_bool_without_clauses_matches_everything(index):
+    assert _ids(index, {"bool": {}}) == set(ALBUMS)
+
+
+@pytest.mark.parametrize("bounds, expected", [
+    ({"gte": 50000}, {"souvlaki", "loveless", "iron_maiden"}),
+    ({"gt": 50000}, {"loveless", "iron_maiden"}),
+    ({"lte": 50000}, {"souvlaki", "just_for_a_day"}),
+    ({"lt": 50000}, {"just_for_a_day"}),
+    ({"gte": 30000, "lt": 60000}, {"souvlaki", "just_for_a_day"}),
+    ({"gt": 2500000}, set()),
+])
+def test_numeric_range(index, bounds, expected):
+    assert _ids(index, {"range": {"box_office": bounds}}) == expected
+
+
+def test_date_range(index):
+    query = {"range": {"release_date": {"gte": "1991-01-01", "lte": "1991-12-31"}}}
+    assert _ids(index, query) == {"loveless", "just_for_a_day"}
+
+
+def test_term_on_keyword_and_number(index):
+    assert _ids(index, {"term": {"album_name": "Loveless"}}) == {"loveless"}
+    assert _ids(index, {"term": {"album_name": "loveless"}}) == set()
+    assert _ids(index, {"term": {"box_office": 30000}}) == {"just_for_a_day"}
+
+
+def test_match_operator_and(index):
+    assert _ids(index, {"match": {"description": {"query": "shoegaze debut", "operator": "and"}}}) == \
+        {"just_for_a_day"}
+    assert _ids(index, {"match": {"description": "shoegaze debut"}}) == {"loveless", "just_for_a_day",
+                                                                         "iron_maiden"}
+
+
+def test_bm25_score(index):
+    # "metal" occurs once, in one three word description out of four.
+    lengths = [6, 5, 3, 3]
+    idf = log(1 + (4 - 1 + 0.5) / (1 + 0.5))
+    expected = idf * (K1 + 1) / (1 + K1 * (1 - B + B * 3 / (sum(lengths) / 4)))
+    assert index.evaluate({"match": {"description": "metal"}}) == {2: pytest.approx(expected)}
+
+
+@pytest.mark.parametrize("a, b, distance", [
+    ("eagle", "eagle", 0), ("eagle", "eagel", 1), ("eagle", "beagle", 1), ("eagle", "eager", 2),
+    ("abc", "xyz", 3),
+])
+def test_edit_distance_counts_transpositions_once(a, b, distance):
+    assert edit_distance(a, b, 3) == distance
+
+
+@pytest.mark.parametrize("fuzziness, term, distance", [
+    ("AUTO", "ab", 0), ("AUTO", "abcde", 1), ("AUTO", "abcdef", 2), (None, "abcdef", 2), (1, "abcdef", 1),
+])
+def test_fuzziness_distance(fuzziness, term, distance):
+    assert fuzziness_distance(fuzziness, term) == distance
+
+
+def test_fuzzy_queries(index):
+    assert _ids(index, {"fuzzy": {"description": "shoegaez"}}) == {"loveless", "just_for_a_day"}
+    assert _ids(index, {"fuzzy": {"description": {"value": "gutar", "fuzziness": 1}}}) == {"souvlaki", "loveless"}
+    assert _ids(index, {"fuzzy": {"description": {"value": "gutr", "fuzziness": 1}}}) == set()
+    assert _ids(index, {"match": {"description": {"query": "heavi metl", "fuzziness": "AUTO"}}}) == {"iron_maiden"}
+
+
+def test_replacing_and_removing_documents(index):
+    assert index.add("loveless", {**ALBUMS["loveless"], "box_office": 10}) == "updated"
+    assert _ids(index, {"range": {"box_office": {"lt": 100}}}) == {"loveless"}
+    assert _ids(index, {"range": {"box_office": {"gte": 60000}}}) == {"iron_maiden"}
+    assert index.remove("loveless")
+    assert not index.remove("loveless")
+    assert _ids(index, {"match": {"description": "noise"}}) == set()
+    assert len(index) == 3
+
+
+def test_range_options(index):
+    query = {"range": {"release_date": {"gte": "1991-01-01", "lte": "1991-12-31", "format": "yyyy-MM-dd",
+                                        "boost": 2.0}}}
+    assert _ids(index, query) == {"loveless", "just_for_a_day"}
+
+
+def test_unsupported_queries_fail(index):
+    with pytest.raises(LocalEngineError):
+        index.evaluate({"range": {"description": {"gte": 1}}})
+    with pytest.raises(LocalEngineError):
+        index.evaluate({"range": {"box_office": {"gte": 1, "relation": "within"}}})
+    with pytest.raises(LocalEngineError):
+        index.evaluate({"wildcard": {"description": "sho*"}})
+
+
+def test_engine_round_trip(tmp_path):
+    path = tmp_path / "local_index.json"
+    engine = LocalEngine(path)
+    engine.indices.create("albums", mappings=MAPPINGS)
+    for id, source in ALBUMS.items():
+        engine.index("albums", source, id=id)
+    engine.close()
+
+    engine = LocalEngine.load(path)
+    response = engine.search("albums", {"term": {"musicians": "Neil Halstead"}}, source={"includes": ["album_name"]})
+    assert response["hits"]["total"]["value"] == 2
+    assert {hit["_source"]["album_name"] for hit in response["hits"]["hits"]} == {"Souvlaki", "Just for a Day"}
+    responses = engine.msearch([{"index": "albums"}, {"query": {"match_all": {}}, "size": 1},
+                                {"index": "missing"}, {"query": {"match_all": {}}}])["responses"]
+    assert [response["status"] for response in responses] == [200, 404]
+    assert len(responses[0]["hits"]["hits"]) == 1